@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import stat
+from pathlib import Path
+
+# A stub Rscript that answers the builder's R queries from the fake installation's fake_r.json file
+_RSCRIPT = '''#!%(python)s
+import os, sys, json
+r_home = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+with open(os.path.join(r_home, "fake_r.json")) as fake_r:
+    info = json.load(fake_r)
+expr = " ".join(sys.argv[1:])
+if "writeLines" in expr and "capability" in expr:
+    lines = ["major\\t%%s" %% info["major"], "minor\\t%%s" %% info["minor"], "r_home\\t%%s" %% info["r_home"],
+             "platform\\t%%s" %% info["platform"]]
+    lines += ["capability\\t%%s\\t%%s" %% (cap, "TRUE" if value else "FALSE")
+              for cap, value in info["capabilities"].items()]
+    lines += ["package\\t%%s\\t%%s\\t%%s" %% (pkg, desc["version"], desc["priority"])
+              for pkg, desc in info["packages"].items()]
+    print("\\n".join(lines))
+elif "R.version$major" in expr:
+    print('[1] "%%s"' %% info["major"])
+elif "R.version$minor" in expr:
+    print('[1] "%%s"' %% info["minor"])
+elif "priority" in expr:
+    priority = "recommended" if "recommended" in expr else "base"
+    print(" ".join(pkg for pkg, desc in info["packages"].items() if desc["priority"] == priority), end="")
+elif "install.packages" in expr and "repos=NULL" in expr:
+    # Install a package file into a library like R CMD INSTALL: args are the file, the package, and the library
+    import tarfile
+    pkg_file, pkg, library = sys.argv[sys.argv.index("--args") + 1:][:3]
+    try:
+        with tarfile.open(pkg_file) as tar:
+            tar.extractall(library)
+    except (OSError, tarfile.TarError) as err:
+        sys.exit("ERROR: %%s" %% err)
+    with open(os.path.join(library, pkg, "DESCRIPTION"), "a") as desc:
+        desc.write("Built: R %%s.%%s; ; ; unix\\n" %% (info["major"], info["minor"]))
+'''
+
+
+def make_fake_r(r_home, n_packages=30, n_recommended=15, n_etc=10, libnn="lib64", version="3.4.4"):
+    """
+    Create a synthetic R installation that the builders can use without R.
+    :param r_home:  The path of the fake installation (--r_home).
+    :param n_packages:  The number of base packages in the library.
+    :param n_recommended:  The number of recommended packages in the library.
+    :param n_etc:  The number of files in R's etc directory.
+    :param libnn:  The name of the lib directory ("lib64" or "lib").
+    :param version:  The R version that is reported.
+    :return:  Returns the path of the fake installation.
+    """
+    r_home = Path(r_home)
+    lib_home = r_home / libnn / "R"
+    for directory in (r_home / "bin", r_home / "share" / "man" / "man1", r_home / "info",
+                      lib_home / "bin", lib_home / "modules", lib_home / "lib", lib_home / "include",
+                      lib_home / "doc", lib_home / "share", lib_home / "tests", lib_home / "etc",
+                      lib_home / "library"):
+        directory.mkdir(parents=True, exist_ok=True)
+    for i in range(n_etc):
+        (lib_home / "etc" / ("etc_file_%s" % i)).write_text("# fake R etc file\n")
+
+    packages = {}
+    for i in range(n_packages + n_recommended):
+        pkg = "base%s" % i if i < n_packages else "recommended%s" % (i - n_packages)
+        priority = "base" if i < n_packages else "recommended"
+        pkg_dir = lib_home / "library" / pkg
+        (pkg_dir / "R").mkdir(parents=True, exist_ok=True)
+        (pkg_dir / "DESCRIPTION").write_text("Package: %s\nVersion: %s\nPriority: %s\nBuilt: R %s; ; ; unix\n" %
+                                             (pkg, version, priority, version))
+        (pkg_dir / "R" / pkg).write_text("# fake R code\n")
+        packages[pkg] = {"version": version, "priority": priority}
+
+    major, minor = version.split(".", 1)
+    info = {"major": major, "minor": minor, "r_home": str(lib_home), "platform": "x86_64-pc-linux-gnu",
+            "capabilities": {"jpeg": True, "png": True, "X11": False}, "packages": packages}
+    (r_home / "fake_r.json").write_text(json.dumps(info))
+
+    rscript = r_home / "bin" / "Rscript"
+    rscript.write_text(_RSCRIPT % {"python": sys.executable})
+    rscript.chmod(rscript.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    r_exe = r_home / "bin" / "R"
+    if not r_exe.exists():
+        os.symlink("Rscript", str(r_exe))
+
+    return r_home
@@ -0,0 +1,161 @@
+"""
+Benchmark the renv builders against synthetic R installations.
+
+    python -m benchmarks.run --output results.json --baseline previous.json
+
+Each scenario times LinuxRenvBuilder construction (with a cold and a warm R
+installation cache), build_venv(), a clear and rebuild, and sourcing the
+activate script.  Scenarios run on tmpfs (when /dev/shm is available) and on an
+emulated slow filesystem that adds latency to every metadata syscall.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import statistics
+import subprocess as sp
+import tempfile
+from contextlib import contextmanager
+
+import click
+
+from benchmarks.fake_r import make_fake_r
+from renv import LinuxRenvBuilder
+
+
+@contextmanager
+def slow_filesystem(latency):
+    """
+    Emulate a network filesystem by adding latency to the metadata syscalls the builders make.
+    :param latency:  The seconds added to each syscall.
+    """
+    patched = {}
+    for name in ("mkdir", "symlink", "link", "open", "chmod", "rename", "stat"):
+        original = getattr(os, name)
+
+        def slow(*args, _original=original, **kwargs):
+            time.sleep(latency)
+            return _original(*args, **kwargs)
+
+        patched[name] = original
+        setattr(os, name, slow)
+        # Keep the dir_fd support of the wrapped functions
+        if original in os.supports_dir_fd:
+            os.supports_dir_fd.add(slow)
+    try:
+        yield
+    finally:
+        for name, original in patched.items():
+            os.supports_dir_fd.discard(getattr(os, name))
+            setattr(os, name, original)
+
+
+def run_scenario(workdir, r_home, repeat):
+    """
+    Time the builder operations.
+    :param workdir:  The directory of the renv root.
+    :param r_home:  The fake R installation.
+    :param repeat:  The number of times each operation is timed.
+    :return:  Returns a dictionary of operation names to their median seconds.
+    """
+    renv_path = os.path.join(workdir, ".renv")
+    os.makedirs(os.path.join(renv_path, "cran"), exist_ok=True)
+    params = dict(path=workdir, name=".renv", r_home=str(r_home))
+    timings = {"construct_cold": [], "construct_warm": [], "build_venv": [], "clear_rebuild": [], "activate": []}
+    for i in range(repeat):
+        env_name = "bench%s" % i
+        shutil.rmtree(os.path.join(renv_path, "cache"), ignore_errors=True)
+        with timed(timings["construct_cold"]):
+            LinuxRenvBuilder(env_name=env_name, **params)
+        with timed(timings["construct_warm"]):
+            builder = LinuxRenvBuilder(env_name=env_name, **params)
+        with timed(timings["build_venv"]):
+            builder.build_venv()
+        with timed(timings["clear_rebuild"]):
+            LinuxRenvBuilder(env_name=env_name, clear=True, **params).build_venv()
+        activate = os.path.join(renv_path, "cran", env_name, "bin", "activate")
+        with timed(timings["activate"]):
+            sp.check_call(["sh", "-c", '. "%s" && deactivate' % activate])
+
+    return {operation: statistics.median(seconds) for operation, seconds in timings.items()}
+
+
+@contextmanager
+def timed(timings):
+    start = time.perf_counter()
+    yield
+    timings.append(time.perf_counter() - start)
+
+
+def compare(results, baseline, threshold):
+    """
+    Find the operations that are slower than the baseline.
+    :param results:  The current results.
+    :param baseline:  The baseline results.
+    :param threshold:  The allowed ratio of current to baseline seconds.
+    :return:  Returns a list of regression descriptions.
+    """
+    regressions = []
+    for scenario, operations in results["scenarios"].items():
+        for operation, seconds in operations.items():
+            previous = baseline.get("scenarios", {}).get(scenario, {}).get(operation)
+            if previous and seconds > previous * threshold:
+                regressions.append("%s/%s: %.4fs -> %.4fs" % (scenario, operation, previous, seconds))
+    return regressions
+
+
+@click.command()
+@click.option('--packages', default=30, show_default=True, help="The number of base packages in the fake R.")
+@click.option('--recommended', default=15, show_default=True,
+              help="The number of recommended packages in the fake R.")
+@click.option('--etc-files', default=10, show_default=True, help="The number of etc files in the fake R.")
+@click.option('--libnn', type=click.Choice(["lib64", "lib"]), default="lib64", show_default=True,
+              help="The lib directory layout of the fake R.")
+@click.option('--repeat', default=5, show_default=True, help="The number of times each operation is timed.")
+@click.option('--latency', default=0.002, show_default=True,
+              help="The seconds added to each syscall on the emulated slow filesystem.")
+@click.option('--output', default=None, type=click.Path(dir_okay=False), help="Write the results to a JSON file.")
+@click.option('--baseline', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="Compare the results to a previous JSON results file.")
+@click.option('--threshold', default=1.25, show_default=True,
+              help="The slowdown ratio that counts as a regression.")
+def main(packages, recommended, etc_files, libnn, repeat, latency, output, baseline, threshold):
+    logging.disable(logging.INFO)
+    tmpfs = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    results = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                        "packages": packages, "recommended": recommended, "etc_files": etc_files,
+                        "libnn": libnn, "repeat": repeat, "latency": latency},
+               "scenarios": {}}
+    for scenario in ("tmpfs", "slowfs"):
+        workdir = tempfile.mkdtemp(prefix="renv-bench-", dir=tmpfs if scenario == "tmpfs" else None)
+        try:
+            r_home = make_fake_r(os.path.join(workdir, "R"), n_packages=packages, n_recommended=recommended,
+                                 n_etc=etc_files, libnn=libnn)
+            if scenario == "slowfs":
+                with slow_filesystem(latency):
+                    results["scenarios"][scenario] = run_scenario(workdir, r_home, repeat)
+            else:
+                results["scenarios"][scenario] = run_scenario(workdir, r_home, repeat)
+        finally:
+            shutil.rmtree(workdir)
+
+    for scenario, operations in results["scenarios"].items():
+        for operation, seconds in operations.items():
+            click.echo("%-8s %-16s %10.4fs" % (scenario, operation, seconds))
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), threshold)
+        for regression in regressions:
+            click.secho("Regression: %s" % regression, fg="red")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,62 @@
-from .core import (LinuxRenvBuilder,BaseRenvBuilder, MacRenvBuilder, WindowsRenvBuilder)
-from .utils import (get_r_installed_root, get_r_path, get_renv_path, get_system_venv, get_user_home_dir,
-                    create_directory, create_symlink, system_r_call)
+import sys
+import importlib
+
+# The builders and their dependencies are only imported when they are used, so that renv --help starts quickly.
+_LAZY_ATTRIBUTES = {
+    "LinuxRenvBuilder": "renv.core",
+    "BaseRenvBuilder": "renv.core",
+    "MacRenvBuilder": "renv.core",
+    "WindowsRenvBuilder": "renv.core",
+    "PackageStore": "renv.store",
+    "RenvError": "renv.exceptions",
+    "RenvNotInitializedError": "renv.exceptions",
+    "RInstallationError": "renv.exceptions",
+    "EnvExistsError": "renv.exceptions",
+    "EnvNotFoundError": "renv.exceptions",
+    "EnvUpgradeError": "renv.exceptions",
+    "PackageInstallError": "renv.exceptions",
+    "get_r_installed_root": "renv.utils",
+    "get_r_path": "renv.utils",
+    "get_renv_path": "renv.utils",
+    "get_system_venv": "renv.utils",
+    "get_user_home_dir": "renv.utils",
+    "create_symlink": "renv.utils",
+    "create_directory": "renv.utils",
+    "system_r_call": "renv.utils",
+    "system_r_probe": "renv.utils",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ (PEP 562) is new in Python 3.7
+    for _name in _LAZY_ATTRIBUTES:
+        __getattr__(_name)
+
 
 __all__ = ("LinuxRenvBuilder",
            "MacRenvBuilder",
            "BaseRenvBuilder",
            "WindowsRenvBuilder",
+           "PackageStore",
+           "RenvError",
+           "RenvNotInitializedError",
+           "RInstallationError",
+           "EnvExistsError",
+           "EnvNotFoundError",
+           "EnvUpgradeError",
+           "PackageInstallError",
            "get_r_installed_root",
            "get_r_path",
            "get_renv_path",
@@ -14,4 +65,5 @@ __all__ = ("LinuxRenvBuilder",
            "create_symlink",
            "create_directory",
            "system_r_call",
+           "system_r_probe",
            )
@@ -0,0 +1,253 @@
+"""
+A Python API for managing R environments without the command line.
+
+    import renv.api
+    entry = renv.api.create("myenv", "/usr/local/apps/R/R-3.4.4")
+    entries = await asyncio.gather(*(renv.api.create_async(name, r_home) for name in names))
+
+The functions raise the errors in renv.exceptions (e.g. EnvExistsError) instead
+of exiting, and they return the environment's registry entry (see
+EnvRegistry).  The *_async variants run the same work in the event loop's
+executor, so R probes, builds, and filesystem work never block the loop.
+Concurrent operations on the same environment are serialized by its lock.
+"""
+import asyncio
+import threading
+from functools import partial
+from pathlib import Path
+
+import renv.utils as utils
+from renv.core import BaseRenvBuilder
+from renv.exceptions import EnvNotFoundError, RenvError
+from renv.pack import PackedEnv, pack_env
+from renv.registry import EnvRegistry
+
+DEFAULT_PATH = "~/.beRi"
+DEFAULT_NAME = ".renv"
+
+# Builders of the same R installation are constructed one at a time so that it is only probed once
+_probe_locks = {}
+_probe_locks_lock = threading.Lock()
+
+
+def init(path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """
+    Initialize the .renv root.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :return:  Returns the path of the .renv root.
+    """
+    return BaseRenvBuilder(path=path, name=name, init=True).renv_path
+
+
+def create(env_name, r_home, path=DEFAULT_PATH, name=DEFAULT_NAME, **options):
+    """
+    Create an environment (see LinuxRenvBuilder for the options, e.g. clear, upgrade, or config_file).
+    :param env_name:  The name of the environment.
+    :param r_home:  The root of the R installation.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :return:  Returns the environment's registry entry.
+    """
+    builder = _builder(env_name=env_name, r_home=r_home, path=path, name=name, **options)
+    builder.build_venv()
+    return builder.registry.get(env_name)
+
+
+def clone(src, dst, path=DEFAULT_PATH, name=DEFAULT_NAME, prompt=None):
+    """
+    Clone an environment into a new environment.
+    :param src:  The name of the source environment.
+    :param dst:  The name of the new environment.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :param prompt:  An alternative prompt prefix for the new environment.
+    :return:  Returns the new environment's registry entry.
+    """
+    builder = env_builder(src, path=path, name=name, env_name=dst, prompt=prompt)
+    builder.clone_venv(env_home(src, path=path, name=name))
+    return builder.registry.get(dst)
+
+
+def install(env_name, packages=None, path=DEFAULT_PATH, name=DEFAULT_NAME, workers=4, retries=2):
+    """
+    Install packages into an environment.
+    :param env_name:  The name of the environment.
+    :param packages:  A list of package names.  The renv.yaml package lists are used by default.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :param workers:  The number of R processes that install packages at the same time.
+    :param retries:  The number of times a failed package installation is retried.
+    :return:  Returns a dictionary with the status, version, attempts, and seconds of each package.
+    """
+    return env_builder(env_name, path=path, name=name).install_packages(pkgs=packages, workers=workers,
+                                                                         retries=retries)
+
+
+def remove(env_name, path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """
+    Delete an environment and remove it from the registry.
+    :param env_name:  The name of the environment.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    """
+    env_builder(env_name, path=path, name=name).remove_venv()
+
+
+def pack(env_name, output, path=DEFAULT_PATH, name=DEFAULT_NAME, compression=None):
+    """
+    Stream an environment into a compressed tar archive (see renv.pack.pack_env).
+    :param env_name:  The name of the environment.
+    :param output:  The path of the archive, or "-" for stdout.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :param compression:  "", "gz", "bz2", or "xz".  By default it is chosen from the archive's suffix.
+    :return:  Returns a dictionary with the number of files and bytes that were archived.
+    """
+    return pack_env(env_home(env_name, path=path, name=name), output,
+                    BaseRenvBuilder(path=path, name=name).renv_path, compression=compression)
+
+
+def unpack(archive, env_name=None, path=DEFAULT_PATH, name=DEFAULT_NAME, **options):
+    """
+    Create an environment from an archive written by pack (e.g. on another node or under another prefix).
+    :param archive:  The path of the archive, or "-" for stdin.
+    :param env_name:  The name of the new environment.  The packed environment's name is used by default.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :param options:  Keyword arguments that override the builder's parameters (e.g. clear).
+    :return:  Returns the new environment's registry entry.
+    """
+    with PackedEnv(archive) as packed:
+        env_name = env_name or packed.env_name
+        params = _config_params(packed.config)
+        params.update(options)
+        builder = _builder(env_name=env_name, path=path, name=name, **params)
+        builder.unpack_venv(packed.extract)
+    return builder.registry.get(env_name)
+
+
+def get(env_name, path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """
+    Get an environment's registry entry.
+    :param env_name:  The name of the environment.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :return:  Returns the registry entry.
+    """
+    entry = _registry(path, name).get(env_name)
+    if not entry:
+        raise EnvNotFoundError("%s is not in the registry." % env_name)
+    return entry
+
+
+def list(path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """
+    List the registered environments.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :return:  Returns a list of registry entries sorted by name.
+    """
+    return _registry(path, name).list()
+
+
+def env_home(env_name, path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """
+    Get the path to an environment.
+    :param env_name:  The name of the environment.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :return:  Returns the path to the environment.
+    """
+    return Path(path).expanduser().absolute() / name / "cran" / env_name
+
+
+def env_builder(existing_env, path=DEFAULT_PATH, name=DEFAULT_NAME, **kwargs):
+    """
+    Create the builder of an existing environment from its renv.yaml file.
+    :param existing_env:  The name of the existing environment.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :param kwargs:  Keyword arguments that override the builder's parameters (e.g. env_name for a clone).
+    :return:  Returns the builder.
+    """
+    home = env_home(existing_env, path=path, name=name)
+    config = utils.read_renv_config(home / "renv.yaml")
+    if not config:
+        raise EnvNotFoundError("%s is not an R environment." % home)
+    params = dict(env_name=existing_env, path=path, name=name, **_config_params(config))
+    params.update(kwargs)
+    return _builder(**params)
+
+
+async def create_async(env_name, r_home, path=DEFAULT_PATH, name=DEFAULT_NAME, **options):
+    """Create an environment without blocking the event loop (see create)."""
+    return await _run(create, env_name, r_home, path=path, name=name, **options)
+
+
+async def clone_async(src, dst, path=DEFAULT_PATH, name=DEFAULT_NAME, prompt=None):
+    """Clone an environment without blocking the event loop (see clone)."""
+    return await _run(clone, src, dst, path=path, name=name, prompt=prompt)
+
+
+async def install_async(env_name, packages=None, path=DEFAULT_PATH, name=DEFAULT_NAME, workers=4, retries=2):
+    """Install packages into an environment without blocking the event loop (see install)."""
+    return await _run(install, env_name, packages=packages, path=path, name=name, workers=workers, retries=retries)
+
+
+async def remove_async(env_name, path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """Delete an environment without blocking the event loop (see remove)."""
+    return await _run(remove, env_name, path=path, name=name)
+
+
+async def pack_async(env_name, output, path=DEFAULT_PATH, name=DEFAULT_NAME, compression=None):
+    """Pack an environment without blocking the event loop (see pack)."""
+    return await _run(pack, env_name, output, path=path, name=name, compression=compression)
+
+
+async def unpack_async(archive, env_name=None, path=DEFAULT_PATH, name=DEFAULT_NAME, **options):
+    """Unpack an environment without blocking the event loop (see unpack)."""
+    return await _run(unpack, archive, env_name=env_name, path=path, name=name, **options)
+
+
+async def get_async(env_name, path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """Get an environment's registry entry without blocking the event loop (see get)."""
+    return await _run(get, env_name, path=path, name=name)
+
+
+async def list_async(path=DEFAULT_PATH, name=DEFAULT_NAME):
+    """List the registered environments without blocking the event loop (see list)."""
+    return await _run(list, path=path, name=name)
+
+
+def _builder(**params):
+    venvR = utils.get_system_venv()
+    if venvR is None:
+        raise RenvError("renv does not support this operating system at this time.")
+    r_home = str(Path(params["r_home"]))
+    with _probe_locks_lock:
+        probe_lock = _probe_locks.setdefault(r_home, threading.Lock())
+    with probe_lock:
+        return venvR(**params)
+
+
+def _config_params(config):
+    # The builder parameters that are recorded in an environment's renv.yaml
+    return dict(r_home=config["R_ABS_HOME"], bindir=config.get("R_BIN_DIR"), libdir=config.get("R_LIB_DIR"),
+                recommended_packages=config.get("RECOMMENDED_PACKAGES", True),
+                relocatable=config.get("RELOCATABLE", False))
+
+
+def _registry(path, name):
+    return EnvRegistry(BaseRenvBuilder(path=path, name=name).renv_path / "registry.sqlite")
+
+
+def _run(func, *args, **kwargs):
+    # The default executor of the running loop does the blocking work.  This is only called from coroutines,
+    # where get_event_loop returns the running loop (get_running_loop is new in Python 3.7).
+    return asyncio.get_event_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+__all__ = ("init", "create", "clone", "install", "remove", "pack", "unpack", "get", "list", "env_home",
+           "env_builder", "create_async", "clone_async", "install_async", "remove_async", "pack_async",
+           "unpack_async", "get_async", "list_async")
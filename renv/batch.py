@@ -0,0 +1,98 @@
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import renv.utils as utils
+
+logger = logging.getLogger(__name__)
+
+# Manifest options that are named differently from the builder's parameters (as in the CLI)
+_OPTION_ALIASES = {"includedir": "rincludedir"}
+
+
+def read_manifest(manifest_file):
+    """
+    Read a build-many manifest.  The manifest is a YAML list (or an "environments" key with a list)
+    of entries with an env_name, an r_home, and an optional dictionary of builder options.
+    :param manifest_file:  The path to the YAML manifest.
+    :return:  Returns a list of builder parameter dictionaries.
+    """
+    import yaml
+    with open(str(manifest_file)) as manifest:
+        entries = yaml.safe_load(manifest) or []
+    if isinstance(entries, dict):
+        entries = entries.get("environments") or []
+
+    jobs = []
+    for entry in entries:
+        if not entry.get("env_name") or not entry.get("r_home"):
+            raise ValueError("Each manifest entry needs an env_name and an r_home: %s" % entry)
+        params = {"env_name": entry["env_name"], "r_home": entry["r_home"]}
+        for option, value in (entry.get("options") or {}).items():
+            params[_OPTION_ALIASES.get(option, option)] = value
+        jobs.append(params)
+
+    return jobs
+
+
+def build_many(jobs, path, name, workers=4, verbose=False):
+    """
+    Build many environments concurrently.  Jobs are grouped by R installation so that each
+    installation is only probed once, and the environments are then built in a process pool.
+    :param jobs:  A list of builder parameter dictionaries (see read_manifest).
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :param workers:  The number of environments to build at the same time.
+    :param verbose:  Show verbose output.
+    :return:  Returns a list with the env_name, r_home, status, seconds, and error of each job.
+    """
+    groups = OrderedDict()
+    for params in jobs:
+        params = dict(params, path=path, name=name, verbose=verbose)
+        key = (params["r_home"], params.get("bindir"), params.get("libdir"))
+        groups.setdefault(key, []).append(params)
+
+    # Probe each R installation once so that every build in its group is served from the cache
+    for (r_home, bindir, libdir), group in groups.items():
+        logger.info("Discovering R at %s for %s environments..." % (r_home, len(group)))
+        try:
+            utils.get_system_venv()(path=path, name=name, r_home=r_home, env_name=group[0]["env_name"],
+                                    bindir=bindir, libdir=libdir, verbose=verbose)
+        except Exception as err:
+            logger.error("Unable to discover R at %s: %s" % (r_home, str(err) or err.__class__.__name__))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_build_one, params) for group in groups.values() for params in group]
+        return [future.result() for future in futures]
+
+
+def format_summary(results, seconds):
+    """
+    Format a summary of the throughput and per environment durations of a build-many run.
+    :param results:  The results of build_many.
+    :param seconds:  The total wall time of the run.
+    :return:  Returns the summary text.
+    """
+    built = [result for result in results if result["status"] == "built"]
+    lines = ["%-30s %-8s %8.2fs  %s" % (result["env_name"], result["status"], result["seconds"],
+                                        result["error"] or result["r_home"])
+             for result in sorted(results, key=lambda result: result["seconds"], reverse=True)]
+    lines.append("Built %s of %s environments in %.2fs (%.2f environments/s)." %
+                 (len(built), len(results), seconds, len(built) / seconds if seconds else 0))
+
+    return "\n".join(lines)
+
+
+def _build_one(params):
+    start = time.perf_counter()
+    result = {"env_name": params["env_name"], "r_home": str(params["r_home"]), "status": "built", "error": None}
+    try:
+        builder = utils.get_system_venv()(**params)
+        builder.build_venv()
+    except Exception as err:
+        result["status"] = "failed"
+        result["error"] = str(err) or err.__class__.__name__
+    result["seconds"] = time.perf_counter() - start
+
+    return result
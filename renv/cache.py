@@ -0,0 +1,174 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+
+class RInstallCache(object):
+    """
+The RInstallCache class stores the results of probing system R installations
+in the .renv root so that R does not need to be launched for an installation
+that has already been seen.
+
+Each entry is keyed by the installation's R_HOME and Rscript executable, since
+one R_HOME can be probed through different bin directories (e.g. a relocated or
+wrapped Rscript).  An entry is only valid while the inode and modification time
+of its Rscript executable and its library directory are unchanged.  Upgrading R
+in place changes these, which automatically invalidates the entry.
+"""
+
+    def __init__(self, cache_dir):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = Path(cache_dir)
+        self.cache_file = self.cache_dir / "r_installs.json"
+
+    @staticmethod
+    def fingerprint(rscript, rlibrary):
+        """
+        Get the fingerprint of an R installation.
+        :param rscript:  The path to the installation's Rscript exe.
+        :param rlibrary:  The path to the installation's library directory.
+        :return:  Returns a list of the inode and mtime of each path, or None if either is missing.
+        """
+        fingerprint = []
+        for path in (rscript, rlibrary):
+            try:
+                st = os.stat(str(path))
+            except OSError:
+                return None
+            fingerprint.extend([st.st_ino, st.st_mtime_ns])
+        return fingerprint
+
+    @staticmethod
+    def key(r_home, rscript):
+        """
+        Get the cache key of an R installation.
+        :param r_home:  The R installation's root directory.
+        :param rscript:  The path to the installation's Rscript exe.
+        :return:  Returns the key of the installation's entry.
+        """
+        return "%s%s%s" % (r_home, os.pathsep, rscript)
+
+    def get(self, r_home, rscript, rlibrary):
+        """
+        Get the cached R probe dictionary for an R installation.
+        :param r_home:  The R installation's root directory.
+        :param rscript:  The path to the installation's Rscript exe.
+        :param rlibrary:  The path to the installation's library directory.
+        :return:  Returns the R probe dictionary, or None if there is no valid entry.
+        """
+        entry = self._load().get(self.key(r_home, rscript))
+        if not entry:
+            return None
+        if entry["fingerprint"] != self.fingerprint(rscript, rlibrary):
+            self.logger.debug("The cached R installation info for %s is stale." % r_home)
+            return None
+        self.logger.debug("Using cached R installation info for %s." % r_home)
+        return entry["r_info"]
+
+    def set(self, r_home, rscript, rlibrary, r_info):
+        """
+        Cache the R probe dictionary for an R installation.
+        :param r_home:  The R installation's root directory.
+        :param rscript:  The path to the installation's Rscript exe.
+        :param rlibrary:  The path to the installation's library directory.
+        :param r_info:  The R probe dictionary.
+        """
+        fingerprint = self.fingerprint(rscript, rlibrary)
+        if fingerprint is None:
+            return
+        entries = self._load()
+        entries[self.key(r_home, rscript)] = {"fingerprint": fingerprint, "r_info": r_info}
+        try:
+            self._save(entries)
+        except OSError as err:
+            self.logger.debug("Unable to cache the R installation info for %s: %s" % (r_home, err))
+
+    def _load(self):
+        try:
+            with open(str(self.cache_file)) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        # Write to a temporary file first so that concurrent builds never read a partial cache
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_dir / ("%s.%s.tmp" % (self.cache_file.name, os.getpid()))
+        with open(str(tmp_file), "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(str(tmp_file), str(self.cache_file))
+
+
+class DownloadCache(object):
+    """
+The DownloadCache class keeps the package tarballs that renv downloads in the
+.renv root so that every environment on the node shares a single download.
+
+Files are stored by a hash of their URL next to a .sha256 file with their
+checksum.  Files are verified against an expected MD5 (e.g. the MD5sum field
+of a repository's PACKAGES file) when they are downloaded and against their
+recorded checksum whenever they are reused.  URLs can be remote or file://.
+"""
+
+    def __init__(self, cache_dir):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = Path(cache_dir)
+
+    def path_for(self, url):
+        """
+        Get the cache path of a URL.
+        :param url:  The URL of the file.
+        :return:  Returns the path of the cached file.
+        """
+        url_hash = hashlib.sha1(url.encode()).hexdigest()
+        return self.cache_dir / url_hash[:2] / url_hash / url.rstrip("/").split("/")[-1]
+
+    def fetch(self, url, md5=None):
+        """
+        Get a file from the cache, downloading it first if necessary.
+        :param url:  The URL of the file.
+        :param md5:  The expected MD5 checksum of the file.
+        :return:  Returns the path of the cached file.
+        """
+        cached = self.path_for(url)
+        checksum_file = cached.with_name(cached.name + ".sha256")
+        if cached.exists() and checksum_file.exists():
+            if file_digest(cached, "sha256") == checksum_file.read_text().strip():
+                self.logger.debug("Using the cached download of %s" % url)
+                return cached
+            self.logger.warning("The cached download of %s is corrupt and will be downloaded again." % url)
+
+        # urllib.request is slow to import and is only needed here
+        from urllib.request import urlopen
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cached.with_name("%s.%s.tmp" % (cached.name, os.getpid()))
+        try:
+            with urlopen(url) as response, open(str(tmp_file), "wb") as download:
+                shutil.copyfileobj(response, download)
+            if md5 and file_digest(tmp_file, "md5") != md5:
+                raise ValueError("The MD5 checksum of %s does not match the repository." % url)
+            checksum_file.write_text(file_digest(tmp_file, "sha256"))
+            os.replace(str(tmp_file), str(cached))
+        finally:
+            if tmp_file.exists():
+                tmp_file.unlink()
+        self.logger.debug("Downloaded %s" % url)
+
+        return cached
+
+
+def file_digest(path, algorithm):
+    """
+    Hash the contents of a file.
+    :param path:  The path to the file.
+    :param algorithm:  The hashlib algorithm (e.g. "sha256" or "md5").
+    :return:  Returns the hex digest.
+    """
+    digest = hashlib.new(algorithm)
+    with open(str(path), "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
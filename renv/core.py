@@ -1,18 +1,39 @@
 import sys
+import json
+import socket
 import platform
 import logging
-import re
 import shutil
-import yaml
-from os import environ, listdir
-from pkg_resources import resource_filename, get_distribution
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os import environ, getpid, kill, listdir, readlink, rename, sep, walk
 from pathlib import Path
 
-from cookiecutter.main import cookiecutter
-
 import renv.utils as utils
+from renv.exceptions import (EnvExistsError, EnvUpgradeError, PackageInstallError, RenvNotInitializedError,
+                             RInstallationError)
+from renv.cache import DownloadCache, RInstallCache
+from renv.index import RepoIndex
+from renv.install import PackageInstaller
+from renv.locks import FileLock, env_lock_file, root_lock_file
+from renv.plan import FilesystemPlan
+from renv.registry import EnvRegistry, count_packages
+from renv.profiling import tracer
+from renv.store import PackageStore, link_file, tree_hash
+from renv.templates import get_templates
 from renv import cookies
 
+# The default renv.yaml settings (see the README)
+DEFAULT_CONFIG = {
+    "STANDARD_PKG_LIST": {"BiocInstaller": "Bioconductor", "devtools": "Devtools", "tidyverse": "Tidyverse"},
+    "REPRODUCIBLE_WORKFLOW_PKG_LIST": {"packrat": "Packrat", "miniCRAN": "MiniCRAN"},
+}
+
+# Staging directories of builds on other hosts are only removed once they are this many seconds old
+STALE_STAGING_AGE = 86400
+
 
 class BaseRenvBuilder(object):
     """
@@ -49,7 +70,7 @@ R environment.
         self.renv_path = self.path / name
         
         # Set variable/path of cookies template
-        self.cookie_jar = Path(resource_filename(cookies.__name__, ''))
+        self.cookie_jar = Path(cookies.__file__).parent
         
         # Initialize renv if necessary
         if init:
@@ -63,8 +84,7 @@ R environment.
             # Set the class variables that represent the system's R installation
             self.r_home = Path(r_home)
             if not self.r_home.exists():
-                self.logger.error("%s does not exist." % self.r_home)
-                sys.exit() # Throw system exit if R home isn't found.
+                raise RInstallationError("%s does not exist." % self.r_home)
 
             self.logger.debug("Target Installation:  %s" % str(self.r_home))
             self.logger.debug("Virtual Environment:  %s" % str(self.env_home))
@@ -81,28 +101,31 @@ R environment.
                 self.prompt = '(%s) ' % self.env_name
         else:
             if not self.renv_path.exists():
-                self.logger.error("You have not initialized renv yet.  Please run 'renv init' to continue.")
-                sys.exit()
+                raise RenvNotInitializedError("You have not initialized renv yet.  Please run 'renv init' to continue.")
                     
 
     def initial_setup(self):
         """Initialize the .renv directory structure."""
-        if self.renv_path.exists():
-            self.logger.error("The renv path you have set already exists: %s" % self.renv_path)
-        elif not self.renv_path.exists():
-            self.logger.info("Initializing renv for the first time...")
-            init_cookie = self.cookie_jar / Path("init")
-            e_c = {
-                "renv_init_dir": self.name
-            }
-            cookiecutter(str(init_cookie), no_input=True, extra_context=e_c, output_dir=str(self.path))
+        # Concurrent initializations wait for each other instead of racing to create the root
+        with FileLock(root_lock_file(self.path, self.name)).hold():
+            if self.renv_path.exists():
+                self.logger.error("The renv path you have set already exists: %s" % self.renv_path)
+            elif not self.renv_path.exists():
+                self.logger.info("Initializing renv for the first time...")
+                # cookiecutter is slow to import and is only needed here
+                from cookiecutter.main import cookiecutter
+                init_cookie = self.cookie_jar / Path("init")
+                e_c = {
+                    "renv_init_dir": self.name
+                }
+                cookiecutter(str(init_cookie), no_input=True, extra_context=e_c, output_dir=str(self.path))
             
 
 class LinuxRenvBuilder(BaseRenvBuilder):
 
     def __init__(self, env_name=None, path=None, name=None, r_home=None, bindir=None, libdir=None, mandir=None,
                  rincludedir=None, rdocdir=None, rsharedir=None, infodir=None, recommended_packages=True, clear=False,
-                 upgrade=False, prompt=None, verbose=None):
+                 upgrade=False, prompt=None, verbose=None, config_file=None, first_run=None, relocatable=None):
 
         super().__init__(env_name=env_name, path=path, name=name, r_home=r_home,
                          recommended_packages=recommended_packages, clear=clear, upgrade=upgrade,
@@ -111,17 +134,14 @@ class LinuxRenvBuilder(BaseRenvBuilder):
         #
         # Get installation directories.  These mimic parameters in source installation.  (./configure --help)
         # See https://cran.r-project.org/doc/manuals/R-admin.html#Installation for info on these directories.
-        self.bindir = bindir
+        self.bindir, self.libdir, self.mandir, self.rincludedir, self.rdocdir, self.rsharedir, self.infodir = (
+            Path(d) if d else None for d in (bindir, libdir, mandir, rincludedir, rdocdir, rsharedir, infodir))
+        # The installation directories given explicitly are recorded in the environment's renv.yaml
+        self.r_custom_dirs = {"R_BIN_DIR": bindir and str(bindir), "R_LIB_DIR": libdir and str(libdir)}
         if not self.bindir:
             self.bindir = self.r_home / "bin"
-        self.libdir = libdir
-        self.mandir = mandir
         if not self.mandir:
             self.mandir = self.r_home / "share" / "man"
-        self.rincludedir = rincludedir
-        self.rdocdir = rdocdir
-        self.rsharedir = rsharedir
-        self.infodir = infodir
 
         # Here LIBnn is usually ‘lib’, but may be ‘lib64’ on some 64-bit Linux systems
         # See previous link
@@ -142,7 +162,7 @@ class LinuxRenvBuilder(BaseRenvBuilder):
                 self.libdir = self.r_home / self.libnn
             else:
                 self.libdir = self.r_home / "<libnn>"
-                raise FileNotFoundError("%s does not exist" % self.libdir)
+                raise RInstallationError("%s does not exist" % self.libdir)
         # Initialize path variables in the libdir
         if not self.rincludedir:
             self.rincludedir = self.libdir / "R" / "include"
@@ -156,20 +176,23 @@ class LinuxRenvBuilder(BaseRenvBuilder):
         # Start setting other variables.
         self.rlibrary = self.libdir / "R" / "library"
 
-        # R version
-        major, error = utils.system_r_call(rcmd_type="major", rscript=str(self.bindir / "Rscript"))
-        # Minor Version
-        minor, error = utils.system_r_call(rcmd_type="minor", rscript=str(self.bindir / "Rscript"))
-        major = re.findall('"([^"]*)"', major)
-        minor = re.findall('"([^"]*)"', minor)
-
-        self.r_major_ver = major
-        self.r_minor_ver = minor
-        self.r_version = "%s.%s" % (str(major[0]), str(minor[0]))
+        # Probe the system R once for the version, R_HOME, platform, capabilities, and installed packages
+        # unless this installation has already been probed and cached.
+        rscript = self.bindir / "Rscript"
+        self.r_cache = RInstallCache(self.renv_path / "cache")
+        self.r_info = self.r_cache.get(self.r_home, rscript, self.rlibrary)
+        if not self.r_info:
+            self.r_info = utils.system_r_probe(rscript=str(rscript))
+            self.r_cache.set(self.r_home, rscript, self.rlibrary, self.r_info)
+
+        self.r_major_ver = [self.r_info["major"]]
+        self.r_minor_ver = [self.r_info["minor"]]
+        self.r_version = self.r_info["version"]
         self.logger.debug("The target R version is %s." % self.r_version)
 
         # ****************** Virtual Environment R ****************
         self.usr_cfg_file = self.env_home / "renv.yaml"
+        self.lock_file = self.env_home / "renv.lock"
         self.env_libdir = self.env_home / self.libnn
         self.env_bindir = self.env_home / "bin"
         self.env_mandir = self.env_home / "share" / "man"
@@ -179,64 +202,621 @@ class LinuxRenvBuilder(BaseRenvBuilder):
         self.env_infodir = self.env_home / "info"
         self.env_library = self.env_libdir / "R" / "library"
 
-    def build_venv(self):
-        self.create_env_dirs()
-        self.create_etc_symlink()
-        self.create_library_symlink()
-        self.setup_templates()
-        self.create_r_symlink()
+        # The environment's settings start from its existing renv.yaml (e.g. when upgrading) and the
+        # YAML file given by the user.
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(utils.read_renv_config(self.usr_cfg_file))
+        if self.clear:
+            self.config.pop("PACKAGE_INSTALLS", None)
+        if config_file:
+            self.config.update(utils.read_renv_config(config_file))
+        if first_run:
+            self.config["FIRST_RUN"] = first_run
+        if relocatable is not None:
+            self.config["RELOCATABLE"] = relocatable
+        # Relocatable environments use relative symlinks and resolve their paths when they are activated
+        self.relocatable = bool(self.config.get("RELOCATABLE"))
+        self.cran_mirror = self.config.get("CRAN_MIRROR", self.cran_mirror)
+        self.cranextra_mirror = self.config.get("CRANEXTRA_MIRROR", self.cranextra_mirror)
+
+        # Package files are downloaded once for every environment on the node and their dependencies are
+        # resolved from a local index of the repositories
+        self.downloads = DownloadCache(self.renv_path / "cache" / "downloads")
+        self.index = RepoIndex(self.renv_path / "cache" / "index.sqlite")
+
+        # Packages built for this R are shared between environments through the package store
+        self.store = PackageStore(self.renv_path / "store")
+
+        # Every environment under the .renv root is recorded in the registry
+        self.registry = EnvRegistry(self.renv_path / "registry.sqlite")
+
+        # The directories and symlinks of the environment are planned first and then created in bulk
+        self.plan = FilesystemPlan()
+
+        # New environments are built in a staging directory next to env_home (see staging)
+        self.stage_home = None
+
+        # Processes that change the environment hold its lock exclusively and readers share it
+        self.env_lock = FileLock(env_lock_file(self.renv_path, self.env_name))
+
+    def build_venv(self, first_run_packages=True):
+        requested = time.time()
+        with self.env_lock.hold():
+            if self.upgrade and self.env_home.exists():
+                return self.upgrade_venv()
+            if self.built_since(requested):
+                self.logger.info("%s was built with the same settings by another renv process." % self.env_name)
+                return str(self.env_bindir)
+            return self._build_venv(first_run_packages)
+
+    def _build_venv(self, first_run_packages):
+        self.timings = OrderedDict()
+        phases = [self.create_env_dirs, self.create_etc_symlink, self.create_library_symlink, self.materialize,
+                  self.setup_templates, self.create_r_symlink, self.write_config]
+        if first_run_packages:
+            phases.append(self.install_first_run_packages)
+        phases.extend([self.commit_venv, self.register_venv])
+        with self.staging():
+            for phase in phases:
+                start = time.perf_counter()
+                with tracer.span(phase.__name__, env_name=self.env_name):
+                    phase()
+                self.timings[phase.__name__] = time.perf_counter() - start
+        self.logger.debug("Build timings: %s" % ", ".join("%s=%.4fs" % (phase, seconds)
+                                                          for phase, seconds in self.timings.items()))
+        self.logger.info("%s has been created." % self.env_name)
+        return str(self.env_bindir)
+
+    def built_since(self, requested):
+        """
+        Check whether another process built the environment with the same settings as this builder
+        after a build was requested, so that the build can reuse it.
+        :param requested:  The time the build was requested.
+        :return:  Returns True if the environment can be reused.
+        """
+        entry = self.registry.get(self.env_name)
+        if not entry or entry["created"] < requested or not self.usr_cfg_file.is_file():
+            return False
+        config = utils.read_renv_config(self.usr_cfg_file)
+        spec = {"R_ABS_HOME": str(self.r_home), "R_VERSION": self.r_version,
+                "RECOMMENDED_PACKAGES": self.recommended_packages, "CRAN_MIRROR": self.cran_mirror,
+                "CRANEXTRA_MIRROR": self.cranextra_mirror, "FIRST_RUN": self.config.get("FIRST_RUN"),
+                "RELOCATABLE": self.relocatable, "PROMPT": self.prompt}
+        spec.update(self.r_custom_dirs)
+        spec.update((k, v) for k, v in self.config.items() if "PKG_LIST" in k)
+        return all(config.get(k) == v for k, v in spec.items())
+
+    def upgrade_venv(self, workers=4):
+        """
+        Upgrade an existing environment to this R installation in place.  Only the symlinks that
+        differ from a fresh build are added, retargeted, or removed, and the templated files are
+        rendered again.  The user library is kept, and only the packages that were built for another
+        major.minor version of R are reinstalled.
+        :param workers:  The number of R processes that reinstall packages at the same time.
+        :return:  Returns the path to the environment's bin directory.
+        """
+        with self.env_lock.hold():
+            return self._upgrade_venv(workers)
+
+    def _upgrade_venv(self, workers):
+        env_library = utils.get_env_library(self.env_home)
+        if env_library and Path(env_library) != self.env_library:
+            raise EnvUpgradeError("%s uses a different lib directory than %s. Remove using --clear." %
+                                  (self.env_home, self.libdir))
+        old_config = utils.read_renv_config(self.usr_cfg_file)
+        old_r_home = old_config.get("R_ABS_HOME")
+        self.logger.info("Upgrading %s from R %s to R %s..." %
+                         (self.env_name, old_config.get("R_VERSION"), self.r_version))
+
+        with tracer.span("upgrade_venv", env_name=self.env_name):
+            # Plan a fresh build and apply only the differences
+            self._plan_env_dirs()
+            self.create_etc_symlink()
+            self.create_library_symlink()
+            for suffix in ("R", "Rscript"):
+                self.link(self.bindir / suffix, self.env_bindir / suffix)
+            # Stale links point into either R installation or nowhere; links to the package store are kept
+            sys_dirs = [str(r_home).rstrip(sep) + sep for r_home in (self.r_home, old_r_home) if r_home]
+
+            def stale(link):
+                return not Path(link).exists() or utils.link_target(link).startswith(tuple(sys_dirs))
+
+            changes = self.plan.sync(removable=stale)
+            self.setup_templates()
+            self.write_config()
+            self.rebuild_packages(workers=workers)
+            self.register_venv(new=False)
+        self.logger.info("%s has been upgraded (%s)." %
+                         (self.env_name, ", ".join("%s %s" % (n, change) for change, n in changes.items())))
+        return str(self.env_bindir)
+
+    def rebuild_packages(self, workers=4):
+        """
+        Reinstall the packages in the user library that were built for another major.minor version of R.
+        Packages that can't be reinstalled are restored.
+        :param workers:  The number of R processes that install packages at the same time.
+        :return:  Returns a list of the reinstalled packages.
+        """
+        r_minor = utils.r_minor_version(self.r_version)
+        stale = []
+        for pkg in sorted(listdir(str(self.env_library))):
+            pkg_dir = self.env_library / pkg
+            if pkg_dir.is_symlink() or pkg.startswith("."):
+                continue
+            built = utils.r_minor_version(utils.read_description(pkg_dir).get("Built"))
+            if built and built != r_minor:
+                stale.append(pkg)
+        if not stale:
+            return []
+
+        self.logger.info("Reinstalling %s packages built for another version of R..." % len(stale))
+        for pkg in stale:
+            (self.env_library / pkg).rename(self.env_library / (".%s.old" % pkg))
+        results = self.install_packages(pkgs=stale, workers=workers)
+        for pkg in stale:
+            old_dir = self.env_library / (".%s.old" % pkg)
+            if (self.env_library / pkg).exists():
+                shutil.rmtree(str(old_dir))
+            else:
+                self.logger.error("%s could not be reinstalled and was restored." % pkg)
+                old_dir.rename(self.env_library / pkg)
+        return [pkg for pkg in stale if results.get(pkg, {}).get("status") in ("installed", "linked")]
+
+    def clone_venv(self, src_env_home):
+        """
+        Create this environment from an existing environment for the same R installation.  The
+        source's directories and symlinks are reused, its installed packages are hardlinked, and
+        only the path dependent files are rendered again.
+        :param src_env_home:  The path to the source environment.
+        :return:  Returns the path to the environment's bin directory.
+        """
+        src_env_home = Path(src_env_home)
+        src_lock_file = env_lock_file(self.renv_path, src_env_home.name)
+        if src_lock_file == self.env_lock.lock_file:
+            # The source's shared lock would wait for this environment's exclusive lock forever
+            raise EnvExistsError("%s already exists." % self.env_home)
+        src_lock = FileLock(src_lock_file)
+        with self.env_lock.hold(), src_lock.hold(shared=True):
+            return self._clone_venv(src_env_home)
+
+    def _clone_venv(self, src_env_home):
+        if self.env_home.exists():
+            raise EnvExistsError("%s already exists." % self.env_home)
+        self.logger.info("Cloning %s into %s" % (src_env_home, self.env_home))
+        with tracer.span("clone_venv", env_name=self.env_name, src=str(src_env_home)), self.staging():
+            self._clone_tree(src_env_home)
+            self.commit_venv()
+            self.register_venv()
         self.logger.info("%s has been created." % self.env_name)
         return str(self.env_bindir)
 
+    def _clone_tree(self, src_env_home):
+        rendered = set(str(path.relative_to(self.env_home)) for path in self.template_paths().values())
+        rendered.add(str(self.usr_cfg_file.relative_to(self.env_home)))
+        files = []
+        for root, dirs, filenames in walk(str(src_env_home)):
+            rel_root = Path(root).relative_to(src_env_home)
+            self.plan.mkdir(self.stage_path(self.env_home / rel_root))
+            for name in dirs + filenames:
+                src_path = Path(root) / name
+                rel_path = rel_root / name
+                if src_path.is_symlink():
+                    target = Path(readlink(str(src_path)))
+                    # Links into the source environment are retargeted to the clone.  Relative links are kept.
+                    if target.is_absolute():
+                        if src_env_home in target.parents:
+                            target = self.env_home / target.relative_to(src_env_home)
+                        self.link(target, self.env_home / rel_path)
+                    else:
+                        self.plan.symlink(target, self.stage_path(self.env_home / rel_path))
+                elif name in filenames and str(rel_path) not in rendered:
+                    files.append((src_path, self.stage_path(self.env_home / rel_path)))
+        self.materialize()
+        for src_file, dst_file in files:
+            link_file(src_file, dst_file)
+        self.logger.debug("Linked %s files." % len(files))
+
+        self.setup_templates()
+        self.write_config(base_config=utils.read_renv_config(src_env_home / "renv.yaml"))
+
+    def install_packages(self, pkgs=None, workers=4, retries=2, versions=None):
+        """
+        Install packages into the environment non-interactively.  Independent packages are
+        installed concurrently and the results are recorded in the environment's renv.yaml.
+        :param pkgs:  A list of package names.  The renv.yaml package lists are used by default.
+        :param workers:  The number of R processes that install packages at the same time.
+        :param retries:  The number of times a failed package installation is retried.
+        :param versions:  A dictionary of package names to the versions that must be installed.
+        :return:  Returns a dictionary with the status, version, attempts, and seconds of each package.
+        """
+        with self.env_lock.hold():
+            return self._install_packages(pkgs, workers, retries, versions)
+
+    def _install_packages(self, pkgs, workers, retries, versions):
+        cfg_file = self.stage_path(self.usr_cfg_file)
+        config = utils.read_renv_config(cfg_file) or dict(self.config)
+        if pkgs is None:
+            pkgs = utils.get_pkg_names(config)
+        repos = [config.get("CRAN_MIRROR", self.cran_mirror), config.get("CRANEXTRA_MIRROR", self.cranextra_mirror)]
+        installer = PackageInstaller(rscript=self.bindir / "Rscript", library=self.stage_path(self.env_library),
+                                     repos=repos,
+                                     r_minor=utils.r_minor_version(self.r_version), store=self.store,
+                                     index=self.index, downloads=self.downloads, workers=workers, retries=retries)
+        with tracer.span("install_packages", env_name=self.env_name):
+            # Only the packages linked into the environment library count as installed.  The environment's R
+            # doesn't see the rest of the system library (e.g. recommended packages that weren't linked).
+            results = installer.install(pkgs, versions=versions)
+
+        package_installs = config.get("PACKAGE_INSTALLS") or {}
+        package_installs.update(results)
+        config["PACKAGE_INSTALLS"] = package_installs
+        utils.write_renv_config(cfg_file, config)
+        if self.stage_home is None and self.env_home.exists() and self.registry.get(self.env_name):
+            self.register_venv(new=False)
+        return results
+
+    def install_first_run_packages(self):
+        """
+        Install the renv.yaml package lists ahead of time when FIRST_RUN is declarative, so that the
+        environment's R sessions start without any prompts or downloads.  The .Rprofile doesn't prompt
+        for the lists, so the build fails if any package can't be installed.
+        :raises PackageInstallError:  Raised when a package is unavailable or fails to install.
+        """
+        if self.config.get("FIRST_RUN") != "declarative":
+            return
+        self.logger.info("Installing the renv.yaml package lists...")
+        results = self.install_packages()
+        failed = sorted("%s (%s)" % (pkg, result["status"]) for pkg, result in results.items()
+                        if result["status"] not in ("installed", "linked"))
+        if failed:
+            message = "The renv.yaml package lists could not be installed: %s." % ", ".join(failed)
+            if results.get("BiocInstaller", {}).get("status") == "unavailable":
+                message += (" BiocInstaller is installed from Bioconductor, not CRAN.  Set CRANEXTRA_MIRROR to a "
+                            "Bioconductor repository or remove it from STANDARD_PKG_LIST.")
+            raise PackageInstallError(message)
+
+    def lock_venv(self, workers=8):
+        """
+        Record the exact packages in the environment's library in its renv.lock file.  Each package
+        is recorded with its version, source, store build hash, and a hash of its installed files.
+        Packages linked from the system R are only recorded with their version.
+        :param workers:  The number of packages that are hashed at the same time.
+        :return:  Returns the lock dictionary.
+        """
+        with self.env_lock.hold(shared=True):
+            return self._lock_venv(workers)
+
+    def _lock_venv(self, workers):
+        lock_pkgs = {}
+        user_pkgs = []
+        for pkg in sorted(listdir(str(self.env_library))):
+            pkg_dir = self.env_library / pkg
+            if pkg.startswith(".") or not (pkg_dir / "DESCRIPTION").is_file():
+                continue
+            if pkg_dir.is_symlink() and pkg in self.r_info["packages"] and \
+                    Path(utils.link_target(pkg_dir)) == self.rlibrary / pkg:
+                lock_pkgs[pkg] = {"Version": self.r_info["packages"][pkg]["version"], "Source": "R"}
+            else:
+                user_pkgs.append(pkg)
+
+        def lock_pkg(pkg):
+            pkg_dir = self.env_library / pkg
+            desc = utils.read_description(pkg_dir)
+            key = self.store.key(pkg_dir)
+            return {"Version": desc.get("Version"), "Source": desc.get("Repository") or desc.get("RemoteType") or
+                    "local", "Build": key[3] if key else None, "Hash": tree_hash(pkg_dir)}
+
+        with tracer.span("lock_venv", env_name=self.env_name):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                lock_pkgs.update(zip(user_pkgs, pool.map(lock_pkg, user_pkgs)))
+        lock = {"R": {"Version": self.r_version, "Home": str(self.r_home), "BinDir": self.r_custom_dirs["R_BIN_DIR"],
+                      "LibDir": self.r_custom_dirs["R_LIB_DIR"], "RecommendedPackages": self.recommended_packages,
+                      "Repositories": [self.cran_mirror, self.cranextra_mirror]},
+                "Packages": lock_pkgs}
+        utils.write_lockfile(self.lock_file, lock)
+        self.logger.info("Locked %s packages in %s" % (len(lock_pkgs), self.lock_file))
+        return lock
+
+    def restore_venv(self, lock, workers=4, clean=False):
+        """
+        Recreate the environment's library from a lock dictionary.  The environment is built first if
+        it doesn't exist.  Locked packages are linked from the package store in parallel after their
+        hashes are verified, so only the packages that aren't stored for this R are built (at their
+        locked versions) and added to the store.
+        :param lock:  The lock dictionary (see lock_venv).
+        :param workers:  The number of packages that are verified or built at the same time.
+        :param clean:  Remove the packages that aren't in the lock from the library.
+        :return:  Returns a dictionary with the status and version of each locked package.
+        """
+        with self.env_lock.hold():
+            return self._restore_venv(lock, workers, clean)
+
+    def _restore_venv(self, lock, workers, clean):
+        if not self.env_home.exists():
+            repos = lock["R"].get("Repositories") or [self.cran_mirror, self.cranextra_mirror]
+            self.cran_mirror, self.cranextra_mirror = (repos * 2)[:2]
+            self.build_venv(first_run_packages=False)
+        r_minor = utils.r_minor_version(self.r_version)
+        if utils.r_minor_version(lock["R"]["Version"]) != r_minor:
+            self.logger.warning("The lock is for R %s, so its packages will be built for R %s." %
+                                (lock["R"]["Version"], self.r_version))
+
+        results = {}
+        locked = {}
+        for pkg, entry in lock["Packages"].items():
+            if entry["Source"] != "R":
+                locked[pkg] = entry
+            elif self.r_info["packages"].get(pkg, {}).get("version") != entry["Version"]:
+                results[pkg] = {"status": "mismatch", "version": entry["Version"]}
+                self.logger.warning("%s %s is locked but R has %s." %
+                                    (pkg, entry["Version"], self.r_info["packages"].get(pkg, {}).get("version")))
+
+        def restore_pkg(pkg):
+            entry = locked[pkg]
+            pkg_dir = self.env_library / pkg
+            if pkg_dir.exists():
+                if tree_hash(pkg_dir) == entry["Hash"]:
+                    return "kept"
+                pkg_dir.rename(self.env_library / (".%s.old" % pkg))
+            stored = self.store.entry_path((pkg, entry["Version"], r_minor, entry.get("Build")))
+            if entry.get("Build") and stored.is_dir():
+                if tree_hash(stored) == entry["Hash"]:
+                    self.store.link(stored, self.env_library)
+                    return "linked"
+                self.logger.warning("%s in the package store does not match the lock and will be rebuilt." % stored)
+                # Remove the entry so that the rebuilt package replaces it instead of being linked to it
+                shutil.rmtree(str(stored.parent), ignore_errors=True)
+            return "missing"
+
+        with tracer.span("restore_venv", env_name=self.env_name):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                statuses = dict(zip(locked, pool.map(restore_pkg, locked)))
+            missing = [pkg for pkg, status in statuses.items() if status == "missing"]
+            if missing:
+                self.logger.info("Building %s packages that are not in the package store..." % len(missing))
+                installed = self.install_packages(pkgs=missing, workers=workers,
+                                                  versions={pkg: locked[pkg]["Version"] for pkg in missing})
+                for pkg in missing:
+                    if (self.env_library / pkg).is_dir():
+                        # The installer added the package to the store
+                        statuses[pkg] = "built"
+                    else:
+                        statuses[pkg] = installed.get(pkg, {}).get("status", "failed")
+
+        for pkg, status in statuses.items():
+            old_dir = self.env_library / (".%s.old" % pkg)
+            if old_dir.exists():
+                if (self.env_library / pkg).exists():
+                    shutil.rmtree(str(old_dir))
+                else:
+                    old_dir.rename(self.env_library / pkg)
+            version = utils.read_description(self.env_library / pkg).get("Version")
+            if status == "built" and version != locked[pkg]["Version"]:
+                status = "mismatch"
+                self.logger.warning("%s %s is locked but %s was built." % (pkg, locked[pkg]["Version"], version))
+            results[pkg] = {"status": status, "version": version}
+
+        if clean:
+            for pkg in sorted(listdir(str(self.env_library))):
+                if pkg not in lock["Packages"] and not pkg.startswith("."):
+                    self.logger.info("Removing %s, which is not in the lock." % pkg)
+                    if (self.env_library / pkg).is_symlink():
+                        (self.env_library / pkg).unlink()
+                    else:
+                        shutil.rmtree(str(self.env_library / pkg))
+        self.register_venv(new=False)
+        return results
+
+    def unpack_venv(self, extract):
+        """
+        Create this environment from a packed environment (see renv.pack), e.g. on another node or
+        under another prefix.  The environment is extracted into a staging directory, the symlinks
+        into its old location are retargeted, and the path dependent files are rendered again.
+        :param extract:  A function that extracts the packed environment into a directory.
+        :return:  Returns the path to the environment's bin directory.
+        """
+        with self.env_lock.hold():
+            if self.env_home.exists() and not self.clear:
+                raise EnvExistsError("%s already exists. Remove using --clear." % self.env_home)
+            with tracer.span("unpack_venv", env_name=self.env_name), self.staging():
+                extract(self.stage_home)
+                packed_config = utils.read_renv_config(self.stage_path(self.usr_cfg_file))
+                self.relocate_links(packed_config.get("R_ENV_HOME"))
+                self.setup_templates()
+                self.write_config(base_config=packed_config)
+                self.commit_venv()
+                self.register_venv()
+        self.logger.info("%s has been unpacked." % self.env_name)
+        return str(self.env_bindir)
+
+    def relocate_links(self, old_env_home):
+        """
+        Retarget the absolute symlinks into the environment's old location to its new location.  The
+        symlinks of relocatable environments are made relative again.
+        :param old_env_home:  The path the environment was built at.
+        :return:  Returns the number of retargeted symlinks.
+        """
+        old_env_home = Path(old_env_home or self.env_home)
+        build_home = self.stage_path(self.env_home)
+        retargeted = 0
+        for root, dirs, files in walk(str(build_home)):
+            for name in dirs + files:
+                link = Path(root) / name
+                if not link.is_symlink():
+                    continue
+                target = Path(readlink(str(link)))
+                if not target.is_absolute():
+                    continue
+                if old_env_home in target.parents:
+                    target = self.env_home / target.relative_to(old_env_home)
+                new_target = self.link_target(target, self.env_home / link.relative_to(build_home))
+                if str(new_target) != readlink(str(link)):
+                    link.unlink()
+                    link.symlink_to(new_target)
+                    retargeted += 1
+        self.logger.debug("Retargeted %s symlinks from %s." % (retargeted, old_env_home))
+        return retargeted
+
+    def register_venv(self, new=True):
+        """
+        Record the environment's R installation, package count, and disk usage in the registry.
+        :param new:  The environment was (re)created, which resets its creation time.
+        """
+        self.registry.register(self.env_name, self.env_home, self.r_version, self.r_home,
+                               count_packages(self.env_library), utils.disk_usage(self.env_home), new=new)
+
+    def remove_venv(self):
+        """Delete the environment and remove it from the registry."""
+        with self.env_lock.hold():
+            if self.env_home.exists():
+                shutil.rmtree(str(self.env_home))
+            self.registry.remove(self.env_name)
+        self.logger.info("%s has been removed." % self.env_name)
+
+    @contextmanager
+    def staging(self):
+        """
+        Build a new environment in a staging directory next to env_home (.<env_name>~<host>~<pid>.staging)
+        that commit_venv renames into place, so a failed build never leaves a half built environment
+        behind.  The staging directory is removed if the build fails, and the stale staging directories
+        of crashed builds are removed first.
+        """
+        self.remove_stale_staging()
+        self.stage_home = self._stage_name("staging")
+        try:
+            yield self.stage_home
+        finally:
+            if self.stage_home is not None and self.stage_home.exists():
+                self.logger.debug("Removing the staging directory %s" % self.stage_home)
+                shutil.rmtree(str(self.stage_home))
+            self.stage_home = None
+
+    def stage_path(self, path):
+        """
+        Get the path that a path in the environment is written to while the environment is staged.
+        :param path:  A path in env_home.
+        :return:  Returns the path in the staging directory, or the path itself when nothing is staged.
+        """
+        if self.stage_home is None:
+            return path
+        return self.stage_home / Path(path).relative_to(self.env_home)
+
+    def commit_venv(self):
+        """
+        Rename the staging directory into place.  With clear, the existing environment is swapped out
+        first and deleted afterwards.
+        """
+        old_home = None
+        if self.clear and self.env_home.exists():
+            old_home = self._stage_name("old")
+            rename(str(self.env_home), str(old_home))
+        try:
+            rename(str(self.stage_home), str(self.env_home))
+        except OSError:
+            if old_home:
+                rename(str(old_home), str(self.env_home))
+            if self.env_home.exists():
+                # Another build of the same environment finished first
+                raise EnvExistsError("%s already exists. Remove using --clear or upgrade using --upgrade." %
+                                     self.env_home)
+            raise
+        self.stage_home = None
+        if old_home:
+            shutil.rmtree(str(old_home))
+            self.logger.debug("%s has been deleted." % old_home)
+        self.logger.debug("Moved the staged environment to %s" % self.env_home)
+
+    def remove_stale_staging(self):
+        """
+        Remove the staging directories of this environment's builds that crashed.  A staging directory
+        is stale when its build process on this host is gone (or is this process) or, for other hosts,
+        when it is older than STALE_STAGING_AGE.
+        """
+        envs_dir = self.env_home.parent
+        if not envs_dir.is_dir():
+            return
+        host = socket.gethostname()
+        for name in listdir(str(envs_dir)):
+            if not name.startswith(".") or not name.endswith((".staging", ".old")):
+                continue
+            fields = name[1:].rsplit(".", 1)[0].rsplit("~", 2)
+            if len(fields) != 3 or fields[0] != self.env_name or not fields[2].isdigit():
+                continue
+            if fields[1] == host:
+                # This process holds the environment's lock, so a directory with its pid is left over
+                # from an earlier process with the same pid (e.g. in a container)
+                pid = int(fields[2])
+                stale = pid == getpid() or not _pid_alive(pid)
+            else:
+                stale = time.time() - (envs_dir / name).lstat().st_mtime > STALE_STAGING_AGE
+            if stale:
+                self.logger.info("Removing the staging directory %s of a failed build." % (envs_dir / name))
+                shutil.rmtree(str(envs_dir / name), ignore_errors=True)
+
+    def _stage_name(self, suffix):
+        return self.env_home.with_name(".%s~%s~%s.%s" % (self.env_name, socket.gethostname(), getpid(), suffix))
+
     def create_env_dirs(self):
-        # Delete the environment if clear is True.
-        if self.clear:
-            shutil.rmtree(self.env_home)
+        if self.env_home.exists() and not self.clear:
+            raise EnvExistsError("%s already exists. Remove using --clear or upgrade using --upgrade." % self.env_home)
+        # Delete the environment if clear is True and the build isn't staged.  Staged builds replace it.
+        if self.clear and self.stage_home is None and self.env_home.exists():
+            shutil.rmtree(str(self.env_home))
             self.logger.debug("%s has been deleted." % self.env_home)
 
         # create directories
-        if not self.env_home.exists():
-            self.env_home.mkdir()
-            self.logger.info("Environment home created at %s" % str(self.env_home))
-        elif self.env_home.exists():
-            self.logger.error("%s already exists. Remove using --clear." % self.env_home)
-            sys.exit()
-        
+        build_home = self.stage_path(self.env_home)
+        build_home.mkdir()
+        self.logger.info("Environment home created at %s" % str(build_home))
+
         self.logger.info("Creating environment home subdirectories...")
+        self._plan_env_dirs()
+
+    def _plan_env_dirs(self):
         env_lib_home = self.env_libdir / "R"
         sys_lib_home = self.libdir / "R"
         
-        env_lib_home.mkdir(parents=True)  # make home and env_libdir
-        self.logger.debug(str(env_lib_home))
-        Path(env_lib_home / "etc").mkdir()
-        self.logger.debug(str(env_lib_home / "etc"))
-        Path(env_lib_home / "library").mkdir()
-        self.logger.debug(str(env_lib_home / "library"))
+        self.plan.mkdir(self.stage_path(env_lib_home))  # make home and env_libdir
+        self.plan.mkdir(self.stage_path(env_lib_home / "etc"))
+        self.plan.mkdir(self.stage_path(env_lib_home / "library"))
+        self.plan.mkdir(self.stage_path(self.env_bindir))
 
         # create directory system links
-        Path(env_lib_home / "bin").symlink_to(sys_lib_home / "bin")
-        self.logger.debug(str(env_lib_home / "bin"))
-        Path(env_lib_home / "modules").symlink_to(sys_lib_home / "modules")
-        self.logger.debug(str(env_lib_home / "modules"))
-        Path(env_lib_home / "lib").symlink_to(sys_lib_home / "lib")
-        self.logger.debug(str(env_lib_home / "lib"))
-        self.env_includedir.symlink_to(self.rincludedir)
-        self.logger.debug(str(self.env_includedir))
-        self.env_docdir.symlink_to(self.rdocdir)
-        self.logger.debug(str(self.env_docdir))
-        self.env_sharedir.symlink_to(self.rsharedir)
-        self.logger.debug(str(self.env_sharedir))
+        self.link(sys_lib_home / "bin", env_lib_home / "bin")
+        self.link(sys_lib_home / "modules", env_lib_home / "modules")
+        self.link(sys_lib_home / "lib", env_lib_home / "lib")
+        self.link(self.rincludedir, self.env_includedir)
+        self.link(self.rdocdir, self.env_docdir)
+        self.link(self.rsharedir, self.env_sharedir)
 
         if Path(sys_lib_home / "tests").exists():
-            Path(env_lib_home / "tests").symlink_to(sys_lib_home / "tests")
-            self.logger.debug(str(env_lib_home / "tests"))
+            self.link(sys_lib_home / "tests", env_lib_home / "tests")
         if Path(self.mandir / "man1").exists():
-            self.env_mandir.mkdir(parents=True)
-            Path(self.env_mandir / "man1").symlink_to(self.mandir / "man1")
-            self.logger.debug(str(self.env_mandir))
+            self.plan.mkdir(self.stage_path(self.env_mandir))
+            self.link(self.mandir / "man1", self.env_mandir / "man1")
         if self.infodir.exists():
-            self.env_infodir.symlink_to(self.infodir)
-            self.logger.debug(str(self.env_infodir))
+            self.link(self.infodir, self.env_infodir)
+
+    def link(self, target, link):
+        """
+        Plan a symlink in the environment.
+        :param target:  The absolute path the symlink points to.
+        :param link:  The final path of the symlink in env_home (it is staged while the environment is built).
+        """
+        self.plan.symlink(self.link_target(target, link), self.stage_path(link))
+
+    def link_target(self, target, link):
+        """
+        Get the target of a symlink in the environment.  Relocatable environments link to the paths
+        under the renv installation path (e.g. the environment itself or an R installed next to it)
+        with relative symlinks, so the tree can be moved as a whole.
+        :param target:  The absolute path the symlink points to.
+        :param link:  The final path of the symlink in env_home.
+        :return:  Returns the target to use for the symlink.
+        """
+        if self.relocatable and self.path in Path(target).parents:
+            return utils.relative_link(target, link)
+        return target
 
     def create_etc_symlink(self):
         env_lib_home = self.env_libdir / "R"
@@ -244,66 +824,129 @@ class LinuxRenvBuilder(BaseRenvBuilder):
         # create system link files
         etc_files = listdir(str(Path(sys_lib_home / "etc")))
         for file in etc_files:
-            if file != "Rprofile.site" or file != "Renviron.site":
-                Path(env_lib_home / "etc" / file).symlink_to(sys_lib_home / "etc" / file)
-                self.logger.debug(str(env_lib_home / "etc" / file))
+            # The site files are templated for the environment
+            if file not in ("Rprofile.site", "Renviron.site"):
+                self.link(sys_lib_home / "etc" / file, env_lib_home / "etc" / file)
 
     def create_library_symlink(self):
         # Get base packages from system R
-        base_pkgs, error = utils.system_r_call(rcmd_type="base", rscript=str(self.bindir / "Rscript"))
-        base_pkgs = base_pkgs.split(" ")
+        base_pkgs = utils.r_packages_by_priority(self.r_info, "base")
         self.logger.debug("Using base packages...")
         # Get recommended packages from system R
         if self.recommended_packages:
-            recommended_pkgs, error = utils.system_r_call(rcmd_type="recommended", rscript=str(self.bindir / "Rscript"))
-            recommended_pkgs = recommended_pkgs.split(" ")
+            recommended_pkgs = utils.r_packages_by_priority(self.r_info, "recommended")
             self.logger.debug("Using recommended packages...")
             pkgs = set(base_pkgs + recommended_pkgs)
         else:
             pkgs = set(base_pkgs)
         # symlink the packages to the environment
         for pkg in pkgs:
-            self.logger.debug("Creating symlink for %s" % str(pkg))
-            pkg_path = self.rlibrary / pkg
-            env_pkg_path = self.env_library / pkg
-            env_pkg_path.symlink_to(pkg_path)
+            self.link(self.rlibrary / pkg, self.env_library / pkg)
+        self.logger.debug("Planned symlinks for %s packages." % len(pkgs))
+
+    def materialize(self):
+        """Create the planned environment directories and symlinks."""
+        self.logger.debug("Materializing %s planned filesystem entries..." % len(self.plan))
+        self.plan.apply()
+
+    def template_paths(self):
+        """
+        Get the final paths of the templated files.
+        :return:  Returns a dictionary of template file names to paths.
+        """
+        templates = get_templates(self.cookie_jar / 'posix')
+        site_dir = self.env_libdir / "R" / "etc"
+        # The site files belong in R's etc directory
+        return {filename: (site_dir if filename in ("Rprofile.site", "Renviron.site") else self.env_bindir) / filename
+                for filename in templates.templates}
 
     def setup_templates(self):
         self.logger.debug("Creating templated files...")
         activator_cookie = self.cookie_jar / 'posix'
+        env_path = self.env_path
         e_c = {
-            "dirname": "bin",
-            "__R_HOME__": str(self.env_libdir / "R"),
-            "__VENV_DIR__": str(self.env_home),
+            "__R_HOME__": env_path(self.env_libdir / "R"),
+            "__VENV_DIR__": env_path(self.env_home),
             "__VENV_NAME__": self.env_name,
             "__VENV_PROMPT__": self.prompt,
             "__VENV_BIN_NAME__": "bin",  # Why???
-            "__VENV_R__": str(self.env_bindir / "R"),
-            "__VENV_RSCRIPT__": str(self.env_bindir / "Rscript"),
-            "__VENV_R_PROFILE__": str(self.env_libdir / "R" / "etc" / "Rprofile.site"),
-            "__VENV_R_ENVIRON__": str(self.env_libdir / "R" / "etc" / "Renviron.site"),
+            "__VENV_R__": env_path(self.env_bindir / "R"),
+            "__VENV_RSCRIPT__": env_path(self.env_bindir / "Rscript"),
+            "__VENV_R_PROFILE__": env_path(self.env_libdir / "R" / "etc" / "Rprofile.site"),
+            "__VENV_R_ENVIRON__": env_path(self.env_libdir / "R" / "etc" / "Renviron.site"),
             "__R_VERSION__": self.r_version,
             "__CRAN_MIRROR__": self.cran_mirror,
             "__CRANEXTRA_MIRROR__": self.cranextra_mirror,
-            "__R_LIBS_USER__": str(self.env_library),
-            "__R_LIBS_SITE__": str(self.env_library),
-            "__R_INCLUDE_DIR__": str(self.env_includedir),
-            "__R_DOC_DIR__": str(self.env_docdir),
-            "__R_SHARE_DIR__": str(self.env_sharedir)
+            "__R_LIBS_USER__": env_path(self.env_library),
+            "__R_LIBS_SITE__": env_path(self.env_library),
+            "__R_LIBS_SITE_R__": json.dumps(str(self.env_library)),
+            "__R_INCLUDE_DIR__": env_path(self.env_includedir),
+            "__R_DOC_DIR__": env_path(self.env_docdir),
+            "__R_SHARE_DIR__": env_path(self.env_sharedir)
         }
-        cookiecutter(str(activator_cookie), no_input=True, extra_context=e_c, output_dir=self.env_home)
-        shutil.move(str(self.env_bindir / "Rprofile.site"), str(self.env_libdir / "R" / "etc"))
-        shutil.move(str(self.env_bindir / "Renviron.site"), str(self.env_libdir / "R" / "etc"))
+        overrides = None
+        if self.relocatable:
+            # R reads the library path from the environment, and the shell activators find the
+            # environment from their own location.  activate falls back to the build path in shells
+            # other than bash and zsh, and csh can't, so they are rendered again by renv unpack.
+            e_c["__R_LIBS_SITE_R__"] = 'Sys.getenv("R_LIBS_SITE")'
+            overrides = {
+                "activate": {"__VENV_DIR__": str(self.env_home), "__VENV_RELOCATABLE__": "1"},
+                "activate.fish": {"__VENV_DIR__": '"(dirname (dirname (realpath (status -f))))"'},
+                "activate.csh": {"__VENV_DIR__": str(self.env_home)},
+            }
+        # The .Rprofile only prompts for the package lists on the first run when they aren't declarative
+        pkg_lists = {k: v for k, v in self.config.items() if "PKG_LIST" in k}
+        if self.config.get("FIRST_RUN") == "declarative":
+            pkg_lists = {k: {} for k in pkg_lists}
+        e_c.update(("__%s__" % k, v) for k, v in utils.format_pkg_list(pkg_lists).items())
+        # Render the templates straight to their final paths
+        templates = get_templates(activator_cookie)
+        templates.write(e_c, {filename: self.stage_path(path) for filename, path in self.template_paths().items()},
+                        overrides=overrides)
+
+    def env_path(self, path):
+        """
+        Get a path in the environment for the templated files.  Relocatable environments refer to
+        their own paths with ${VIRTUAL_ENV}, which is set when the environment is activated.
+        :param path:  A path in env_home.
+        :return:  Returns the path as a string.
+        """
+        if not self.relocatable:
+            return str(path)
+        rel_path = Path(path).relative_to(self.env_home)
+        return "${VIRTUAL_ENV}" if rel_path == Path(".") else "${VIRTUAL_ENV}/%s" % rel_path
+
+    def write_config(self, base_config=None):
+        """
+        Write the environment's renv.yaml configuration file.
+        :param base_config:  A configuration dictionary to update (e.g. from a cloned environment).
+        """
+        config = dict(self.config if base_config is None else base_config)
+        config.update({
+            "R_ABS_HOME": str(self.r_home),
+            "R_ENV_HOME": str(self.env_home),
+            "R_LIBS_USER": str(self.env_library),
+            "R_INCLUDE_DIR": str(self.env_includedir),
+            "R_VERSION": self.r_version,
+            "RECOMMENDED_PACKAGES": self.recommended_packages,
+            "CRAN_MIRROR": self.cran_mirror,
+            "CRANEXTRA_MIRROR": self.cranextra_mirror,
+            "RELOCATABLE": self.relocatable,
+            "PROMPT": self.prompt,
+        })
+        config.update(self.r_custom_dirs)
+        utils.write_renv_config(self.stage_path(self.usr_cfg_file), config)
 
     def create_r_symlink(self):
         self.logger.debug("Setting up R executables...")
         # Set up symlinks of r executables
         for suffix in ("R", "Rscript"):
-            env_exe = self.env_bindir / suffix
+            env_exe = self.stage_path(self.env_bindir / suffix)
             sys_exe = self.bindir / suffix
             if not env_exe.exists():
                 if sys_exe.exists():
-                    env_exe.symlink_to(sys_exe)
+                    env_exe.symlink_to(self.link_target(sys_exe, self.env_bindir / suffix))
                     self.logger.debug(suffix)
                 else:
                     self.logger.error("%s does not exist." % str(sys_exe))
@@ -311,6 +954,16 @@ class LinuxRenvBuilder(BaseRenvBuilder):
                 self.logger.error("%s already exists." % env_exe)
 
 
+def _pid_alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
 class MacRenvBuilder(BaseRenvBuilder):
 
     def __init__(self):
@@ -0,0 +1,26 @@
+class RenvError(Exception):
+    """The base class of the errors renv raises."""
+
+
+class RenvNotInitializedError(RenvError):
+    """The .renv root has not been initialized with renv init."""
+
+
+class RInstallationError(RenvError, FileNotFoundError):
+    """The R installation (or one of its directories) does not exist."""
+
+
+class EnvExistsError(RenvError, FileExistsError):
+    """The environment already exists."""
+
+
+class EnvNotFoundError(RenvError, FileNotFoundError):
+    """The environment does not exist or is not an R environment."""
+
+
+class EnvUpgradeError(RenvError):
+    """The environment can't be upgraded in place."""
+
+
+class PackageInstallError(RenvError):
+    """Packages could not be installed into the environment."""
@@ -0,0 +1,370 @@
+import os
+import time
+import shutil
+import logging
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import renv.utils as utils
+from renv.locks import FileLock, env_lock_file
+from renv.profiling import tracer
+from renv.registry import EnvRegistry
+from renv.store import PackageStore, link_tree, tree_hash
+
+# Temporary files and staging directories older than this many seconds were left behind by crashed processes
+_STALE_TMP_AGE = 3600
+
+
+class GarbageCollector(object):
+    """
+The GarbageCollector class accounts for and reclaims the disk space used by
+the .renv root.
+
+The environments (<renv>/cran), the package store, and the download cache are
+walked with a parallel scandir walker that counts every inode once, so shared
+hardlinked files are only charged once.  The collector prunes dangling
+symlinks (e.g. after a system R was removed), hardlinks identical package
+trees that were installed into several environments, removes stale temporary
+files, and evicts the package store entries and downloads that no environment
+uses (least recently used first) until the caches fit in a size budget.
+Environments that are locked by another renv process are left alone.  A
+directory is only an orphan when it isn't registered and doesn't have an
+environment's layout (bin/activate and lib*/R/library), so environments built
+before renv.yaml and the registry existed are kept.
+"""
+
+    def __init__(self, renv_path, workers=8):
+        self.logger = logging.getLogger(__name__)
+        self.renv_path = Path(renv_path)
+        self.envs_dir = self.renv_path / "cran"
+        self.store = PackageStore(self.renv_path / "store")
+        self.downloads_dir = self.renv_path / "cache" / "downloads"
+        self.registry = EnvRegistry(self.renv_path / "registry.sqlite")
+        self.workers = workers
+
+    def env_homes(self):
+        """
+        Get the environment directories.
+        :return:  Returns an ordered dictionary of environment names to paths.
+        """
+        if not self.envs_dir.is_dir():
+            return OrderedDict()
+        return OrderedDict((name, self.envs_dir / name) for name in sorted(os.listdir(str(self.envs_dir)))
+                           if (self.envs_dir / name).is_dir() and not name.startswith("."))
+
+    def usage(self):
+        """
+        Walk the environments, the package store, and the download cache.
+        :return:  Returns a dictionary with the per environment usage (total and shared bytes, dangling
+                  symlinks, and whether the environment is orphaned), the store and cache usage, the
+                  total usage with every inode counted once, and the scan of each tree.
+        """
+        env_homes = self.env_homes()
+        roots = OrderedDict((name, str(env_home)) for name, env_home in env_homes.items())
+        roots[":store"] = str(self.store.store_dir)
+        roots[":cache"] = str(self.downloads_dir)
+        with tracer.span("gc_scan", category="gc"):
+            scans = scan_trees(roots, workers=self.workers)
+
+        # Inodes that are in more than one tree are shared
+        owners = {}
+        for scan in scans.values():
+            for inode in scan["inodes"]:
+                owners[inode] = owners.get(inode, 0) + 1
+        registered = set(entry["name"] for entry in self.registry.list())
+        envs = OrderedDict()
+        for name, env_home in env_homes.items():
+            scan = scans[name]
+            envs[name] = {"env_home": str(env_home), "usage": sum(scan["inodes"].values()),
+                          "shared": sum(size for inode, size in scan["inodes"].items() if owners[inode] > 1),
+                          "dangling": scan["dangling"], "orphaned": name not in registered and not is_env_layout(env_home)}
+        total = {}
+        for scan in scans.values():
+            total.update(scan["inodes"])
+
+        return {"envs": envs, "store": sum(scans[":store"]["inodes"].values()),
+                "cache": sum(scans[":cache"]["inodes"].values()), "total": sum(total.values()), "scans": scans}
+
+    def collect(self, max_cache_size=None, dedupe=True, remove_orphans=False, dry_run=False):
+        """
+        Reclaim disk space in the .renv root.
+        :param max_cache_size:  The bytes the package store and download cache may use.  Unused entries are
+                                evicted (least recently used first) until they fit.  Nothing is evicted by default.
+        :param dedupe:  Hardlink identical packages that are installed in several environments.
+        :param remove_orphans:  Delete the orphaned environment directories (see usage) and their registry
+                               entries.
+        :param dry_run:  Only report what would be reclaimed.
+        :return:  Returns the usage dictionary (see usage) with the pruned symlinks, deduplicated packages,
+                  removed orphans, removed temporary files, evicted entries, and reclaimed bytes.
+        """
+        report = self.usage()
+        report.update({"pruned": [], "deduped": [], "orphans": [], "tmp": [], "evicted": [], "reclaimed": 0})
+        with tracer.span("gc_collect", category="gc", dry_run=dry_run), ExitStack() as locks:
+            for name, env in report["envs"].items():
+                env_lock = FileLock(env_lock_file(self.renv_path, name))
+                env["busy"] = not env_lock.acquire(blocking=False)
+                if env["busy"]:
+                    self.logger.info("%s is in use by another renv process and was skipped." % name)
+                    continue
+                locks.callback(env_lock.release)
+                if env["orphaned"] and remove_orphans:
+                    report["orphans"].append(env["env_home"])
+                    report["reclaimed"] += env["usage"] - env["shared"]
+                    if not dry_run:
+                        shutil.rmtree(env["env_home"])
+                        self.registry.remove(name)
+                    continue
+                for link in env["dangling"]:
+                    report["pruned"].append(link)
+                    if not dry_run:
+                        os.unlink(link)
+            if dedupe:
+                report["reclaimed"] += self.dedupe(report, dry_run=dry_run)
+            report["reclaimed"] += self.remove_tmp(report, dry_run=dry_run)
+            if max_cache_size is not None:
+                report["reclaimed"] += self.evict(report, max_cache_size, dry_run=dry_run)
+
+        return report
+
+    def dedupe(self, report, dry_run=False):
+        """
+        Replace the copies of identical installed packages with hardlinks to a single copy.  Packages
+        are grouped by their package store key and only linked when their tree hashes match.  The copy
+        in the package store is preferred when there is one.
+        :param report:  The report from usage, which is updated with the deduplicated packages.
+        :param dry_run:  Only report what would be deduplicated.
+        :return:  Returns the number of bytes reclaimed.
+        """
+        groups = OrderedDict()
+        for name, env in report["envs"].items():
+            library = utils.get_env_library(env["env_home"])
+            if env["orphaned"] or env.get("busy") or not library:
+                continue
+            for pkg in sorted(os.listdir(library)):
+                pkg_dir = Path(library) / pkg
+                if pkg.startswith(".") or pkg_dir.is_symlink() or not (pkg_dir / "DESCRIPTION").is_file():
+                    continue
+                key = self.store.key(pkg_dir)
+                if key:
+                    groups.setdefault(key, []).append(pkg_dir)
+
+        candidates = []
+        for key, pkg_dirs in groups.items():
+            stored = self.store.entry_path(key)
+            canonical = stored if stored.is_dir() else pkg_dirs[0]
+            for pkg_dir in pkg_dirs:
+                if pkg_dir != canonical and not os.path.samefile(str(pkg_dir / "DESCRIPTION"),
+                                                                 str(canonical / "DESCRIPTION")):
+                    candidates.append((canonical, pkg_dir))
+        if not candidates:
+            return 0
+
+        def same_tree(pair):
+            return tree_hash(pair[0]) == tree_hash(pair[1])
+
+        reclaimed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            matches = list(pool.map(same_tree, candidates))
+        for (canonical, pkg_dir), match in zip(candidates, matches):
+            if not match:
+                self.logger.debug("%s differs from %s and was not deduplicated." % (pkg_dir, canonical))
+                continue
+            reclaimed += utils.disk_usage(pkg_dir)
+            report["deduped"].append(str(pkg_dir))
+            if dry_run:
+                continue
+            # Link next to the package first so that it is never missing from the library.  The names
+            # include the pid so that they don't collide with another gc or package store ingest.
+            new_dir = pkg_dir.with_name(".%s~%s.new" % (pkg_dir.name, os.getpid()))
+            old_dir = pkg_dir.with_name(".%s~%s.old" % (pkg_dir.name, os.getpid()))
+            link_tree(canonical, new_dir)
+            os.rename(str(pkg_dir), str(old_dir))
+            os.rename(str(new_dir), str(pkg_dir))
+            shutil.rmtree(str(old_dir))
+        self.logger.debug("Deduplicated %s packages." % len(report["deduped"]))
+
+        return reclaimed
+
+    def remove_tmp(self, report, dry_run=False):
+        """
+        Remove the temporary files and staging directories that crashed processes left in the package
+        store and the download cache.
+        :param report:  The report from usage, which is updated with the removed paths.
+        :param dry_run:  Only report what would be removed.
+        :return:  Returns the number of bytes reclaimed.
+        """
+        reclaimed = 0
+        now = time.time()
+        for root in (self.store.store_dir, self.downloads_dir):
+            for tmp_path in _stale_tmp(str(root), now):
+                reclaimed += utils.disk_usage(tmp_path) if os.path.isdir(tmp_path) else os.lstat(tmp_path).st_size
+                report["tmp"].append(tmp_path)
+                if not dry_run:
+                    _remove(tmp_path)
+
+        return reclaimed
+
+    def evict(self, report, max_cache_size, dry_run=False):
+        """
+        Evict the package store entries and downloads that no environment uses, least recently used
+        first, until the package store and the download cache fit in a size budget.
+        :param report:  The report from usage, which is updated with the evicted paths.
+        :param max_cache_size:  The bytes the package store and download cache may use.
+        :param dry_run:  Only report what would be evicted.
+        :return:  Returns the number of bytes reclaimed.
+        """
+        cache_size = report["store"] + report["cache"]
+        if cache_size <= max_cache_size:
+            return 0
+
+        # A store entry is in use when an environment hardlinks its files or symlinks to it
+        env_inodes = set()
+        env_targets = []
+        for name in report["envs"]:
+            env_inodes.update(report["scans"][name]["inodes"])
+            env_targets.extend(report["scans"][name]["targets"])
+        candidates = []
+        for entry in _store_entries(self.store.store_dir):
+            st = os.stat(os.path.join(entry, "DESCRIPTION"))
+            if (st.st_dev, st.st_ino) in env_inodes or \
+                    any(target == entry or target.startswith(entry + os.sep) for target in env_targets):
+                continue
+            # The build directory is removed with the entry
+            candidates.append((st.st_atime, os.path.dirname(entry)))
+        if self.downloads_dir.is_dir():
+            for root, dirs, files in os.walk(str(self.downloads_dir)):
+                for name in files:
+                    if not name.endswith((".sha256", ".tmp")):
+                        candidates.append((os.stat(os.path.join(root, name)).st_atime, os.path.join(root, name)))
+
+        reclaimed = 0
+        for last_used, path in sorted(candidates):
+            if cache_size - reclaimed <= max_cache_size:
+                break
+            size = utils.disk_usage(path) if os.path.isdir(path) else os.lstat(path).st_blocks * 512
+            reclaimed += size
+            report["evicted"].append(path)
+            if not dry_run:
+                _remove(path)
+                if os.path.exists(path + ".sha256"):
+                    os.unlink(path + ".sha256")
+                _remove_empty_parents(path, (str(self.store.store_dir), str(self.downloads_dir)))
+        self.logger.debug("Evicted %s unused package store entries and downloads." % len(report["evicted"]))
+
+        return reclaimed
+
+
+def is_env_layout(env_home):
+    """
+    Check whether a directory has the layout of an R environment, which environments built before
+    renv.yaml existed also have.
+    :param env_home:  The path to the directory.
+    :return:  Returns True if the directory has a bin/activate script and a lib*/R/library directory.
+    """
+    return (Path(env_home) / "bin" / "activate").is_file() and utils.get_env_library(env_home) is not None
+
+
+def scan_trees(roots, workers=8):
+    """
+    Walk directory trees in parallel with os.scandir.  Every directory is listed by a pool of worker
+    threads, which keeps many metadata requests in flight on network filesystems.  Symlinks aren't
+    followed.
+    :param roots:  A dictionary of names to the paths of the trees.
+    :param workers:  The number of directories that are listed at the same time.
+    :return:  Returns a dictionary of names to a dictionary with the bytes used by each (st_dev, st_ino)
+              inode in the tree, the dangling symlinks, and the absolute targets of the other symlinks.
+    """
+    scans = OrderedDict((name, {"inodes": {}, "dangling": [], "targets": []}) for name in roots)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_dir, path): name for name, path in roots.items() if os.path.isdir(path)}
+        while pending:
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                name = pending.pop(future)
+                inodes, dangling, targets, subdirs = future.result()
+                scan = scans[name]
+                scan["inodes"].update(inodes)
+                scan["dangling"].extend(dangling)
+                scan["targets"].extend(targets)
+                for subdir in subdirs:
+                    pending[pool.submit(_scan_dir, subdir)] = name
+    tracer.count("gc.inodes", sum(len(scan["inodes"]) for scan in scans.values()))
+
+    return scans
+
+
+def _scan_dir(path):
+    inodes = {}
+    dangling = []
+    targets = []
+    subdirs = []
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return inodes, dangling, targets, subdirs
+    tracer.count("syscalls.getdents")
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        inodes[(st.st_dev, st.st_ino)] = st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+        if entry.is_symlink():
+            target = os.path.join(path, os.readlink(entry.path))
+            if os.path.exists(entry.path):
+                targets.append(os.path.normpath(target))
+            else:
+                dangling.append(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+
+    return inodes, dangling, targets, subdirs
+
+
+def _store_entries(store_dir):
+    # Store entries are <name>/<version>/R-<major.minor>/<build hash>/<name>
+    store_dir = str(store_dir)
+    if not os.path.isdir(store_dir):
+        return
+    for name in os.listdir(store_dir):
+        for version in _listdir(os.path.join(store_dir, name)):
+            for r_minor in _listdir(os.path.join(store_dir, name, version)):
+                for build_hash in _listdir(os.path.join(store_dir, name, version, r_minor)):
+                    entry = os.path.join(store_dir, name, version, r_minor, build_hash, name)
+                    if not build_hash.endswith(".tmp") and os.path.isfile(os.path.join(entry, "DESCRIPTION")):
+                        yield entry
+
+
+def _stale_tmp(root, now):
+    if not os.path.isdir(root):
+        return
+    for dirpath, dirs, files in os.walk(root):
+        for name in list(dirs) + files:
+            path = os.path.join(dirpath, name)
+            if name.endswith(".tmp") and now - os.lstat(path).st_mtime > _STALE_TMP_AGE:
+                if name in dirs:
+                    dirs.remove(name)
+                yield path
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except NotADirectoryError:
+        return []
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _remove_empty_parents(path, roots):
+    parent = os.path.dirname(path)
+    while parent not in roots and not os.listdir(parent):
+        os.rmdir(parent)
+        parent = os.path.dirname(parent)
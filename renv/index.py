@@ -0,0 +1,221 @@
+import os
+import gzip
+import json
+import time
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+
+import renv.utils as utils
+from renv.store import link_file
+from renv.profiling import tracer
+
+# The DESCRIPTION fields of the dependencies that must be installed first
+DEPENDENCY_FIELDS = ("Depends", "Imports", "LinkingTo")
+
+# The package indexes of a CRAN-like repository in order of preference
+PACKAGES_FILES = ("PACKAGES.gz", "PACKAGES")
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS repos (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, checked REAL)",
+    "CREATE TABLE IF NOT EXISTS packages (repo TEXT, name TEXT, version TEXT, md5 TEXT, deps TEXT, record TEXT, "
+    "PRIMARY KEY (repo, name))",
+    "CREATE INDEX IF NOT EXISTS packages_name ON packages (name)",
+)
+
+
+class RepoIndex(object):
+    """
+The RepoIndex class keeps a local SQLite copy of the package metadata of CRAN-
+like repositories in the .renv root.
+
+Each repository's PACKAGES index is downloaded once and refreshed
+incrementally: the index is only checked again after max_age seconds, and then
+with a conditional request (ETag and Last-Modified), so an unchanged index is
+never downloaded or parsed twice.  Dependency graphs are resolved from the
+local copy in milliseconds, and the packages in the download cache can be
+written out as a local repository for R (e.g. for offline installs).
+"""
+
+    def __init__(self, index_file, timeout=60):
+        self.logger = logging.getLogger(__name__)
+        self.index_file = Path(index_file)
+        self.timeout = timeout
+
+    def refresh(self, repos, max_age=3600, force=False):
+        """
+        Update the local copy of the repositories' package indexes.
+        :param repos:  A list of repository URLs (remote or file://).
+        :param max_age:  The seconds before a repository's index is checked again.
+        :param force:  Check every repository regardless of max_age.
+        :return:  Returns a dictionary of repository URLs to the number of packages that were
+                  updated, or None for the indexes that were not modified (or couldn't be read).
+        """
+        updated = {}
+        with self._connect() as conn:
+            for repo in _repo_urls(repos):
+                row = conn.execute("SELECT etag, last_modified, checked FROM repos WHERE url = ?",
+                                   (repo,)).fetchone()
+                etag, last_modified, checked = row or (None, None, 0)
+                if not force and time.time() - checked < max_age:
+                    updated[repo] = None
+                    continue
+                try:
+                    with tracer.span("index_refresh", category="network", repo=repo):
+                        fetched = self._fetch(repo, etag, last_modified)
+                except (OSError, ValueError) as err:
+                    self.logger.warning("Unable to refresh the package index of %s: %s" % (repo, err))
+                    updated[repo] = None
+                    continue
+                if fetched:
+                    text, etag, last_modified = fetched
+                    updated[repo] = self._store(conn, repo, utils.parse_dcf(text))
+                    self.logger.debug("Indexed %s packages from %s" % (updated[repo], repo))
+                else:
+                    updated[repo] = None
+                    self.logger.debug("The package index of %s is up to date." % repo)
+                conn.execute("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?)",
+                             (repo, etag, last_modified, time.time()))
+
+        return updated
+
+    def resolve(self, pkgs, repos):
+        """
+        Resolve the recursive dependencies of packages from the local index.
+        :param pkgs:  A list of package names.
+        :param repos:  A list of repository URLs.  Packages in the first repositories take precedence.
+        :return:  Returns a dictionary of package names to their version, direct dependencies, MD5
+                  checksum, and download URL.
+        """
+        repos = _repo_urls(repos)
+        graph = {}
+        with self._connect() as conn:
+            todo = list(pkgs)
+            while todo:
+                pkg = todo.pop()
+                if pkg in graph:
+                    continue
+                row = self._lookup(conn, pkg, repos)
+                if not row:
+                    continue
+                repo, version, md5, deps = row
+                deps = set(filter(None, deps.split(",")))
+                graph[pkg] = {"version": version, "deps": deps, "md5": md5,
+                              "url": "%s/src/contrib/%s_%s.tar.gz" % (repo, pkg, version)}
+                todo.extend(deps - set(graph))
+
+        return graph
+
+    def write_repo(self, repo_dir, repos, downloads):
+        """
+        Write the downloaded packages as a local CRAN-like repository that R can install from
+        (e.g. install.packages(pkgs, repos="file://<repo_dir>")).
+        :param repo_dir:  The directory of the local repository.
+        :param repos:  A list of repository URLs.  Packages in the first repositories take precedence.
+        :param downloads:  The DownloadCache with the package files.
+        :return:  Returns the number of packages in the local repository.
+        """
+        repos = _repo_urls(repos)
+        contrib = Path(repo_dir) / "src" / "contrib"
+        contrib.mkdir(parents=True, exist_ok=True)
+        records = {}
+        with self._connect() as conn:
+            rows = conn.execute("SELECT repo, name, version, record FROM packages WHERE repo IN (%s)" %
+                                ",".join("?" * len(repos)), repos).fetchall()
+        for repo, name, version, record in sorted(rows, key=lambda row: repos.index(row[0]), reverse=True):
+            pkg_file = downloads.path_for("%s/src/contrib/%s_%s.tar.gz" % (repo, name, version))
+            if pkg_file.exists():
+                records[name] = (pkg_file, json.loads(record))
+
+        for name, (pkg_file, record) in records.items():
+            repo_file = contrib / pkg_file.name
+            if not repo_file.exists():
+                link_file(pkg_file, repo_file)
+        text = "".join("%s\n" % "".join("%s: %s\n" % field for field in record.items())
+                       for _, record in sorted(records.values(), key=lambda entry: entry[1]["Package"]))
+        _write_atomic(contrib / "PACKAGES", text.encode("utf-8"))
+        _write_atomic(contrib / "PACKAGES.gz", gzip.compress(text.encode("utf-8")))
+
+        return len(records)
+
+    def _fetch(self, repo, etag, last_modified):
+        # urllib.request is slow to import and is only needed here
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        error = None
+        for packages_file in PACKAGES_FILES:
+            url = "%s/src/contrib/%s" % (repo, packages_file)
+            try:
+                with urlopen(Request(url, headers=headers), timeout=self.timeout) as response:
+                    new_etag = response.headers.get("ETag")
+                    new_last_modified = response.headers.get("Last-Modified")
+                    # file:// and some servers ignore conditional requests
+                    if (new_etag or new_last_modified) and (new_etag, new_last_modified) == (etag, last_modified):
+                        return None
+                    data = response.read()
+            except HTTPError as err:
+                if err.code == 304:
+                    return None
+                error = err
+                continue
+            except OSError as err:
+                error = err
+                continue
+            if packages_file.endswith(".gz"):
+                data = gzip.decompress(data)
+            return data.decode("utf-8", errors="replace"), new_etag, new_last_modified
+        raise error
+
+    @staticmethod
+    def _store(conn, repo, records):
+        rows = []
+        for record in records:
+            if not record.get("Package") or not record.get("Version"):
+                continue
+            deps = [dep for field in DEPENDENCY_FIELDS for dep in utils.parse_dependencies(record.get(field))]
+            rows.append((repo, record["Package"], record["Version"], record.get("MD5sum"),
+                         ",".join(sorted(set(deps))), json.dumps(record)))
+        conn.execute("DELETE FROM packages WHERE repo = ?", (repo,))
+        conn.executemany("INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    @staticmethod
+    def _lookup(conn, pkg, repos):
+        rows = conn.execute("SELECT repo, version, md5, deps FROM packages WHERE name = ? AND repo IN (%s)" %
+                            ",".join("?" * len(repos)), [pkg] + repos).fetchall()
+        return min(rows, key=lambda row: repos.index(row[0])) if rows else None
+
+    @contextmanager
+    def _connect(self):
+        # sqlite3 is slow to import and is only needed once packages are installed
+        import sqlite3
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        # The timeout lets concurrent builds wait for each other's refreshes
+        conn = sqlite3.connect(str(self.index_file), timeout=self.timeout)
+        try:
+            with conn:
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+                yield conn
+        finally:
+            conn.close()
+
+
+def _repo_urls(repos):
+    urls = []
+    for repo in repos:
+        if repo and repo.rstrip("/") not in urls:
+            urls.append(repo.rstrip("/"))
+    return urls
+
+
+def _write_atomic(path, data):
+    tmp_file = path.with_name("%s.%s.tmp" % (path.name, os.getpid()))
+    with open(str(tmp_file), "wb") as tmp:
+        tmp.write(data)
+    os.replace(str(tmp_file), str(path))
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import subprocess as sp
+from pathlib import Path
+from subprocess import TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from renv.profiling import tracer
+
+# Resolve the recursive hard dependencies of the requested packages (passed as arguments) and write each
+# package's version and direct dependencies as tab delimited records.
+_R_RESOLVE_EXPR = (
+    'args <- commandArgs(trailingOnly=TRUE); '
+    'repos <- strsplit(args[1], ",")[[1]]; pkgs <- args[-1]; '
+    'db <- utils::available.packages(repos=repos); '
+    'which <- c("Depends", "Imports", "LinkingTo"); '
+    'deps <- tools::package_dependencies(pkgs[pkgs %in% rownames(db)], db=db, which=which, recursive=TRUE); '
+    'all_pkgs <- intersect(unique(c(pkgs, unlist(deps))), rownames(db)); '
+    'direct <- tools::package_dependencies(all_pkgs, db=db, which=which); '
+    'writeLines(paste(all_pkgs, db[all_pkgs, "Version"], '
+    'vapply(direct[all_pkgs], paste, "", collapse=","), sep="\\t"))'
+)
+
+_R_INSTALL_EXPR = (
+    'args <- commandArgs(trailingOnly=TRUE); '
+    'utils::install.packages(args[1], lib=args[2], repos=strsplit(args[3], ",")[[1]], dependencies=FALSE); '
+    'if (!file.exists(file.path(args[2], args[1], "DESCRIPTION"))) quit(status=1)'
+)
+
+# Install a downloaded package file (passed as an argument along with the package name and library)
+_R_INSTALL_FILE_EXPR = (
+    'args <- commandArgs(trailingOnly=TRUE); '
+    'utils::install.packages(args[1], lib=args[3], repos=NULL, type="source"); '
+    'if (!file.exists(file.path(args[3], args[2], "DESCRIPTION"))) quit(status=1)'
+)
+
+
+class PackageInstaller(object):
+    """
+The PackageInstaller class installs R packages into an environment's library
+non-interactively.
+
+The dependency graph of the requested packages is resolved with a single R
+call.  Packages are then installed in dependency order, with packages that
+don't depend on each other installed concurrently by separate R processes.
+Packages that are already in the package store are linked instead of built,
+and packages that are built are added to the store.
+
+With a repository index, the dependency graph is resolved in Python from the
+local copy of the repositories' metadata instead, and with a download cache
+every package file is downloaded (and checksummed) through the cache before it
+is installed.
+"""
+
+    def __init__(self, rscript, library, repos, r_minor=None, store=None, index=None, downloads=None, workers=4,
+                 retries=2, timeout=3600):
+        self.logger = logging.getLogger(__name__)
+        if retries < 0:
+            raise ValueError("The number of retries can't be negative: %s" % retries)
+        self.rscript = str(rscript)
+        self.library = Path(library)
+        self.repo_urls = list(repos)
+        self.repos = ",".join(repos)
+        self.index = index
+        self.downloads = downloads
+        self.r_minor = r_minor
+        self.store = store
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+
+    def resolve(self, pkgs):
+        """
+        Resolve the dependency graph of packages from the repositories.
+        :param pkgs:  A list of package names.
+        :return:  Returns a dictionary of package names to their version and direct dependencies.
+        """
+        if self.index:
+            self.index.refresh(self.repo_urls)
+            return self.index.resolve(pkgs, self.repo_urls)
+        stdout, stderr = self._run_r("resolve", _R_RESOLVE_EXPR, [self.repos] + list(pkgs), timeout=300)[1:]
+        graph = {}
+        for line in stdout.splitlines():
+            fields = line.split("\t")
+            if len(fields) == 3:
+                graph[fields[0]] = {"version": fields[1], "deps": set(filter(None, fields[2].split(",")))}
+        return graph
+
+    def install(self, pkgs, installed=(), versions=None):
+        """
+        Install packages and their dependencies.
+        :param pkgs:  A list of package names.
+        :param installed:  Package names that are already available in addition to the packages in the library.
+        :param versions:  A dictionary of package names to the versions that must be installed.  Versions that
+                          are no longer current are downloaded from the repository's archive.
+        :return:  Returns a dictionary with the status, version, attempts, and seconds of each package.
+        """
+        installed = set(installed) | set(os.listdir(str(self.library)))
+        graph = self.resolve(pkgs)
+        for pkg, version in (versions or {}).items():
+            node = graph.get(pkg)
+            if node and node["version"] != version and node.get("url"):
+                repo = node["url"].split("/src/contrib/")[0]
+                node.update(version=version, md5=None,
+                            url="%s/src/contrib/Archive/%s/%s_%s.tar.gz" % (repo, pkg, pkg, version))
+        results = {pkg: {"status": "unavailable"} for pkg in pkgs if pkg not in graph and pkg not in installed}
+        for pkg in results:
+            self.logger.error("%s is not available from %s" % (pkg, self.repos))
+
+        # Only the packages that aren't installed are scheduled and only their dependencies on each other matter
+        pending = {pkg: graph[pkg]["deps"] - installed for pkg in graph if pkg not in installed}
+        for pkg in pending:
+            pending[pkg] &= set(pending)
+        self.logger.info("Installing %s packages with %s workers..." % (len(pending), self.workers))
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for pkg in sorted(p for p, deps in pending.items() if not deps):
+                    del pending[pkg]
+                    running[pool.submit(self._install_one, pkg, graph[pkg])] = pkg
+                if not running:
+                    # The remaining packages depend on packages that failed or on each other
+                    for pkg in pending:
+                        results[pkg] = {"status": "skipped", "version": graph[pkg]["version"]}
+                        self.logger.error("%s was skipped because its dependencies were not installed." % pkg)
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pkg = running.pop(future)
+                    results[pkg] = future.result()
+                    if results[pkg]["status"] in ("installed", "linked"):
+                        for deps in pending.values():
+                            deps.discard(pkg)
+
+        return results
+
+    def _install_one(self, pkg, node):
+        start = time.perf_counter()
+        version = node["version"]
+        if self.store and self.r_minor:
+            entry = self.store.find(pkg, self.r_minor, version)
+            if entry:
+                self.store.link(entry, self.library)
+                return {"status": "linked", "version": version, "attempts": 0,
+                        "seconds": round(time.perf_counter() - start, 3)}
+
+        for attempt in range(1, self.retries + 2):
+            if self.downloads and node.get("url"):
+                try:
+                    pkg_file = self.downloads.fetch(node["url"], md5=node.get("md5"))
+                except (OSError, ValueError) as err:
+                    status = "failed"
+                    self.logger.warning("Downloading %s failed (attempt %s): %s" % (pkg, attempt, err))
+                    continue
+                returncode, stdout, stderr = self._run_r("install", _R_INSTALL_FILE_EXPR,
+                                                         [str(pkg_file), pkg, str(self.library)])
+            else:
+                returncode, stdout, stderr = self._run_r("install", _R_INSTALL_EXPR,
+                                                         [pkg, str(self.library), self.repos])
+            if not returncode:
+                status = "installed"
+                self.logger.info("%s %s was installed." % (pkg, version))
+                self._store_package(pkg)
+                break
+            status = "failed"
+            self.logger.warning("Installing %s failed (attempt %s): %s" % (pkg, attempt, stderr.strip()[-500:]))
+
+        return {"status": status, "version": version, "attempts": attempt,
+                "seconds": round(time.perf_counter() - start, 3)}
+
+    def _store_package(self, pkg):
+        # Packages that were built are stored so that the other environments on the node link them
+        if not self.store:
+            return
+        try:
+            self.store.ingest_package(self.library / pkg)
+        except OSError as err:
+            self.logger.warning("%s could not be added to the package store: %s" % (pkg, err))
+
+    def _run_r(self, rcmd_type, expr, args, timeout=None):
+        # Packages are installed into and loaded from the environment library
+        env = dict(os.environ, R_LIBS=str(self.library), R_LIBS_USER=str(self.library))
+        with tracer.span("system_r_call", category="subprocess", rcmd_type=rcmd_type, args=args[:2]):
+            proc = sp.Popen([self.rscript, "--vanilla", "-e", expr, "--args"] + args, stderr=sp.PIPE,
+                            stdout=sp.PIPE, encoding='utf-8', env=env)
+            try:
+                stdout, stderr = proc.communicate(timeout=timeout or self.timeout)
+            except TimeoutExpired:
+                proc.kill()
+                stdout, stderr = proc.communicate()
+                stderr = "%s\nTimed out." % stderr
+                return 1, stdout, stderr
+
+        return proc.returncode, stdout, stderr
@@ -0,0 +1,115 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+from renv.profiling import tracer
+
+
+class FileLock(object):
+    """
+The FileLock class coordinates the renv processes that share a .renv root
+with flock(2) locks on files in the root.
+
+A lock is held either exclusively (e.g. while an environment is built or
+changed) or shared (e.g. while an environment is read), and it is released
+when the process exits, so a crashed build never leaves a stale lock behind.
+hold() is reentrant, which lets builder methods that take the lock call each
+other.  A reentrant hold of a lock that is already held keeps its mode.
+"""
+
+    def __init__(self, lock_file, timeout=None, poll=0.1):
+        self.logger = logging.getLogger(__name__)
+        self.lock_file = Path(lock_file)
+        self.timeout = timeout
+        self.poll = poll
+        self.depth = 0
+        self._fd = None
+        self._lock = threading.RLock()
+
+    @property
+    def locked(self):
+        return self.depth > 0
+
+    def acquire(self, shared=False, blocking=True):
+        """
+        Acquire the lock.
+        :param shared:  Share the lock with other readers instead of holding it exclusively.
+        :param blocking:  Wait until the lock is available (for up to timeout seconds).
+        :return:  Returns True, or False if the lock isn't available and blocking is False.
+        """
+        with self._lock:
+            if self.depth:
+                self.depth += 1
+                return True
+            self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.lock_file), os.O_RDWR | os.O_CREAT, 0o644)
+            operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            start = time.perf_counter()
+            waiting = False
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = time.perf_counter() - start
+                    if not blocking or (self.timeout is not None and waited >= self.timeout):
+                        os.close(fd)
+                        if not blocking:
+                            return False
+                        raise TimeoutError("Timed out waiting for %s after %.0fs." % (self.lock_file, waited))
+                    if not waiting:
+                        waiting = True
+                        self.logger.info("Waiting for another renv process to release %s..." % self.lock_file)
+                    time.sleep(self.poll)
+            tracer.count("locks.waited_ms", int((time.perf_counter() - start) * 1000))
+            self._fd = fd
+            self.depth = 1
+            return True
+
+    def release(self):
+        """Release the lock once it has been released as many times as it was acquired."""
+        with self._lock:
+            if not self.depth:
+                raise RuntimeError("%s is not locked." % self.lock_file)
+            self.depth -= 1
+            if not self.depth:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = None
+
+    @contextmanager
+    def hold(self, shared=False):
+        """
+        Hold the lock for a block of code.
+        :param shared:  Share the lock with other readers instead of holding it exclusively.
+        """
+        self.acquire(shared=shared)
+        try:
+            yield self
+        finally:
+            self.release()
+
+
+def env_lock_file(renv_path, env_name):
+    """
+    Get the lock file of an environment.
+    :param renv_path:  The path to the .renv root.
+    :param env_name:  The name of the environment.
+    :return:  Returns the path of the lock file.
+    """
+    return Path(renv_path) / "locks" / ("%s.lock" % env_name)
+
+
+def root_lock_file(path, name):
+    """
+    Get the lock file that serializes the initialization of a .renv root.  It lives next to the
+    root because the root doesn't exist until it is initialized.
+    :param path:  The renv installation path.
+    :param name:  The renv directory name.
+    :return:  Returns the path of the lock file.
+    """
+    return Path(path) / (".%s.lock" % name)
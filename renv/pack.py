@@ -0,0 +1,197 @@
+import os
+import sys
+import logging
+import tarfile
+from pathlib import Path, PurePosixPath
+
+import renv.utils as utils
+from renv.exceptions import EnvNotFoundError, RenvError
+from renv.locks import FileLock, env_lock_file
+from renv.profiling import tracer
+
+# Archive suffixes and their tarfile compression
+COMPRESSION = {".tar": "", ".gz": "gz", ".tgz": "gz", ".bz2": "bz2", ".tbz2": "bz2", ".xz": "xz", ".txz": "xz"}
+
+
+def compression_for(archive, default="gz"):
+    """
+    Get the compression of an archive from its file name.
+    :param archive:  The path of the archive.
+    :param default:  The compression of archives without a known suffix (e.g. stdout).
+    :return:  Returns "", "gz", "bz2", or "xz".
+    """
+    return COMPRESSION.get(Path(str(archive)).suffix, default)
+
+
+def pack_env(env_home, output, renv_path, compression=None):
+    """
+    Stream an environment into a compressed tar archive that renv unpack (see PackedEnv) can
+    create the environment from on another node or under another prefix.  The archive starts
+    with the environment's renv.yaml.  Symlinks into the .renv root outside of the environment
+    (e.g. to the package store) are archived as the files they point to, hardlinked files are
+    archived once, and the other symlinks (e.g. to the system R) are kept.
+    :param env_home:  The path to the environment.
+    :param output:  The path of the archive, or "-" for stdout.
+    :param renv_path:  The path of the .renv root.
+    :param compression:  "", "gz", "bz2", or "xz".  By default it is chosen from the archive's suffix.
+    :return:  Returns a dictionary with the number of files and bytes that were archived.
+    """
+    env_home = Path(env_home).absolute()
+    renv_path = Path(renv_path).absolute()
+    if not (env_home / "renv.yaml").is_file():
+        raise EnvNotFoundError("%s is not an R environment." % env_home)
+    if compression is None:
+        compression = compression_for(output)
+    if compression not in COMPRESSION.values():
+        raise RenvError("Unknown compression: %s" % compression)
+    packer = _Packer(env_home, renv_path)
+    with FileLock(env_lock_file(renv_path, env_home.name)).hold(shared=True), tracer.span("pack_env"):
+        if output == "-":
+            tar = tarfile.open(fileobj=sys.stdout.buffer, mode="w|%s" % compression)
+        else:
+            tar = tarfile.open(str(output), mode="w|%s" % compression)
+        with tar:
+            packer.pack(tar)
+    logging.getLogger(__name__).info("Packed %s files (%s bytes) of %s." % (packer.files, packer.bytes, env_home))
+    return {"files": packer.files, "bytes": packer.bytes}
+
+
+class _Packer(object):
+
+    def __init__(self, env_home, renv_path):
+        self.env_home = env_home
+        self.renv_path = renv_path
+        self.files = 0
+        self.bytes = 0
+
+    def pack(self, tar):
+        name = self.env_home.name
+        tar.addfile(tar.gettarinfo(str(self.env_home), name))
+        # unpack reads the configuration before anything else
+        self.add(tar, self.env_home / "renv.yaml", "%s/renv.yaml" % name)
+        for root, dirs, files in os.walk(str(self.env_home)):
+            dirs.sort()
+            rel_root = Path(root).relative_to(self.env_home)
+            for entry in sorted(dirs + files):
+                path = Path(root) / entry
+                if rel_root == Path(".") and entry == "renv.yaml":
+                    continue
+                self.add(tar, path, str(PurePosixPath(name, *rel_root.parts, entry)))
+
+    def add(self, tar, path, arcname):
+        if path.is_symlink():
+            target = utils.link_target(path)
+            if self.renv_path in Path(target).parents and self.env_home not in Path(target).parents:
+                return self.add_tree(tar, Path(target), arcname)
+            info = tar.gettarinfo(str(path), arcname)
+            if not os.path.isabs(info.linkname) and self.env_home not in Path(target).parents:
+                # Relative links that leave the environment wouldn't survive a move
+                info.linkname = target
+            tar.addfile(info)
+        elif path.is_file():
+            info = tar.gettarinfo(str(path), arcname)
+            self.add_file(tar, path, info)
+        else:
+            tar.addfile(tar.gettarinfo(str(path), arcname))
+
+    def add_tree(self, tar, path, arcname):
+        if not path.exists():
+            logging.getLogger(__name__).warning("Skipping %s, which points to the missing %s" % (arcname, path))
+            return
+        self.add_file(tar, path, tar.gettarinfo(str(path), arcname))
+        if path.is_dir():
+            for root, dirs, files in os.walk(str(path)):
+                dirs.sort()
+                rel_root = Path(root).relative_to(path)
+                for entry in sorted(dirs + files):
+                    entry_path = Path(root) / entry
+                    entry_name = str(PurePosixPath(arcname, *rel_root.parts, entry))
+                    if entry in files:
+                        self.add_file(tar, entry_path, tar.gettarinfo(str(entry_path), entry_name))
+                    else:
+                        tar.addfile(tar.gettarinfo(str(entry_path), entry_name))
+
+    def add_file(self, tar, path, info):
+        if info.isreg():
+            with open(str(path), "rb") as fileobj:
+                tar.addfile(info, fileobj)
+            self.files += 1
+            self.bytes += info.size
+        else:
+            tar.addfile(info)
+
+
+class PackedEnv(object):
+    """
+The PackedEnv class reads an environment archive written by pack_env as a
+stream, so it can be unpacked from a pipe.  The environment's renv.yaml is
+read first, which lets the builder of the new environment be created before
+the rest of the archive is extracted.
+
+    with PackedEnv(archive) as packed:
+        builder.unpack_venv(packed.extract)
+"""
+
+    def __init__(self, archive):
+        self.logger = logging.getLogger(__name__)
+        if archive == "-":
+            self.tar = tarfile.open(fileobj=sys.stdin.buffer, mode="r|*")
+        else:
+            self.tar = tarfile.open(str(archive), mode="r|*")
+        root = self.tar.next()
+        cfg = self.tar.next()
+        if root is None or not root.isdir() or cfg is None or cfg.name != "%s/renv.yaml" % root.name:
+            self.tar.close()
+            raise RenvError("%s is not a packed R environment." % archive)
+        self.env_name = root.name
+        self.cfg_member = cfg
+        self.config_text = self.tar.extractfile(cfg).read()
+        import yaml
+        self.config = yaml.safe_load(self.config_text) or {}
+
+    def extract(self, dest):
+        """
+        Extract the environment into a directory.
+        :param dest:  The path of the directory, which must not exist.
+        :return:  Returns the number of extracted members.
+        """
+        dest = Path(dest)
+        dest.mkdir()
+        real_dest = os.path.realpath(str(dest))
+        with open(str(dest / "renv.yaml"), "wb") as cfg:
+            cfg.write(self.config_text)
+        os.chmod(str(dest / "renv.yaml"), self.cfg_member.mode & 0o777)
+        members = 1
+        # The root directory and renv.yaml were already read, so iterating the archive would repeat them
+        member = self.tar.next()
+        while member is not None:
+            member.name = self._strip(member.name)
+            if member.islnk():
+                member.linkname = self._strip(member.linkname)
+            # Members must not be written through a symlink out of the environment
+            parent = os.path.realpath(os.path.dirname(os.path.join(real_dest, member.name)))
+            if parent != real_dest and not parent.startswith(real_dest + os.sep):
+                raise RenvError("%s is outside of the environment." % member.name)
+            if hasattr(tarfile, "tar_filter"):
+                self.tar.extract(member, real_dest, filter="tar")
+            else:
+                self.tar.extract(member, real_dest)
+            members += 1
+            member = self.tar.next()
+        self.logger.debug("Extracted %s members into %s" % (members, dest))
+        return members
+
+    def _strip(self, name):
+        parts = PurePosixPath(name).parts
+        if PurePosixPath(name).is_absolute() or ".." in parts or len(parts) < 2 or parts[0] != self.env_name:
+            raise RenvError("Refusing to extract %s" % name)
+        return str(PurePosixPath(*parts[1:]))
+
+    def close(self):
+        self.tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,126 @@
+import os
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from renv.profiling import tracer
+
+
+class FilesystemPlan(object):
+    """
+The FilesystemPlan class collects the directories and symlinks of an R
+environment up front so that they can be created in as few passes over the
+filesystem as possible.
+
+Directories are created in the order they were planned.  Symlinks are
+grouped by their parent directory and each group is created relative to a
+single open directory file descriptor, with the groups spread across a
+bounded pool of worker threads.  This keeps the number of path lookups and
+round-trips low on network filesystems.
+"""
+
+    def __init__(self, max_workers=8):
+        self.logger = logging.getLogger(__name__)
+        self.max_workers = max_workers
+        self.directories = []
+        self.symlinks = OrderedDict()
+
+    def __len__(self):
+        return len(self.directories) + sum(len(links) for links in self.symlinks.values())
+
+    def mkdir(self, path):
+        """
+        Plan a directory (and any missing parents).
+        :param path:  The path of the directory.
+        """
+        self.directories.append(str(path))
+
+    def symlink(self, src, dst):
+        """
+        Plan a symlink.
+        :param src:  The path the symlink points to.
+        :param dst:  The path of the symlink.
+        """
+        parent, name = os.path.split(str(dst))
+        self.symlinks.setdefault(parent, []).append((str(src), name))
+
+    def apply(self):
+        """Create every planned directory and symlink and then reset the plan."""
+        for directory in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            tracer.count("syscalls.mkdir")
+        if self.symlinks:
+            workers = min(self.max_workers, len(self.symlinks))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Consume the results so that errors are raised here
+                list(pool.map(self._link_batch, self.symlinks.keys(), self.symlinks.values()))
+        self.logger.debug("Created %s directories and %s symlinks." %
+                          (len(self.directories), len(self) - len(self.directories)))
+        self.directories = []
+        self.symlinks = OrderedDict()
+
+    def sync(self, removable):
+        """
+        Bring an existing tree in line with the plan, only touching the entries that differ, and then
+        reset the plan.  Missing directories and symlinks are created, symlinks with another target are
+        retargeted, and symlinks in the planned directories that aren't planned are removed if removable
+        returns True for them.  Existing files and directories are never replaced.
+        :param removable:  A function that takes the path of an unplanned symlink.
+        :return:  Returns a dictionary with the number of added, retargeted, removed, and kept entries.
+        """
+        changes = {"added": 0, "retargeted": 0, "removed": 0, "kept": 0}
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+                tracer.count("syscalls.mkdir")
+                changes["added"] += 1
+        for parent, links in self.symlinks.items():
+            planned = dict((name, src) for src, name in links)
+            for name in os.listdir(parent):
+                dst = os.path.join(parent, name)
+                if name not in planned and os.path.islink(dst) and removable(dst):
+                    os.unlink(dst)
+                    tracer.count("syscalls.unlink")
+                    changes["removed"] += 1
+            for name, src in planned.items():
+                dst = os.path.join(parent, name)
+                if not os.path.lexists(dst):
+                    os.symlink(src, dst)
+                    changes["added"] += 1
+                elif not os.path.islink(dst):
+                    self.logger.warning("%s is not a symlink and was left in place." % dst)
+                    changes["kept"] += 1
+                    continue
+                elif os.readlink(dst) != src:
+                    # Swap in the new symlink with a rename so that it is never missing
+                    tmp_dst = os.path.join(parent, ".%s.%s.tmp" % (name, os.getpid()))
+                    os.symlink(src, tmp_dst)
+                    os.replace(tmp_dst, dst)
+                    tracer.count("syscalls.rename")
+                    changes["retargeted"] += 1
+                else:
+                    changes["kept"] += 1
+                    continue
+                tracer.count("syscalls.symlink")
+        self.logger.debug("Synced the filesystem plan: %s" % changes)
+        self.directories = []
+        self.symlinks = OrderedDict()
+
+        return changes
+
+    @staticmethod
+    def _link_batch(parent, links):
+        if os.symlink not in os.supports_dir_fd:
+            for src, name in links:
+                os.symlink(src, os.path.join(parent, name))
+            tracer.count("syscalls.symlink", len(links))
+            return
+        dir_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for src, name in links:
+                os.symlink(src, name, dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+        tracer.count("syscalls.open")
+        tracer.count("syscalls.close")
+        tracer.count("syscalls.symlink", len(links))
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """
+The Tracer class records where renv spends its time.
+
+Spans time the build phases and every R subprocess, and counters tally the
+filesystem syscalls and bytes written.  Hooks registered with add_hook are
+called with each finished span, and the recorded events can be written as a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+
+Events are only kept while the tracer is enabled, but hooks are always called.
+"""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.counters = Counter()
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        """Start recording events and counters."""
+        self.enabled = True
+
+    def reset(self):
+        """Discard the recorded events and counters."""
+        with self._lock:
+            self.events = []
+            self.counters = Counter()
+            self._origin = time.perf_counter()
+
+    def add_hook(self, hook):
+        """
+        Register a function that is called with each finished span.
+        :param hook:  A function that takes a span event dictionary (name, cat, ts, dur, args).
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """
+        Unregister a span hook.
+        :param hook:  A function registered with add_hook.
+        """
+        self.hooks.remove(hook)
+
+    @contextmanager
+    def span(self, name, category="build", **args):
+        """
+        Time a block of code.
+        :param name:  The name of the span (e.g. the build phase).
+        :param category:  The category of the span (e.g. "build" or "subprocess").
+        :param args:  Extra information about the span.
+        """
+        if not (self.enabled or self.hooks):
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                     "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6, "args": args}
+            if self.enabled:
+                with self._lock:
+                    self.events.append(event)
+            for hook in self.hooks:
+                hook(event)
+
+    def count(self, counter, value=1):
+        """
+        Add to a counter (e.g. "syscalls.symlink" or "bytes_written").
+        :param counter:  The name of the counter.
+        :param value:  The amount to add.
+        """
+        if self.enabled:
+            with self._lock:
+                self.counters[counter] += value
+
+    def chrome_trace(self):
+        """
+        Get the recorded events in the Chrome trace event format.
+        :return:  Returns the trace dictionary.
+        """
+        end = (time.perf_counter() - self._origin) * 1e6
+        counters = [{"name": counter, "ph": "C", "pid": os.getpid(), "tid": 0, "ts": end, "args": {counter: value}}
+                    for counter, value in sorted(self.counters.items())]
+        return {"traceEvents": self.events + counters, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, trace_file):
+        """
+        Write the recorded events as a Chrome trace JSON file.
+        :param trace_file:  The path to the trace file.
+        """
+        with open(str(trace_file), "w") as trace:
+            json.dump(self.chrome_trace(), trace)
+
+    def summary(self):
+        """
+        Summarize the total time of each span and the counters.
+        :return:  Returns the summary text.
+        """
+        totals = Counter()
+        calls = Counter()
+        for event in self.events:
+            totals[event["name"]] += event["dur"] / 1e6
+            calls[event["name"]] += 1
+        lines = ["%-30s %6s calls %10.4fs" % (name, calls[name], seconds) for name, seconds in totals.most_common()]
+        lines.extend("%-30s %17s" % (counter, value) for counter, value in sorted(self.counters.items()))
+
+        return "\n".join(lines)
+
+
+# The tracer used by renv
+tracer = Tracer()
+
+
+def add_hook(hook):
+    """
+    Register a function that is called with each finished span of the renv tracer.
+    :param hook:  A function that takes a span event dictionary (name, cat, ts, dur, args).
+    """
+    tracer.add_hook(hook)
+
+
+def remove_hook(hook):
+    """
+    Unregister a span hook from the renv tracer.
+    :param hook:  A function registered with add_hook.
+    """
+    tracer.remove_hook(hook)
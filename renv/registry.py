@@ -0,0 +1,159 @@
+import os
+import time
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+
+import renv.utils as utils
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS envs (name TEXT PRIMARY KEY, env_home TEXT, r_version TEXT, r_home TEXT, "
+    "created REAL, updated REAL, packages INTEGER, disk_usage INTEGER)",
+)
+
+_FIELDS = ("name", "env_home", "r_version", "r_home", "created", "updated", "packages", "disk_usage")
+
+
+class EnvRegistry(object):
+    """
+The EnvRegistry class records the environments under the .renv root in a
+SQLite database, so that listing them doesn't have to walk the environments.
+
+Builders update an environment's entry (R version, R_HOME, creation time,
+package count, and disk usage) whenever they build, clear, upgrade, install
+into, or remove it.  verify() checks the entries against the filesystem on
+demand.
+"""
+
+    def __init__(self, registry_file, timeout=60):
+        self.logger = logging.getLogger(__name__)
+        self.registry_file = Path(registry_file)
+        self.timeout = timeout
+
+    def register(self, name, env_home, r_version, r_home, packages, disk_usage, new=False):
+        """
+        Add or update an environment's entry.
+        :param name:  The name of the environment.
+        :param env_home:  The path to the environment.
+        :param r_version:  The version of the environment's R.
+        :param r_home:  The environment's R installation.
+        :param packages:  The number of packages in the environment's library.
+        :param disk_usage:  The bytes used by the environment.
+        :param new:  The environment was (re)created, which resets its creation time.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT created FROM envs WHERE name = ?", (name,)).fetchone()
+            created = row[0] if row and not new else now
+            conn.execute("INSERT OR REPLACE INTO envs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (name, str(env_home), r_version, str(r_home), created, now, packages, disk_usage))
+
+    def remove(self, name):
+        """
+        Remove an environment's entry.
+        :param name:  The name of the environment.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM envs WHERE name = ?", (name,))
+
+    def get(self, name):
+        """
+        Get an environment's entry.
+        :param name:  The name of the environment.
+        :return:  Returns the entry dictionary or None.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM envs WHERE name = ?", (name,)).fetchone()
+        return dict(zip(_FIELDS, row)) if row else None
+
+    def list(self):
+        """
+        List the registered environments.
+        :return:  Returns a list of entry dictionaries sorted by name.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM envs ORDER BY name").fetchall()
+        return [dict(zip(_FIELDS, row)) for row in rows]
+
+    def verify(self, envs_dir, names=None):
+        """
+        Check the registered environments against the filesystem.  Entries whose package count
+        or R installation changed are updated, entries of removed environments are dropped, and
+        environments that aren't registered yet are added.  Entries whose renv.yaml can't be read
+        are kept and reported as invalid.
+        :param envs_dir:  The directory of the environments (<path>/<name>/cran).
+        :param names:  The names of the environments to check.  Every environment is checked by default.
+        :return:  Returns a dictionary of environment names to "ok", "updated", "removed", "invalid", or "added".
+        """
+        entries = {entry["name"]: entry for entry in self.list() if not names or entry["name"] in names}
+        statuses = {}
+        for name, entry in sorted(entries.items()):
+            env_home = Path(entry["env_home"])
+            if not (env_home / "renv.yaml").is_file():
+                self.remove(name)
+                statuses[name] = "removed"
+                continue
+            config = _read_config(env_home)
+            if config is None:
+                self.logger.warning("The renv.yaml of %s can't be read." % env_home)
+                statuses[name] = "invalid"
+                continue
+            r_version, r_home = config.get("R_VERSION"), config.get("R_ABS_HOME")
+            packages = count_packages(utils.get_env_library(env_home))
+            if (r_version, r_home, packages) == (entry["r_version"], entry["r_home"], entry["packages"]):
+                statuses[name] = "ok"
+            else:
+                self.register(name, env_home, r_version, r_home, packages, utils.disk_usage(env_home))
+                statuses[name] = "updated"
+
+        # Environments that were built before the registry existed
+        if Path(envs_dir).is_dir():
+            for name in sorted(os.listdir(str(envs_dir))):
+                env_home = Path(envs_dir) / name
+                if name in entries or (names and name not in names) or not (env_home / "renv.yaml").is_file() \
+                        or self.get(name):
+                    continue
+                config = _read_config(env_home)
+                if config is None:
+                    continue
+                self.register(name, env_home, config.get("R_VERSION"), config.get("R_ABS_HOME"),
+                              count_packages(utils.get_env_library(env_home)), utils.disk_usage(env_home), new=True)
+                statuses[name] = "added"
+
+        return statuses
+
+    @contextmanager
+    def _connect(self):
+        # sqlite3 is slow to import and is only needed once an environment changes
+        import sqlite3
+        self.registry_file.parent.mkdir(parents=True, exist_ok=True)
+        # The timeout lets concurrent builds wait for each other's updates
+        conn = sqlite3.connect(str(self.registry_file), timeout=self.timeout)
+        try:
+            with conn:
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+                yield conn
+        finally:
+            conn.close()
+
+
+def _read_config(env_home):
+    # A renv.yaml that isn't valid (e.g. after an interrupted write) is reported rather than raised
+    import yaml
+    try:
+        config = utils.read_renv_config(Path(env_home) / "renv.yaml")
+    except yaml.YAMLError:
+        return None
+    return config if isinstance(config, dict) and config.get("R_VERSION") else None
+
+
+def count_packages(library):
+    """
+    Count the packages in a library.
+    :param library:  The path to the package library.
+    :return:  Returns the number of packages.
+    """
+    if not library or not os.path.isdir(str(library)):
+        return 0
+    return sum(1 for pkg in os.listdir(str(library)) if not pkg.startswith("."))
@@ -1,8 +1,25 @@
+import os
+import time
+import shlex
 import click
-from renv import BaseRenvBuilder, get_system_venv
+from pathlib import Path
+from renv.exceptions import RenvError
+from renv.profiling import tracer
+from renv.utils import (activated_environ, format_size, get_env_library, get_system_venv, parse_size,
+                        read_description, read_env_block, read_lockfile, read_renv_config, r_minor_version)
 
 
-@click.group(invoke_without_command=True)
+class RenvGroup(click.Group):
+    """A click group that reports renv's errors as command-line errors."""
+
+    def invoke(self, ctx):
+        try:
+            return super().invoke(ctx)
+        except RenvError as err:
+            raise click.ClickException(str(err))
+
+
+@click.group(cls=RenvGroup, invoke_without_command=True)
 @click.option('--r_home', '-r', default=None,
               help="Provide the root of the directory tree where R is installed ($R_HOME).  This would be R's "
                    "installation directory when using ./configure --prefix=<r_home>.")
@@ -31,14 +48,30 @@ from renv import BaseRenvBuilder, get_system_venv
               help="Provide an alternative prompt prefix for this environment.")
 @click.option('--verbose', '-v', is_flag=True, default=False,
               help="Show verbose cli output.")
+@click.option('--config', '-c', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="A renv.yaml file with the package lists and CRAN mirrors of the environment.")
+@click.option('--first-run', type=click.Choice(["interactive", "declarative"]), default=None,
+              help="Prompt for the renv.yaml package lists in the first R session (interactive) or install them "
+                   "while the environment is built (declarative).")
+@click.option('--relocatable', is_flag=True, default=False,
+              help="Build the environment with relative symlinks and paths that are resolved when it is "
+                   "activated, so it keeps working when it is moved.")
+@click.option('--profile', is_flag=True, default=False,
+              help="Show where renv spent its time when it exits.")
+@click.option('--trace-json', default=None, type=click.Path(dir_okay=False),
+              help="Write a Chrome trace (chrome://tracing) of where renv spent its time to this file.")
 @click.pass_context
 def renv(ctx, r_home, env_name, path, name, bindir, libdir, includedir, recommended_packages, clear,
-         upgrade, prompt, verbose):
+         upgrade, prompt, verbose, config, first_run, relocatable, profile, trace_json):
     ctx.ensure_object(dict)
+    if profile or trace_json:
+        tracer.enable()
+        ctx.call_on_close(lambda: report_profile(profile, trace_json))
     ctx.obj['path'] = path
     ctx.obj['name'] = name
     ctx.obj['env_name'] = env_name
     ctx.obj['r_home'] = r_home
+    ctx.obj['verbose'] = verbose
     if path != "~/.beRi":
         raise NotImplementedError("Renv only supports installing into the home directory at this time.")
 
@@ -47,7 +80,7 @@ def renv(ctx, r_home, env_name, path, name, bindir, libdir, includedir, recommen
         ctx.obj['venvR'] = venvR
         builder = venvR(env_name=env_name, path=path, name=name, r_home=r_home, recommended_packages=recommended_packages,
               clear=clear, upgrade=upgrade, prompt=prompt, verbose=verbose, bindir=bindir, libdir=libdir,
-              rincludedir=includedir)
+              rincludedir=includedir, config_file=config, first_run=first_run, relocatable=relocatable or None)
         env_bin = builder.build_venv()
         click.secho("To activate: source " + env_bin + "/activate", fg="green")
 
@@ -55,5 +88,393 @@ def renv(ctx, r_home, env_name, path, name, bindir, libdir, includedir, recommen
 @renv.command(help="Initialize renv using the <path>/<name>.")
 @click.pass_context
 def init(ctx):
+    from renv.core import BaseRenvBuilder
     # Initialize renv
     BaseRenvBuilder(path=ctx.obj['path'], name=ctx.obj['name'], init=True)
+
+
+@renv.command(help="Clone the <src> environment into a new <dst> environment.")
+@click.argument('src')
+@click.argument('dst')
+@click.option('--prompt', default=None,
+              help="Provide an alternative prompt prefix for the new environment.")
+@click.pass_context
+def clone(ctx, src, dst, prompt):
+    src_home = get_env_home(ctx, src)
+    builder = env_builder(ctx, src, env_name=dst, prompt=prompt)
+    env_bin = builder.clone_venv(src_home)
+    click.secho("To activate: source " + env_bin + "/activate", fg="green")
+
+
+@renv.command(help="Stream the <env_name> environment into a compressed tar archive that renv unpack can "
+                    "create it from on another node or under another prefix.")
+@click.argument('env_name')
+@click.option('--output', '-o', default=None,
+              help="The archive's path, or - for stdout.  [default: <env_name>.tar.gz]")
+@click.option('--compression', type=click.Choice(["gz", "bz2", "xz", "none"]), default=None,
+              help="The archive's compression.  By default it is chosen from the archive's suffix.")
+@click.pass_context
+def pack(ctx, env_name, output, compression):
+    from renv.api import pack as pack_env
+    output = output or "%s.tar.gz" % env_name
+    compression = "" if compression == "none" else compression
+    packed = pack_env(env_name, output, path=ctx.obj['path'], name=ctx.obj['name'], compression=compression)
+    # The archive may be written to stdout
+    click.secho("Packed %s files (%s) of %s into %s" % (packed["files"], format_size(packed["bytes"]), env_name,
+                                                        output), fg="green", err=True)
+
+
+@renv.command(help="Create an environment from an <archive> written by renv pack (- reads stdin).  It is named "
+                   "after the packed environment unless <env_name> is given.")
+@click.argument('archive')
+@click.argument('env_name', required=False)
+@click.pass_context
+def unpack(ctx, archive, env_name):
+    from renv.api import unpack as unpack_env
+    entry = unpack_env(archive, env_name=env_name, path=ctx.obj['path'], name=ctx.obj['name'],
+                       verbose=ctx.obj['verbose'])
+    click.secho("To activate: source " + str(Path(entry["env_home"]) / "bin" / "activate"), fg="green")
+
+
+@renv.command(help="Install packages (by default the renv.yaml package lists) into the environment.")
+@click.argument('packages', nargs=-1)
+@click.option('--jobs', '-j', type=int, default=4, show_default=True,
+              help="The number of packages to install at the same time.")
+@click.option('--retries', type=click.IntRange(min=0), default=2, show_default=True,
+              help="The number of times a failed package installation is retried.")
+@click.pass_context
+def install(ctx, packages, jobs, retries):
+    if not ctx.obj['env_name']:
+        raise click.UsageError("Provide the environment with --env_name.")
+    builder = env_builder(ctx, ctx.obj['env_name'])
+    results = builder.install_packages(pkgs=list(packages) or None, workers=jobs, retries=retries)
+    for pkg, result in sorted(results.items()):
+        color = "green" if result["status"] in ("installed", "linked") else "red"
+        click.secho("%s: %s (%ss)" % (pkg, result["status"], result.get("seconds", 0)), fg=color)
+
+
+@renv.command(help="Record the exact packages installed in the environment in its renv.lock file.")
+@click.option('--jobs', '-j', type=int, default=8, show_default=True,
+              help="The number of packages to hash at the same time.")
+@click.pass_context
+def lock(ctx, jobs):
+    if not ctx.obj['env_name']:
+        raise click.UsageError("Provide the environment with --env_name.")
+    builder = env_builder(ctx, ctx.obj['env_name'])
+    env_lock = builder.lock_venv(workers=jobs)
+    click.secho("Locked %s packages in %s" % (len(env_lock["Packages"]), builder.lock_file), fg="green")
+
+
+@renv.command(help="Recreate the environment from a lockfile (by default its renv.lock).")
+@click.option('--lockfile', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="The renv.lock file to restore from.")
+@click.option('--jobs', '-j', type=int, default=4, show_default=True,
+              help="The number of packages to verify or build at the same time.")
+@click.option('--clean', is_flag=True, default=False,
+              help="Remove the packages that are not in the lockfile.")
+@click.pass_context
+def restore(ctx, lockfile, jobs, clean):
+    env_name = ctx.obj['env_name']
+    if not env_name:
+        raise click.UsageError("Provide the environment with --env_name.")
+    env_home = get_env_home(ctx, env_name)
+    env_lock = read_lockfile(lockfile or env_home / "renv.lock")
+    if (env_home / "renv.yaml").exists():
+        builder = env_builder(ctx, env_name)
+    else:
+        # The environment is created for the locked R installation
+        r_lock = env_lock["R"]
+        venvR = get_system_venv()
+        builder = venvR(env_name=env_name, path=ctx.obj['path'], name=ctx.obj['name'], r_home=r_lock["Home"],
+                        bindir=r_lock.get("BinDir"), libdir=r_lock.get("LibDir"),
+                        recommended_packages=r_lock.get("RecommendedPackages", True), verbose=ctx.obj['verbose'])
+    results = builder.restore_venv(env_lock, workers=jobs, clean=clean)
+    for pkg, result in sorted(results.items()):
+        color = "red" if result["status"] in ("failed", "skipped", "unavailable", "mismatch") else "green"
+        click.secho("%s: %s" % (pkg, result["status"]), fg=color)
+
+
+@renv.command(name="list", help="List the environments in the registry.")
+@click.pass_context
+def list_envs(ctx):
+    entries = get_registry(ctx).list()
+    for entry in entries:
+        click.echo("%-30s R %-8s %5s packages %9s  %s" % (entry["name"], entry["r_version"], entry["packages"],
+                                                         format_size(entry["disk_usage"]), entry["r_home"]))
+    if not entries:
+        click.secho("There are no environments in the registry.", fg="yellow")
+
+
+@renv.command(help="Show the registry entries of environments (all of them by default).")
+@click.argument('env_names', nargs=-1)
+@click.option('--verify', is_flag=True, default=False,
+              help="Check the entries against the filesystem and update the entries that changed.")
+@click.pass_context
+def status(ctx, env_names, verify):
+    registry = get_registry(ctx)
+    statuses = {}
+    if verify:
+        statuses = registry.verify(Path(ctx.obj['path']).expanduser() / ctx.obj['name'] / "cran", names=env_names)
+    entries = {entry["name"]: entry for entry in registry.list() if not env_names or entry["name"] in env_names}
+    for env_name in sorted(set(entries) | set(statuses)):
+        entry = entries.get(env_name)
+        env_status = statuses.get(env_name, "registered")
+        color = "yellow" if env_status in ("removed", "invalid") else "green"
+        click.secho("%s: %s" % (env_name, env_status), fg=color)
+        if entry:
+            click.echo("  R %s (%s)\n  %s packages, %s\n  created %s, updated %s\n  %s" %
+                       (entry["r_version"], entry["r_home"], entry["packages"], format_size(entry["disk_usage"]),
+                        time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["created"])),
+                        time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["updated"])), entry["env_home"]))
+
+
+@renv.command(help="Delete the <env_name> environment.")
+@click.argument('env_name')
+@click.confirmation_option(prompt="Are you sure you want to delete the environment?")
+@click.pass_context
+def remove(ctx, env_name):
+    env_home = get_env_home(ctx, env_name)
+    if (env_home / "renv.yaml").exists():
+        env_builder(ctx, env_name).remove_venv()
+    else:
+        get_registry(ctx).remove(env_name)
+        click.secho("%s is not an R environment." % env_home, fg="yellow")
+
+
+@renv.command(help="Report the disk usage of the environments and reclaim space in <path>/<name>.")
+@click.option('--max-cache-size', default=None,
+              help="Evict the package store entries and downloads that no environment uses (least recently "
+                   "used first) until they fit in this size (e.g. 10G).")
+@click.option('--dedupe/--no-dedupe', default=True, show_default=True,
+              help="Hardlink identical packages that are installed in several environments.")
+@click.option('--remove-orphans', is_flag=True, default=False,
+              help="Delete the directories under the environments directory that aren't registered "
+                   "environments and don't have an environment's layout.")
+@click.option('--dry-run', is_flag=True, default=False,
+              help="Only report what would be reclaimed.")
+@click.option('--jobs', '-j', type=int, default=8, show_default=True,
+              help="The number of directories to scan at the same time.")
+@click.pass_context
+def gc(ctx, max_cache_size, dedupe, remove_orphans, dry_run, jobs):
+    from renv.core import BaseRenvBuilder
+    from renv.gc import GarbageCollector
+    try:
+        max_cache_size = None if max_cache_size is None else parse_size(max_cache_size)
+    except ValueError as err:
+        raise click.BadParameter(str(err), param_hint="--max-cache-size")
+    builder = BaseRenvBuilder(path=ctx.obj['path'], name=ctx.obj['name'], verbose=ctx.obj['verbose'])
+    report = GarbageCollector(builder.renv_path, workers=jobs).collect(
+        max_cache_size=max_cache_size, dedupe=dedupe, remove_orphans=remove_orphans, dry_run=dry_run)
+    for env_name, env_usage in report["envs"].items():
+        notes = []
+        if env_usage["dangling"]:
+            notes.append("%s dangling symlinks" % len(env_usage["dangling"]))
+        if env_usage["orphaned"]:
+            notes.append("orphaned")
+        click.secho("%-30s %9s (%s shared)  %s" % (env_name, format_size(env_usage["usage"]),
+                                                   format_size(env_usage["shared"]), ", ".join(notes)),
+                    fg="yellow" if notes else "green")
+    click.echo("Package store: %s\nDownload cache: %s\nTotal: %s" %
+               (format_size(report["store"]), format_size(report["cache"]), format_size(report["total"])))
+    click.secho("%s %s: pruned %s symlinks, deduplicated %s packages, removed %s orphans and %s temporary files, "
+                "evicted %s cache entries." %
+                ("Would reclaim" if dry_run else "Reclaimed", format_size(report["reclaimed"]), len(report["pruned"]),
+                 len(report["deduped"]), len(report["orphans"]), len(report["tmp"]), len(report["evicted"])),
+                fg="cyan")
+
+
+@renv.command(name="env", help="Print the shell commands that activate the <env_name> environment "
+                               "(e.g. eval \"$(renv env myenv)\").")
+@click.argument('env_name')
+@click.pass_context
+def env(ctx, env_name):
+    env_block = get_env_block(ctx, env_name)
+    lines = ["export %s=%s" % (var, shlex.quote(value)) for var, value in env_block.items()]
+    lines.append('export PATH=%s:"$PATH"' % shlex.quote(str(Path(env_block["VIRTUAL_ENV"]) / "bin")))
+    lines.append("unset PYTHONHOME")
+    click.echo("\n".join(lines))
+
+
+@renv.command(name="exec", context_settings=dict(ignore_unknown_options=True),
+              help="Run a command in the <env_name> environment (e.g. renv exec myenv -- Rscript script.R).")
+@click.argument('env_name')
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+@click.pass_context
+def exec_command(ctx, env_name, command):
+    env_block = get_env_block(ctx, env_name)
+    try:
+        # The command replaces renv, so its exit status is the exit status of renv exec
+        os.execvpe(command[0], list(command), activated_environ(env_block))
+    except OSError as err:
+        raise click.ClickException("Unable to run %s: %s" % (command[0], err))
+
+
+def get_env_home(ctx, env_name):
+    """
+    Get the path to an environment.
+    :param ctx:  The click context.
+    :param env_name:  The name of the environment.
+    :return:  Returns the path to the environment.
+    """
+    from renv.api import env_home
+    return env_home(env_name, path=ctx.obj['path'], name=ctx.obj['name'])
+
+
+def get_registry(ctx):
+    """
+    Get the registry of the environments.
+    :param ctx:  The click context.
+    :return:  Returns the EnvRegistry.
+    """
+    from renv.core import BaseRenvBuilder
+    from renv.registry import EnvRegistry
+    builder = BaseRenvBuilder(path=ctx.obj['path'], name=ctx.obj['name'], verbose=ctx.obj['verbose'])
+    return EnvRegistry(builder.renv_path / "registry.sqlite")
+
+
+def get_env_block(ctx, env_name):
+    """
+    Read the precomputed activation environment of an environment.
+    :param ctx:  The click context.
+    :param env_name:  The name of the environment.
+    :return:  Returns a dictionary of environment variables.
+    """
+    from renv.locks import FileLock, env_lock_file
+    env_home = get_env_home(ctx, env_name)
+    try:
+        # Wait for a build or upgrade of the environment to finish
+        with FileLock(env_lock_file(env_home.parent.parent, env_name)).hold(shared=True):
+            return read_env_block(env_home)
+    except FileNotFoundError:
+        raise click.UsageError("%s has no bin/activate.env. Upgrade the environment using --upgrade." % env_home)
+
+
+def env_builder(ctx, existing_env, **kwargs):
+    """
+    Create the builder of an existing environment from its renv.yaml file.
+    :param ctx:  The click context.
+    :param existing_env:  The name of the existing environment.
+    :param kwargs:  Keyword arguments that override the builder's parameters (e.g. env_name for a clone).
+    :return:  Returns the builder.
+    """
+    from renv.api import env_builder as api_env_builder
+    kwargs.setdefault("verbose", ctx.obj['verbose'])
+    return api_env_builder(existing_env, path=ctx.obj['path'], name=ctx.obj['name'], **kwargs)
+
+
+@renv.command(name="build-many", help="Build the environments in a YAML manifest of env_name, r_home, and "
+                                      "options entries.")
+@click.argument('manifest', type=click.Path(exists=True))
+@click.option('--jobs', '-j', type=int, default=4, show_default=True,
+              help="The number of environments to build at the same time.")
+@click.pass_context
+def build_many(ctx, manifest, jobs):
+    from renv.batch import build_many as build_envs, format_summary, read_manifest
+    start = time.perf_counter()
+    results = build_envs(read_manifest(manifest), path=ctx.obj['path'], name=ctx.obj['name'], workers=jobs,
+                         verbose=ctx.obj['verbose'])
+    failed = [result for result in results if result["status"] != "built"]
+    click.secho(format_summary(results, time.perf_counter() - start), fg="red" if failed else "green")
+    if failed:
+        raise click.ClickException("%s of %s environments failed to build." % (len(failed), len(results)))
+
+
+@renv.group(help="Share installed packages between environments using the <path>/<name>/store package store.")
+@click.pass_context
+def store(ctx):
+    from renv.store import PackageStore
+    if not ctx.obj['env_name']:
+        raise click.UsageError("Provide the environment with --env_name.")
+    env_home = get_env_home(ctx, ctx.obj['env_name'])
+    ctx.obj['env_library'] = get_env_library(env_home)
+    if not ctx.obj['env_library']:
+        raise click.UsageError("%s is not an R environment." % env_home)
+    ctx.obj['store'] = PackageStore(Path(ctx.obj['path']).expanduser() / ctx.obj['name'] / "store")
+
+
+@store.command(help="Move the packages installed in the environment into the package store and link them back.")
+@click.option('--symlink', is_flag=True, default=False,
+              help="Symlink the package directories instead of hardlinking their files.")
+@click.pass_context
+def add(ctx, symlink):
+    stored = ctx.obj['store'].ingest(ctx.obj['env_library'], symlink=symlink)
+    click.secho("%s packages were added to the package store." % len(stored), fg="green")
+
+
+@store.command(help="Install packages from the package store into the environment.")
+@click.argument('packages', nargs=-1, required=True)
+@click.option('--symlink', is_flag=True, default=False,
+              help="Symlink the package directories instead of hardlinking their files.")
+@click.pass_context
+def link(ctx, packages, symlink):
+    # The base package records the version of R the environment was built with
+    base_desc = read_description(Path(ctx.obj['env_library']) / "base")
+    r_minor = r_minor_version(base_desc.get("Built"))
+    linked, missing = ctx.obj['store'].install(packages, ctx.obj['env_library'], r_minor, symlink=symlink)
+    if linked:
+        click.secho("Installed from the package store: %s" % " ".join(linked), fg="green")
+    if missing:
+        click.secho("Not in the package store for R %s: %s" % (r_minor, " ".join(missing)), fg="yellow")
+
+
+@renv.group(name="index", help="Manage the local index of the CRAN mirrors at <path>/<name>/cache/index.sqlite.  "
+                               "The mirrors of the --env_name environment are used by default.")
+@click.option('--repo', multiple=True,
+              help="A CRAN-like repository URL (remote or file://) to use instead.  Can be repeated.")
+@click.pass_context
+def index(ctx, repo):
+    from renv.core import BaseRenvBuilder
+    from renv.index import RepoIndex
+    builder = BaseRenvBuilder(path=ctx.obj['path'], name=ctx.obj['name'], verbose=ctx.obj['verbose'])
+    repos = list(repo) or [builder.cran_mirror, builder.cranextra_mirror]
+    if not repo and ctx.obj['env_name']:
+        config = read_renv_config(get_env_home(ctx, ctx.obj['env_name']) / "renv.yaml")
+        repos = [config.get("CRAN_MIRROR", repos[0]), config.get("CRANEXTRA_MIRROR", repos[1])]
+    ctx.obj['repos'] = repos
+    ctx.obj['index'] = RepoIndex(builder.renv_path / "cache" / "index.sqlite")
+
+
+@index.command(help="Update the local index from the mirrors' PACKAGES files.")
+@click.option('--force', is_flag=True, default=False,
+              help="Check every mirror even if it was checked recently.")
+@click.pass_context
+def refresh(ctx, force):
+    updated = ctx.obj['index'].refresh(ctx.obj['repos'], force=force)
+    for repo, count in updated.items():
+        click.secho("%s: %s" % (repo, "up to date" if count is None else "%s packages" % count), fg="green")
+
+
+@index.command(help="Show the recursive dependencies of packages from the local index.")
+@click.argument('packages', nargs=-1, required=True)
+@click.pass_context
+def deps(ctx, packages):
+    ctx.obj['index'].refresh(ctx.obj['repos'])
+    graph = ctx.obj['index'].resolve(packages, ctx.obj['repos'])
+    for pkg, node in sorted(graph.items()):
+        click.echo("%s %s: %s" % (pkg, node["version"], " ".join(sorted(node["deps"]))))
+    missing = [pkg for pkg in packages if pkg not in graph]
+    if missing:
+        click.secho("Not in the index: %s" % " ".join(missing), fg="yellow")
+
+
+@index.command(help="Write the downloaded packages as a CRAN-like repository in DIRECTORY for offline installs.")
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.pass_context
+def repo(ctx, directory):
+    from renv.cache import DownloadCache
+    directory = Path(directory).expanduser().absolute()
+    downloads = DownloadCache(Path(ctx.obj['path']).expanduser() / ctx.obj['name'] / "cache" / "downloads")
+    count = ctx.obj['index'].write_repo(directory, ctx.obj['repos'], downloads)
+    click.secho("Wrote %s packages.  Use repos=\"%s\" in R." % (count, directory.as_uri()), fg="green")
+
+
+def report_profile(profile, trace_json):
+    """
+    Report where renv spent its time.
+    :param profile:  Print a summary of the spans and counters.
+    :param trace_json:  The path of a Chrome trace file to write.
+    """
+    if profile:
+        click.secho(tracer.summary(), fg="cyan", err=True)
+    if trace_json:
+        tracer.write_chrome_trace(trace_json)
@@ -0,0 +1,260 @@
+import os
+import errno
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+import renv.utils as utils
+from renv.cache import file_digest
+from renv.profiling import tracer
+
+
+class PackageStore(object):
+    """
+The PackageStore class is a content-addressed store of installed R packages
+that is shared by every environment under the .renv root.
+
+Packages are stored as <name>/<version>/R-<major.minor>/<build hash>/<name>
+where the build hash is derived from the package's installed DESCRIPTION file
+(which records the R version, platform, and time it was built).  Environments
+are populated from the store with hardlinks (or symlinks), so a package that
+has already been built on the node never has to be copied or built again.
+"""
+
+    def __init__(self, store_dir):
+        self.logger = logging.getLogger(__name__)
+        self.store_dir = Path(store_dir)
+
+    def key(self, pkg_dir):
+        """
+        Get the store key of an installed package.
+        :param pkg_dir:  The path to the installed package.
+        :return:  Returns a (name, version, R minor version, build hash) tuple or None.
+        """
+        desc_file = Path(pkg_dir) / "DESCRIPTION"
+        desc = utils.read_description(pkg_dir)
+        r_minor = utils.r_minor_version(desc.get("Built"))
+        if not desc.get("Package") or not desc.get("Version") or not r_minor:
+            return None
+        with open(str(desc_file), "rb") as desc_bytes:
+            build_hash = hashlib.sha1(desc_bytes.read()).hexdigest()[:16]
+
+        return desc["Package"], desc["Version"], r_minor, build_hash
+
+    def entry_path(self, key):
+        """
+        Get the path of a store entry.
+        :param key:  A (name, version, R minor version, build hash) tuple.
+        :return:  Returns the path to the stored package.
+        """
+        name, version, r_minor, build_hash = key
+        return self.store_dir / name / version / ("R-%s" % r_minor) / build_hash / name
+
+    def find(self, name, r_minor, version=None):
+        """
+        Find a stored package that was built for an R minor version.
+        :param name:  The name of the package.
+        :param r_minor:  The major.minor version of R (e.g. "3.4").
+        :param version:  The version of the package.  The latest stored version is used by default.
+        :return:  Returns the path to the stored package or None.
+        """
+        pkg_store = self.store_dir / name
+        if version:
+            versions = [version]
+        elif pkg_store.is_dir():
+            versions = sorted(os.listdir(str(pkg_store)), key=_version_key, reverse=True)
+        else:
+            versions = []
+        for pkg_version in versions:
+            builds = pkg_store / pkg_version / ("R-%s" % r_minor)
+            if builds.is_dir():
+                for build_hash in sorted(os.listdir(str(builds))):
+                    entry = builds / build_hash / name
+                    if entry.is_dir():
+                        return entry
+
+    def add(self, pkg_dir):
+        """
+        Copy an installed package into the store if it isn't stored already.
+        :param pkg_dir:  The path to the installed package.
+        :return:  Returns the path to the stored package or None if the package can't be stored.
+        """
+        key = self.key(pkg_dir)
+        if not key:
+            self.logger.warning("%s is not an installed R package and can't be stored." % pkg_dir)
+            return None
+        entry = self.entry_path(key)
+        if entry.exists():
+            return entry
+
+        # Copy into a staging directory so that the entry appears atomically
+        staging = entry.parent.with_name("%s.%s.tmp" % (entry.parent.name, os.getpid()))
+        entry.parent.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            shutil.copytree(str(pkg_dir), str(staging / key[0]), symlinks=True)
+            os.rename(str(staging), str(entry.parent))
+        except OSError:
+            # Another process stored the same package first
+            if not entry.exists():
+                raise
+        finally:
+            if staging.exists():
+                shutil.rmtree(str(staging))
+        self.logger.debug("Stored %s %s for R %s." % key[:3])
+
+        return entry
+
+    def link(self, entry, library, symlink=False):
+        """
+        Install a stored package into a library.
+        :param entry:  The path to the stored package.
+        :param library:  The path to the package library.
+        :param symlink:  Symlink the package directory instead of hardlinking its files.
+        :return:  Returns the path to the installed package.
+        """
+        entry = Path(entry)
+        pkg_dir = Path(library) / entry.name
+        _link_entry(entry, pkg_dir, symlink)
+        self.logger.debug("Linked %s from the package store." % pkg_dir)
+
+        return pkg_dir
+
+    def install(self, pkgs, library, r_minor, symlink=False):
+        """
+        Install packages from the store into a library.  Packages that are already installed are skipped.
+        :param pkgs:  A list of package names.
+        :param library:  The path to the package library.
+        :param r_minor:  The major.minor version of the library's R (e.g. "3.4").
+        :param symlink:  Symlink the package directories instead of hardlinking their files.
+        :return:  Returns a tuple with a list of the linked packages and a list of the packages not in the store.
+        """
+        linked = []
+        missing = []
+        for pkg in pkgs:
+            if (Path(library) / pkg).exists():
+                continue
+            entry = self.find(pkg, r_minor)
+            if entry:
+                self.link(entry, library, symlink=symlink)
+                linked.append(pkg)
+            else:
+                missing.append(pkg)
+
+        return linked, missing
+
+    def ingest(self, library, symlink=False):
+        """
+        Move the packages installed in a library into the store and replace them with links.
+        :param library:  The path to the package library.
+        :param symlink:  Symlink the package directories instead of hardlinking their files.
+        :return:  Returns a list of the names of the packages that were stored.
+        """
+        stored = []
+        for pkg in sorted(os.listdir(str(library))):
+            pkg_dir = Path(library) / pkg
+            # Symlinks point at the system R or at the store already
+            if pkg_dir.is_symlink() or not (pkg_dir / "DESCRIPTION").is_file():
+                continue
+            if self.ingest_package(pkg_dir, symlink=symlink):
+                stored.append(pkg)
+
+        return stored
+
+    def ingest_package(self, pkg_dir, symlink=False):
+        """
+        Move an installed package into the store and replace it with a link to the stored package.
+        :param pkg_dir:  The path to the installed package.
+        :param symlink:  Symlink the package directory instead of hardlinking its files.
+        :return:  Returns the path to the stored package, or None if the package can't be stored or
+                  is already linked from the store.
+        """
+        pkg_dir = Path(pkg_dir)
+        entry = self.add(pkg_dir)
+        if not entry or os.path.samefile(str(pkg_dir / "DESCRIPTION"), str(entry / "DESCRIPTION")):
+            return None
+        # Link next to the package first so that it is never missing from the library.  The names
+        # include the pid so that they don't collide with a .<pkg>.old kept while it is reinstalled.
+        new_dir = pkg_dir.with_name(".%s~%s.new" % (pkg_dir.name, os.getpid()))
+        old_dir = pkg_dir.with_name(".%s~%s.old" % (pkg_dir.name, os.getpid()))
+        try:
+            _link_entry(entry, new_dir, symlink)
+            os.rename(str(pkg_dir), str(old_dir))
+            os.rename(str(new_dir), str(pkg_dir))
+        finally:
+            if new_dir.is_symlink():
+                new_dir.unlink()
+            elif new_dir.exists():
+                shutil.rmtree(str(new_dir))
+        shutil.rmtree(str(old_dir))
+
+        return entry
+
+
+def tree_hash(pkg_dir):
+    """
+    Hash an installed package from the relative paths and contents of its files and the targets of its symlinks.
+    :param pkg_dir:  The path to the installed package.
+    :return:  Returns the hash as "sha256:<hex digest>".
+    """
+    pkg_dir = str(pkg_dir)
+    entries = []
+    for root, dirs, files in os.walk(pkg_dir):
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, pkg_dir)
+            if os.path.islink(path):
+                entries.append("%s -> %s" % (rel_path, os.readlink(path)))
+            else:
+                entries.append("%s %s" % (rel_path, file_digest(path, "sha256")))
+
+    return "sha256:%s" % hashlib.sha256("\n".join(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+def link_tree(src, dst):
+    """
+    Recreate a directory tree with hardlinks to its files.  Files are copied when
+    hardlinks aren't possible (e.g. across filesystems).
+    :param src:  The source directory.
+    :param dst:  The destination directory, which must not exist.
+    """
+    src = str(src)
+    dst = str(dst)
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.mkdir(dst_root)
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            src_file = os.path.join(root, name)
+            dst_file = os.path.join(dst_root, name)
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), dst_file)
+            else:
+                link_file(src_file, dst_file)
+
+
+def link_file(src, dst):
+    """
+    Hardlink a file, or copy it when a hardlink isn't possible (e.g. across filesystems).
+    :param src:  The source file.
+    :param dst:  The destination file, which must not exist.
+    """
+    try:
+        os.link(str(src), str(dst))
+        tracer.count("syscalls.link")
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(str(src), str(dst))
+        tracer.count("bytes_written", os.path.getsize(str(dst)))
+
+
+def _link_entry(entry, pkg_dir, symlink):
+    if symlink:
+        os.symlink(str(entry), str(pkg_dir))
+    else:
+        link_tree(entry, pkg_dir)
+
+
+def _version_key(version):
+    # Sort package versions (e.g. 1.10-2 > 1.9-3) numerically
+    return [int(part) if part.isdigit() else 0 for part in version.replace("-", ".").split(".")]
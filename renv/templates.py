@@ -0,0 +1,110 @@
+import os
+import re
+import json
+import hashlib
+import logging
+
+from renv.profiling import tracer
+
+logger = logging.getLogger(__name__)
+
+# Matches the cookiecutter variables used in the templates (e.g. {{cookiecutter.__VENV_DIR__}})
+_VARIABLE = re.compile(r"{{\s*cookiecutter\.(\w+)\s*}}")
+
+# Compiled templates keyed by the hash of their template directory
+_TEMPLATE_CACHE = {}
+
+
+class TemplateSet(object):
+    """
+The TemplateSet class compiles the files of a cookiecutter template directory
+once so that they can be rendered straight to their final paths without
+running cookiecutter.
+
+Only plain variable substitution ({{cookiecutter.<name>}}) is supported, which
+is all the renv templates use.  Variables that are missing from the rendering
+context fall back to the defaults in the template's cookiecutter.json.
+"""
+
+    def __init__(self, cookie_dir):
+        self.cookie_dir = str(cookie_dir)
+        with open(os.path.join(self.cookie_dir, "cookiecutter.json")) as cookie_json:
+            self.defaults = json.load(cookie_json)
+        self.templates = {}
+        template_dir = _template_dir(self.cookie_dir)
+        for filename in sorted(os.listdir(template_dir)):
+            template_file = os.path.join(template_dir, filename)
+            with open(template_file) as template:
+                # Even indexes hold literal text and odd indexes hold variable names
+                parts = _VARIABLE.split(template.read())
+            self.templates[filename] = (parts, os.stat(template_file).st_mode & 0o777)
+
+    def render(self, filename, context):
+        """
+        Render a single template.
+        :param filename:  The name of the template file.
+        :param context:  A dictionary of the template variables.
+        :return:  Returns the rendered text.
+        """
+        parts = list(self.templates[filename][0])
+        for i in range(1, len(parts), 2):
+            parts[i] = str(context.get(parts[i], self.defaults.get(parts[i], "")))
+        return "".join(parts)
+
+    def write(self, context, output_files, overrides=None):
+        """
+        Render every template to its final path.
+        :param context:  A dictionary of the template variables.
+        :param output_files:  A dictionary of template file names to output paths.
+        :param overrides:  A dictionary of template file names to the variables that differ for that file.
+        """
+        for filename, (parts, mode) in self.templates.items():
+            output_file = str(output_files[filename])
+            file_context = dict(context, **overrides[filename]) if overrides and filename in overrides else context
+            text = self.render(filename, file_context)
+            with open(output_file, "w") as rendered:
+                rendered.write(text)
+            os.chmod(output_file, mode)
+            tracer.count("syscalls.write")
+            tracer.count("syscalls.chmod")
+            tracer.count("bytes_written", len(text.encode()))
+            logger.debug(output_file)
+
+
+def get_templates(cookie_dir):
+    """
+    Get the compiled templates of a cookiecutter template directory.  Templates are
+    only compiled again when the template directory has changed.
+    :param cookie_dir:  The path to the cookiecutter template directory.
+    :return:  Returns a TemplateSet.
+    """
+    key = template_dir_hash(cookie_dir)
+    if key not in _TEMPLATE_CACHE:
+        logger.debug("Compiling the templates in %s" % cookie_dir)
+        _TEMPLATE_CACHE[key] = TemplateSet(cookie_dir)
+    return _TEMPLATE_CACHE[key]
+
+
+def template_dir_hash(cookie_dir):
+    """
+    Hash the names, sizes and modification times of the files in a cookiecutter template directory.
+    :param cookie_dir:  The path to the cookiecutter template directory.
+    :return:  Returns a hex digest.
+    """
+    cookie_dir = str(cookie_dir)
+    template_dir = _template_dir(cookie_dir)
+    dir_hash = hashlib.sha1(cookie_dir.encode())
+    paths = [os.path.join(cookie_dir, "cookiecutter.json")]
+    paths.extend(os.path.join(template_dir, filename) for filename in sorted(os.listdir(template_dir)))
+    for path in paths:
+        st = os.stat(path)
+        dir_hash.update(("%s:%s:%s;" % (path, st.st_size, st.st_mtime_ns)).encode())
+    return dir_hash.hexdigest()
+
+
+def _template_dir(cookie_dir):
+    # cookiecutter templates have a single templated directory (e.g. {{cookiecutter.dirname}})
+    for filename in os.listdir(cookie_dir):
+        if filename.startswith("{{"):
+            return os.path.join(cookie_dir, filename)
+    raise FileNotFoundError("No template directory was found in %s" % cookie_dir)
@@ -1,13 +1,30 @@
 import os
+import re
 import sys
+import json
 import subprocess as sp
 from shutil import rmtree
 from subprocess import TimeoutExpired
 import renv
 import logging
+from renv.exceptions import RInstallationError
+from renv.profiling import tracer
 
 logger = logging.getLogger(__name__)
 
+# A single R expression that writes every field needed by the builders as tab delimited records.
+_R_PROBE_EXPR = (
+    'caps <- capabilities(); '
+    'pkgs <- utils::installed.packages(lib.loc=.Library); '
+    'writeLines(c('
+    'paste("major", R.version$major, sep="\\t"), '
+    'paste("minor", R.version$minor, sep="\\t"), '
+    'paste("r_home", R.home(), sep="\\t"), '
+    'paste("platform", R.version$platform, sep="\\t"), '
+    'paste("capability", names(caps), caps, sep="\\t"), '
+    'paste("package", pkgs[, "Package"], pkgs[, "Version"], pkgs[, "Priority"], sep="\\t")))'
+)
+
 
 def get_system_venv():
     if os.name == "posix":
@@ -130,17 +147,315 @@ def system_r_call(rcmd_type, rscript):
     elif rcmd_type == "recommended":
         rcmd = "%s -e \'base::cat(rownames(installed.packages(priority=\"recommended\")))\'" % rscript
 
-    recommended_pkgs = sp.Popen([rcmd], stderr=sp.PIPE, stdout=sp.PIPE, shell=True, encoding='utf-8')
+    with tracer.span("system_r_call", category="subprocess", rcmd_type=rcmd_type, rscript=rscript):
+        recommended_pkgs = sp.Popen([rcmd], stderr=sp.PIPE, stdout=sp.PIPE, shell=True, encoding='utf-8')
 
-    try:
-        stdout, stderr = recommended_pkgs.communicate(timeout=15)
-    except TimeoutExpired:
-        recommended_pkgs.kill()
-        stdout, stderr = recommended_pkgs.communicate()
+        try:
+            stdout, stderr = recommended_pkgs.communicate(timeout=15)
+        except TimeoutExpired:
+            recommended_pkgs.kill()
+            stdout, stderr = recommended_pkgs.communicate()
 
     return stdout, stderr
 
 
+def system_r_probe(rscript):
+    """
+    Call the current R once with a system call in order to obtain all of the
+    information the builders need about an R installation.
+    :param rscript:  The absolute path to the desired Rscript exe.
+    :return:  Returns a dictionary with the version, R_HOME, platform,
+    capabilities, and installed packages (with their priority and version).
+    :raises RInstallationError:  Raised when Rscript is missing or the probe fails.
+    """
+    with tracer.span("system_r_call", category="subprocess", rcmd_type="probe", rscript=rscript):
+        try:
+            probe = sp.Popen([rscript, "--vanilla", "-e", _R_PROBE_EXPR], stderr=sp.PIPE, stdout=sp.PIPE,
+                             encoding='utf-8')
+        except OSError as err:
+            raise RInstallationError("Unable to run %s: %s" % (rscript, err.strerror or err))
+
+        try:
+            stdout, stderr = probe.communicate(timeout=15)
+        except TimeoutExpired:
+            probe.kill()
+            stdout, stderr = probe.communicate()
+    if probe.returncode:
+        raise RInstallationError("The R probe failed using %s (exit status %s): %s" %
+                                 (rscript, probe.returncode, stderr.strip()))
+
+    r_info = parse_r_probe(stdout)
+    if not r_info["major"]:
+        raise RInstallationError("The R probe using %s did not report the R version." % rscript)
+    return r_info
+
+
+def parse_r_probe(stdout):
+    """
+    Parse the tab delimited output of the R probe into a dictionary.
+    :param stdout:  The stdout of the R probe system call.
+    :return:  Returns the R probe dictionary.
+    """
+    r_info = {"major": "", "minor": "", "version": "", "r_home": "", "platform": "",
+              "capabilities": {}, "packages": {}}
+    for line in stdout.splitlines():
+        fields = line.split("\t")
+        if fields[0] in ("major", "minor", "r_home", "platform") and len(fields) == 2:
+            r_info[fields[0]] = fields[1]
+        elif fields[0] == "capability" and len(fields) == 3:
+            r_info["capabilities"][fields[1]] = fields[2] == "TRUE"
+        elif fields[0] == "package" and len(fields) == 4 and fields[1]:
+            r_info["packages"][fields[1]] = {"version": fields[2], "priority": fields[3]}
+    r_info["version"] = "%s.%s" % (r_info["major"], r_info["minor"])
+
+    return r_info
+
+
+def r_packages_by_priority(r_info, priority):
+    """
+    Get the names of the installed packages with a specific priority.
+    :param r_info:  The R probe dictionary.
+    :param priority:  The package priority (e.g. "base" or "recommended").
+    :return:  Returns a sorted list of package names.
+    """
+    return sorted(pkg for pkg, desc in r_info["packages"].items() if desc["priority"] == priority)
+
+
+def parse_dcf(text):
+    """
+    Parse text in R's Debian Control File format (e.g. DESCRIPTION or PACKAGES files).
+    :param text:  The contents of the DCF file.
+    :return:  Returns a list with a dictionary for each record.
+    """
+    records = []
+    record = {}
+    field = None
+    for line in text.splitlines():
+        if not line.strip():
+            if record:
+                records.append(record)
+            record = {}
+            field = None
+        elif line[0] in " \t" and field:
+            # Continuation lines belong to the previous field
+            record[field] = "%s %s" % (record[field], line.strip())
+        elif ":" in line:
+            field, value = line.split(":", 1)
+            record[field] = value.strip()
+    if record:
+        records.append(record)
+
+    return records
+
+
+def parse_dependencies(field):
+    """
+    Parse the package names from a DESCRIPTION dependency field (e.g. Depends or Imports).
+    :param field:  The value of the field (e.g. "R (>= 3.0.0), methods, Rcpp (>= 0.12)").
+    :return:  Returns a list of package names without R itself.
+    """
+    pkgs = []
+    for dep in (field or "").split(","):
+        pkg = dep.split("(")[0].strip()
+        if pkg and pkg != "R":
+            pkgs.append(pkg)
+
+    return pkgs
+
+
+def read_description(pkg_dir):
+    """
+    Read the DESCRIPTION file of an installed R package.
+    :param pkg_dir:  The path to the installed package.
+    :return:  Returns a dictionary of the DESCRIPTION fields or an empty dictionary.
+    """
+    try:
+        with open(os.path.join(str(pkg_dir), "DESCRIPTION"), encoding="utf-8", errors="replace") as desc:
+            records = parse_dcf(desc.read())
+    except OSError:
+        return {}
+
+    return records[0] if records else {}
+
+
+def r_minor_version(version):
+    """
+    Get the major.minor part of an R version.  R packages must be rebuilt when this changes.
+    :param version:  An R version (e.g. "3.4.4") or a DESCRIPTION Built field (e.g. "R 3.4.4; ...").
+    :return:  Returns the major.minor version (e.g. "3.4") or None.
+    """
+    match = re.search(r"(\d+)\.(\d+)", version or "")
+    if match:
+        return "%s.%s" % match.groups()
+
+
+def get_env_library(env_home):
+    """
+    Get the package library of an existing R environment.
+    :param env_home:  The path to the R environment.
+    :return:  Returns the path to the environment's library or None.
+    """
+    for libnn in ("lib64", "lib"):
+        env_library = os.path.join(str(env_home), libnn, "R", "library")
+        if os.path.isdir(env_library):
+            return env_library
+
+
+def link_target(link):
+    """
+    Get the absolute target of a symlink, whether the symlink is absolute or relative.
+    :param link:  The path of the symlink.
+    :return:  Returns the normalized absolute path the symlink points to.
+    """
+    link = str(link)
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(link)), os.readlink(link)))
+
+
+def relative_link(target, link):
+    """
+    Get the relative target of a symlink, so that it keeps working when the tree it is in is moved.
+    :param target:  The absolute path the symlink points to.
+    :param link:  The absolute path of the symlink.
+    :return:  Returns the target relative to the symlink's directory.
+    """
+    return os.path.relpath(str(target), os.path.dirname(str(link)))
+
+
+def disk_usage(path):
+    """
+    Get the disk usage of a directory tree.  Symlinks aren't followed and hardlinked files are only counted once.
+    :param path:  The path to the directory.
+    :return:  Returns the number of bytes used.
+    """
+    seen = set()
+    usage = 0
+    for root, dirs, files in os.walk(str(path)):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                usage += st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+
+    return usage
+
+
+def format_size(size):
+    """
+    Format a number of bytes for people (e.g. 1.5G).
+    :param size:  The number of bytes.
+    :return:  Returns the formatted size.
+    """
+    for unit in ("B", "K", "M", "G", "T"):
+        if abs(size) < 1024 or unit == "T":
+            return "%.1f%s" % (size, unit) if unit != "B" else "%d%s" % (size, unit)
+        size /= 1024.0
+
+
+def parse_size(size):
+    """
+    Parse a size for people (e.g. 10G or 512M) into a number of bytes.
+    :param size:  The size with an optional B, K, M, G, or T unit.
+    :return:  Returns the number of bytes.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([BKMGT]?)B?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("%s is not a size (e.g. 10G)." % size)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "BKMGT".index(unit.upper() or "B"))
+
+
+def read_renv_config(cfg_file):
+    """
+    Read an environment's renv.yaml configuration file.
+    :param cfg_file:  The path to the renv.yaml file.
+    :return:  Returns the configuration dictionary or an empty dictionary if there isn't one.
+    """
+    import yaml
+    try:
+        with open(str(cfg_file)) as cfg:
+            return yaml.safe_load(cfg) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def write_renv_config(cfg_file, config):
+    """
+    Write an environment's renv.yaml configuration file.
+    :param cfg_file:  The path to the renv.yaml file.
+    :param config:  The configuration dictionary.
+    """
+    import yaml
+    with open(str(cfg_file), "w") as cfg:
+        yaml.safe_dump(config, cfg, default_flow_style=False)
+
+
+def read_lockfile(lock_file):
+    """
+    Read an environment's renv.lock file.
+    :param lock_file:  The path to the renv.lock file.
+    :return:  Returns the lock dictionary with the R installation and the locked packages.
+    """
+    with open(str(lock_file)) as lock:
+        return json.load(lock)
+
+
+def write_lockfile(lock_file, lock):
+    """
+    Write an environment's renv.lock file.
+    :param lock_file:  The path to the renv.lock file.
+    :param lock:  The lock dictionary.
+    """
+    with open(str(lock_file), "w") as lock_json:
+        json.dump(lock, lock_json, indent=2, sort_keys=True)
+        lock_json.write("\n")
+
+
+def read_env_block(env_home):
+    """
+    Read the precomputed activation environment (bin/activate.env) of an R environment.
+    :param env_home:  The path to the R environment.
+    :return:  Returns a dictionary of environment variables.
+    """
+    env_block = {}
+    # Relocatable environments refer to their own paths with ${VIRTUAL_ENV}
+    virtual_env = os.path.abspath(str(env_home))
+    with open(os.path.join(str(env_home), "bin", "activate.env")) as env_file:
+        for line in env_file:
+            if "=" in line and not line.startswith("#"):
+                var, value = line.rstrip("\n").split("=", 1)
+                env_block[var] = value.replace("${VIRTUAL_ENV}", virtual_env)
+
+    return env_block
+
+
+def activated_environ(env_block, environ=None):
+    """
+    Get the process environment of an activated R environment.  This is what sourcing bin/activate does.
+    :param env_block:  The activation environment from read_env_block.
+    :param environ:  The process environment to start from.  The current environment is used by default.
+    :return:  Returns a dictionary of environment variables.
+    """
+    environ = dict(os.environ if environ is None else environ)
+    environ.update(env_block)
+    environ["PATH"] = os.path.join(env_block["VIRTUAL_ENV"], "bin") + os.pathsep + environ.get("PATH", "")
+    environ.pop("PYTHONHOME", None)
+
+    return environ
+
+
+def get_pkg_names(config_dict):
+    """
+    Get the names of the R packages in the package lists of the YAML configuration.
+    :param config_dict:  The configuration dictionary created with the YAML file.
+    :return:  Returns a list of package names.
+    """
+    pkg_names = []
+    for list_name in sorted(k for k in config_dict if "PKG_LIST" in k):
+        pkg_names.extend(pkg for pkg in config_dict[list_name] or {} if pkg not in pkg_names)
+
+    return pkg_names
+
+
 def format_pkg_list(config_dict):
     """
     Takes the YAML configuration information and parses/formats the R
@@ -0,0 +1,58 @@
+import pytest
+
+from benchmarks.fake_r import make_fake_r
+
+
+@pytest.fixture
+def renv_home(tmp_path, monkeypatch):
+    """An initialized ~/.beRi/.renv root in a temporary home directory."""
+    home = tmp_path / "home"
+    monkeypatch.setenv("HOME", str(home))
+    renv_path = home / ".beRi" / ".renv"
+    (renv_path / "cran").mkdir(parents=True)
+    return renv_path
+
+
+@pytest.fixture
+def fake_r(tmp_path):
+    """A synthetic R installation (see benchmarks/fake_r.py)."""
+    return make_fake_r(tmp_path / "R-3.4.4", n_packages=5, n_recommended=3, n_etc=3)
+
+
+def make_local_cran(repo_dir, packages):
+    """
+    Create a file:// CRAN-like repository with a PACKAGES index and a source tarball for each package.
+    :param repo_dir:  The directory of the repository.
+    :param packages:  A dictionary of package names to (version, list of dependencies).
+    :return:  Returns the repository's file:// URL.
+    """
+    import io
+    import gzip
+    import hashlib
+    import tarfile
+    contrib = repo_dir / "src" / "contrib"
+    contrib.mkdir(parents=True)
+    records = []
+    for pkg, (version, deps) in sorted(packages.items()):
+        desc = "Package: %s\nVersion: %s\n" % (pkg, version)
+        if deps:
+            desc += "Imports: %s\n" % ", ".join(deps)
+        pkg_file = contrib / ("%s_%s.tar.gz" % (pkg, version))
+        with tarfile.open(str(pkg_file), "w:gz") as tar:
+            for name, text in (("DESCRIPTION", desc), ("R/%s" % pkg, "# %s\n" % pkg)):
+                data = text.encode()
+                info = tarfile.TarInfo("%s/%s" % (pkg, name))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        records.append(desc + "MD5sum: %s\n" % hashlib.md5(pkg_file.read_bytes()).hexdigest())
+    text = "\n".join(records)
+    (contrib / "PACKAGES").write_text(text)
+    (contrib / "PACKAGES.gz").write_bytes(gzip.compress(text.encode()))
+    return "file://%s" % repo_dir
+
+
+@pytest.fixture
+def local_cran(tmp_path):
+    """A file:// CRAN mirror stand-in where pkgB imports pkgA and pkgC imports pkgB."""
+    return make_local_cran(tmp_path / "cran", {"pkgA": ("1.0", []), "pkgB": ("2.1", ["pkgA"]),
+                                               "pkgC": ("0.3", ["pkgB"])})
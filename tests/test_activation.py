@@ -0,0 +1,56 @@
+import os
+import sys
+import subprocess as sp
+
+from click.testing import CliRunner
+
+import renv.api as api
+from renv.renv import renv
+
+# renv exec replaces the process, so it's run in a subprocess
+_RENV = [sys.executable, "-c", "from renv.renv import renv; renv()"]
+
+
+def _renv(*args):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return sp.run(_RENV + list(args), stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, env=env)
+
+
+def test_env(renv_home, fake_r):
+    env_home = api.env_home(api.create("e1", str(fake_r))["name"])
+    library = env_home / "lib64" / "R" / "library"
+    result = CliRunner().invoke(renv, ["env", "e1"])
+    assert result.exit_code == 0, result.output
+    lines = result.stdout.splitlines()
+    assert "export VIRTUAL_ENV=%s" % env_home in lines
+    assert "export R_LIBS=%s" % library in lines
+    assert "export R_LIBS_USER=%s" % library in lines
+    assert 'export PATH=%s:"$PATH"' % (env_home / "bin") in lines
+
+    # The output activates the environment in a shell
+    proc = sp.run(["sh", "-c", 'eval "$1" && echo "$R_LIBS_USER" && command -v Rscript', "sh", result.stdout],
+                  stdout=sp.PIPE, universal_newlines=True)
+    assert proc.stdout.splitlines() == [str(library), str(env_home / "bin" / "Rscript")]
+
+
+def test_env_missing_activation_block(renv_home, fake_r):
+    env_home = api.env_home(api.create("e1", str(fake_r))["name"])
+    (env_home / "bin" / "activate.env").unlink()
+    result = CliRunner().invoke(renv, ["env", "e1"])
+    assert result.exit_code == 2
+    assert "--upgrade" in result.output
+
+
+def test_exec(renv_home, fake_r):
+    env_home = api.env_home(api.create("e1", str(fake_r))["name"])
+    proc = _renv("exec", "e1", "--", "sh", "-c", 'echo "$VIRTUAL_ENV"; echo "$R_LIBS_USER"; exit 3')
+    assert proc.returncode == 3, proc.stderr
+    assert proc.stdout.splitlines() == [str(env_home), str(env_home / "lib64" / "R" / "library")]
+
+    # Options after -- belong to the command
+    proc = _renv("exec", "e1", "--", "Rscript", "-e", "R.version$major")
+    assert (proc.returncode, proc.stdout.strip()) == (0, '[1] "3"')
+
+    proc = _renv("exec", "e1", "--", "no-such-command")
+    assert proc.returncode == 1
+    assert "Unable to run no-such-command" in proc.stderr
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import renv.api as api
+from renv.exceptions import EnvExistsError, EnvNotFoundError, RenvError, RInstallationError
+
+
+def _run(coroutine):
+    # asyncio.run is new in Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_create_get_remove(renv_home, fake_r):
+    entry = api.create("e1", str(fake_r))
+    assert entry == api.get("e1")
+    assert entry["r_version"] == "3.4.4"
+    assert [env["name"] for env in api.list()] == ["e1"]
+    api.remove("e1")
+    assert not (renv_home / "cran" / "e1").exists()
+    with pytest.raises(EnvNotFoundError):
+        api.get("e1")
+
+
+def test_typed_errors(renv_home, fake_r, tmp_path):
+    api.create("e1", str(fake_r))
+    with pytest.raises(EnvExistsError):
+        api.clone("e1", "e1")
+    with pytest.raises(EnvNotFoundError):
+        api.env_builder("missing")
+    with pytest.raises(RInstallationError):
+        api.create("e2", str(tmp_path / "no-R"))
+    # The typed errors are also the builtin errors they correspond to
+    assert issubclass(RInstallationError, FileNotFoundError) and issubclass(RInstallationError, RenvError)
+
+
+def test_async_variants(renv_home, fake_r):
+    names = ["e%s" % i for i in range(8)]
+
+    async def create_all():
+        return await asyncio.gather(*(api.create_async(name, str(fake_r)) for name in names))
+
+    entries = _run(create_all())
+    assert sorted(entry["name"] for entry in entries) == names
+    clone = _run(api.clone_async("e0", "copy"))
+    assert clone["name"] == "copy"
+    assert len(_run(api.list_async())) == len(names) + 1
+    _run(api.remove_async("copy"))
+    with pytest.raises(EnvNotFoundError):
+        _run(api.get_async("copy"))
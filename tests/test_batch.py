@@ -0,0 +1,51 @@
+import pytest
+from click.testing import CliRunner
+
+import renv.api as api
+from renv.batch import build_many, format_summary, read_manifest
+from renv.renv import renv
+
+
+@pytest.fixture
+def manifest(tmp_path, fake_r):
+    manifest_file = tmp_path / "manifest.yaml"
+    manifest_file.write_text("environments:\n"
+                             "  - env_name: good\n"
+                             "    r_home: %s\n"
+                             "    options:\n"
+                             "      recommended_packages: false\n"
+                             "  - env_name: bad\n"
+                             "    r_home: %s\n" % (fake_r, tmp_path / "no-R"))
+    return manifest_file
+
+
+def test_read_manifest(tmp_path, fake_r, manifest):
+    assert read_manifest(manifest) == [
+        {"env_name": "good", "r_home": str(fake_r), "recommended_packages": False},
+        {"env_name": "bad", "r_home": str(tmp_path / "no-R")}]
+    invalid = tmp_path / "invalid.yaml"
+    invalid.write_text("- env_name: no_r_home\n")
+    with pytest.raises(ValueError):
+        read_manifest(invalid)
+
+
+def test_build_many(renv_home, manifest):
+    results = build_many(read_manifest(manifest), path=str(renv_home.parent), name=renv_home.name, workers=2)
+    statuses = {result["env_name"]: result["status"] for result in results}
+    assert statuses == {"good": "built", "bad": "failed"}
+    assert [result["error"] for result in results if result["env_name"] == "bad"][0]
+    assert not (api.env_home("good") / "lib64" / "R" / "library" / "recommended0").exists()
+    assert "Built 1 of 2 environments" in format_summary(results, 1.0)
+
+
+def test_build_many_command(tmp_path, renv_home, fake_r, manifest):
+    result = CliRunner().invoke(renv, ["build-many", str(manifest), "--jobs", "2"])
+    assert result.exit_code == 1
+    assert "1 of 2 environments failed to build" in result.output
+    assert [entry["name"] for entry in api.list()] == ["good"]
+
+    good = tmp_path / "good.yaml"
+    good.write_text("- env_name: other\n  r_home: %s\n" % fake_r)
+    result = CliRunner().invoke(renv, ["build-many", str(good)])
+    assert result.exit_code == 0, result.output
+    assert "Built 1 of 1 environments" in result.output
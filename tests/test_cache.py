@@ -0,0 +1,34 @@
+import os
+
+from renv.cache import RInstallCache
+
+
+def test_r_install_cache(tmp_path, fake_r):
+    cache = RInstallCache(tmp_path / "cache")
+    rscript = fake_r / "bin" / "Rscript"
+    rlibrary = fake_r / "lib64" / "R" / "library"
+    assert cache.get(fake_r, rscript, rlibrary) is None
+    cache.set(fake_r, rscript, rlibrary, {"version": "3.4.4"})
+    assert cache.get(fake_r, rscript, rlibrary) == {"version": "3.4.4"}
+
+    # Changing the Rscript executable invalidates the entry
+    st = os.stat(str(rscript))
+    os.utime(str(rscript), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert cache.get(fake_r, rscript, rlibrary) is None
+
+
+def test_r_install_cache_keys_include_rscript(tmp_path, fake_r):
+    cache = RInstallCache(tmp_path / "cache")
+    rscript = fake_r / "bin" / "Rscript"
+    rlibrary = fake_r / "lib64" / "R" / "library"
+    other_bindir = tmp_path / "wrapper" / "bin"
+    other_bindir.mkdir(parents=True)
+    other_rscript = other_bindir / "Rscript"
+    other_rscript.write_text(rscript.read_text())
+
+    cache.set(fake_r, rscript, rlibrary, {"version": "3.4.4"})
+    # The same R_HOME probed through another Rscript has its own entry
+    assert cache.get(fake_r, other_rscript, rlibrary) is None
+    cache.set(fake_r, other_rscript, rlibrary, {"version": "3.5.0"})
+    assert cache.get(fake_r, rscript, rlibrary) == {"version": "3.4.4"}
+    assert cache.get(fake_r, other_rscript, rlibrary) == {"version": "3.5.0"}
@@ -0,0 +1,23 @@
+from click.testing import CliRunner
+
+import renv.api as api
+from renv.renv import renv
+
+
+def test_clone(renv_home, fake_r):
+    api.create("e1", str(fake_r))
+    result = CliRunner().invoke(renv, ["clone", "e1", "e3"])
+    assert result.exit_code == 0, result.output
+    assert "To activate" in result.output
+    e3_home = renv_home / "cran" / "e3"
+    assert (e3_home / "renv.yaml").is_file()
+    assert str(e3_home) in (e3_home / "bin" / "activate").read_text()
+    assert api.get("e3")["env_home"] == str(e3_home)
+
+
+def test_clone_existing_env(renv_home, fake_r):
+    api.create("e1", str(fake_r))
+    api.create("e3", str(fake_r))
+    result = CliRunner().invoke(renv, ["clone", "e1", "e3"])
+    assert result.exit_code == 1
+    assert "already exists" in result.output
@@ -0,0 +1,120 @@
+import os
+import time
+
+import pytest
+
+import renv.api as api
+from renv.gc import GarbageCollector
+from renv.locks import FileLock, env_lock_file
+from renv.registry import EnvRegistry
+from renv.store import PackageStore
+
+
+def _install_copy(library, pkg, code="# code\n"):
+    # An installed package as R would leave it: a real directory with its own files
+    pkg_dir = library / pkg
+    (pkg_dir / "R").mkdir(parents=True)
+    (pkg_dir / "DESCRIPTION").write_text("Package: %s\nVersion: 1.0\nBuilt: R 3.4.4; ; ; unix\n" % pkg)
+    (pkg_dir / "R" / pkg).write_text(code * 1000)
+    return pkg_dir
+
+
+@pytest.fixture
+def envs(renv_home, fake_r):
+    libraries = []
+    for env_name in ("e1", "e2", "e3"):
+        env_home = api.env_home(api.create(env_name, str(fake_r))["name"])
+        libraries.append(env_home / "lib64" / "R" / "library")
+    for library in libraries:
+        _install_copy(library, "pkgA")
+    # Same DESCRIPTION (so the same store key) but different files
+    _install_copy(libraries[2], "pkgB", code="# other code\n")
+    _install_copy(libraries[0], "pkgB")
+    return libraries
+
+
+def test_dedupe(renv_home, envs):
+    gc = GarbageCollector(renv_home)
+    before = gc.usage()
+    assert before["envs"]["e2"]["shared"] == 0
+
+    report = gc.collect(dry_run=True)
+    assert sorted(report["deduped"]) == [str(envs[1] / "pkgA"), str(envs[2] / "pkgA")]
+    assert report["reclaimed"] > 0
+    assert not (envs[1] / "pkgA" / "R" / "pkgA").samefile(envs[0] / "pkgA" / "R" / "pkgA")
+
+    report = gc.collect()
+    assert sorted(report["deduped"]) == [str(envs[1] / "pkgA"), str(envs[2] / "pkgA")]
+    for library in envs[1:]:
+        assert (library / "pkgA" / "R" / "pkgA").samefile(envs[0] / "pkgA" / "R" / "pkgA")
+        assert not [name for name in os.listdir(str(library)) if name.startswith(".")]
+    # Packages with the same key but different files are left alone
+    assert not (envs[2] / "pkgB" / "R" / "pkgB").samefile(envs[0] / "pkgB" / "R" / "pkgB")
+    after = gc.usage()
+    assert after["envs"]["e2"]["shared"] > 0
+    assert after["total"] < before["total"]
+
+
+def test_prune_orphans_and_busy_envs(renv_home, envs, fake_r):
+    dangling = envs[0] / "gone"
+    os.symlink(str(fake_r / "missing"), str(dangling))
+    busy_dangling = envs[1] / "gone"
+    os.symlink(str(fake_r / "missing"), str(busy_dangling))
+    # An environment built before renv.yaml and the registry existed
+    legacy_home = envs[2].parents[2]
+    (legacy_home / "renv.yaml").unlink()
+    EnvRegistry(renv_home / "registry.sqlite").remove("e3")
+    orphan = renv_home / "cran" / "leftover"
+    (orphan / "lib").mkdir(parents=True)
+
+    with FileLock(env_lock_file(renv_home, "e2")).hold():
+        report = GarbageCollector(renv_home).collect(remove_orphans=True)
+    assert report["envs"]["e2"]["busy"]
+    assert report["pruned"] == [str(dangling)]
+    assert not os.path.lexists(str(dangling))
+    # The environment in use by another process is left alone
+    assert os.path.lexists(str(busy_dangling))
+    assert report["orphans"] == [str(orphan)]
+    assert not orphan.exists()
+    assert not report["envs"]["e3"]["orphaned"]
+    assert (envs[2] / "pkgB" / "DESCRIPTION").is_file()
+    assert report["deduped"] == [str(envs[2] / "pkgA")]
+    assert [entry["name"] for entry in api.list()] == ["e1", "e2"]
+
+
+def test_evict(tmp_path, renv_home, envs):
+    gc = GarbageCollector(renv_home)
+    store = PackageStore(renv_home / "store")
+    # pkgA is used by the environments and pkgC and pkgD are not
+    used = store.ingest_package(envs[0] / "pkgA")
+    unused = {}
+    for pkg in ("pkgC", "pkgD"):
+        unused[pkg] = store.add(_install_copy(tmp_path / "library", pkg))
+    downloads = renv_home / "cache" / "downloads" / "ab" / "abc"
+    downloads.mkdir(parents=True)
+    (downloads / "pkgC_1.0.tar.gz").write_bytes(b"0" * 10000)
+    (downloads / "pkgC_1.0.tar.gz.sha256").write_text("0" * 64)
+    stale_tmp = renv_home / "store" / "pkgE.1234.tmp"
+    stale_tmp.mkdir()
+    # pkgC was used least recently, then the download, then pkgD
+    now = time.time()
+    for age, path in ((300, unused["pkgC"] / "DESCRIPTION"), (200, downloads / "pkgC_1.0.tar.gz"),
+                      (100, unused["pkgD"] / "DESCRIPTION")):
+        os.utime(str(path), (now - age, now - age))
+    os.utime(str(stale_tmp), (now - 7200, now - 7200))
+
+    usage = gc.usage()
+    report = gc.collect(max_cache_size=usage["store"] + usage["cache"] - 1, dedupe=False)
+    assert report["evicted"] == [str(unused["pkgC"].parent)]
+    assert report["tmp"] == [str(stale_tmp)]
+    assert not unused["pkgC"].exists() and not stale_tmp.exists()
+    assert not (renv_home / "store" / "pkgC").exists()
+
+    report = gc.collect(max_cache_size=0, dedupe=False, dry_run=True)
+    assert report["evicted"] == [str(downloads / "pkgC_1.0.tar.gz"), str(unused["pkgD"].parent)]
+    assert (downloads / "pkgC_1.0.tar.gz").exists()
+
+    gc.collect(max_cache_size=0, dedupe=False)
+    assert not downloads.exists()
+    assert not unused["pkgD"].exists()
+    assert used.is_dir()
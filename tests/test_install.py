@@ -0,0 +1,129 @@
+from pathlib import Path
+
+import pytest
+
+import renv.api as api
+import renv.utils as utils
+from renv.cache import DownloadCache, file_digest
+from renv.exceptions import PackageInstallError
+from renv.index import RepoIndex
+from renv.install import PackageInstaller
+from renv.store import PackageStore
+from tests.conftest import make_local_cran
+
+
+def _config(tmp_path, local_cran, **pkg_lists):
+    config = {"CRAN_MIRROR": local_cran, "CRANEXTRA_MIRROR": local_cran, "FIRST_RUN": "declarative",
+              "STANDARD_PKG_LIST": {}, "REPRODUCIBLE_WORKFLOW_PKG_LIST": {}}
+    config.update(pkg_lists)
+    config_file = tmp_path / "renv.yaml"
+    utils.write_renv_config(config_file, config)
+    return str(config_file)
+
+
+def test_index_resolves_from_file_mirror(tmp_path, local_cran):
+    index = RepoIndex(tmp_path / "index.sqlite")
+    assert index.refresh([local_cran]) == {local_cran: 3}
+    # The index is only checked again after max_age
+    assert index.refresh([local_cran]) == {local_cran: None}
+    graph = index.resolve(["pkgC"], [local_cran])
+    assert sorted(graph) == ["pkgA", "pkgB", "pkgC"]
+    assert graph["pkgC"]["deps"] == {"pkgB"}
+    assert graph["pkgA"]["url"] == "%s/src/contrib/pkgA_1.0.tar.gz" % local_cran
+
+
+def test_download_cache(tmp_path, local_cran):
+    downloads = DownloadCache(tmp_path / "downloads")
+    url = "%s/src/contrib/pkgA_1.0.tar.gz" % local_cran
+    md5 = file_digest(Path(url[len("file://"):]), "md5")
+    cached = downloads.fetch(url, md5=md5)
+    assert cached == downloads.path_for(url)
+    assert cached.with_name(cached.name + ".sha256").read_text() == file_digest(cached, "sha256")
+
+    # A corrupt cached file is downloaded again
+    cached.write_bytes(b"corrupt")
+    assert file_digest(downloads.fetch(url, md5=md5), "md5") == md5
+    with pytest.raises(ValueError):
+        downloads.fetch("%s/src/contrib/pkgB_2.1.tar.gz" % local_cran, md5="0" * 32)
+
+
+def test_installer_installs_in_dependency_order(tmp_path, fake_r, local_cran):
+    library = tmp_path / "library"
+    library.mkdir()
+    installer = PackageInstaller(fake_r / "bin" / "Rscript", library, [local_cran],
+                                 index=RepoIndex(tmp_path / "index.sqlite"),
+                                 downloads=DownloadCache(tmp_path / "downloads"), retries=0)
+    results = installer.install(["pkgC", "missing"])
+    assert {pkg: result["status"] for pkg, result in results.items()} == \
+        {"pkgA": "installed", "pkgB": "installed", "pkgC": "installed", "missing": "unavailable"}
+    assert utils.read_description(library / "pkgB")["Version"] == "2.1"
+
+
+def test_declarative_first_run(tmp_path, renv_home, fake_r, local_cran):
+    config_file = _config(tmp_path, local_cran, STANDARD_PKG_LIST={"pkgC": "C"})
+    entry = api.create("e1", str(fake_r), config_file=config_file)
+    env_home = Path(entry["env_home"])
+    library = env_home / "lib64" / "R" / "library"
+    for pkg in ("pkgA", "pkgB", "pkgC"):
+        assert (library / pkg / "DESCRIPTION").is_file()
+    config = utils.read_renv_config(env_home / "renv.yaml")
+    assert config["PACKAGE_INSTALLS"]["pkgC"]["status"] == "installed"
+    # The first R session has nothing to prompt for
+    assert "pkgC" not in (env_home / "bin" / ".Rprofile").read_text()
+
+    # The second environment is built without the mirror's package files
+    for pkg_file in Path(local_cran[len("file://"):], "src", "contrib").glob("*.tar.gz"):
+        pkg_file.unlink()
+    entry = api.create("e2", str(fake_r), config_file=config_file)
+    assert (Path(entry["env_home"]) / "lib64" / "R" / "library" / "pkgA" / "DESCRIPTION").is_file()
+
+
+def test_declarative_first_run_fails_visibly(tmp_path, renv_home, fake_r, local_cran):
+    # BiocInstaller (in the default STANDARD_PKG_LIST) is not on CRAN
+    config_file = _config(tmp_path, local_cran, STANDARD_PKG_LIST={"BiocInstaller": "Bioconductor", "pkgA": "A"})
+    with pytest.raises(PackageInstallError, match="BiocInstaller"):
+        api.create("e1", str(fake_r), config_file=config_file)
+    assert not (renv_home / "cran" / "e1").exists()
+    assert api.list() == []
+
+
+def test_built_packages_are_stored(tmp_path, fake_r, local_cran):
+    store = PackageStore(tmp_path / "store")
+    kwargs = dict(r_minor="3.4", store=store, index=RepoIndex(tmp_path / "index.sqlite"),
+                  downloads=DownloadCache(tmp_path / "downloads"), retries=0)
+    library = tmp_path / "library"
+    library.mkdir()
+    results = PackageInstaller(fake_r / "bin" / "Rscript", library, [local_cran], **kwargs).install(["pkgB"])
+    assert {pkg: result["status"] for pkg, result in results.items()} == {"pkgA": "installed", "pkgB": "installed"}
+    entry = store.find("pkgB", "3.4", "2.1")
+    assert entry
+    # The library links the stored package
+    assert (library / "pkgB" / "DESCRIPTION").samefile(entry / "DESCRIPTION")
+
+    other = tmp_path / "other"
+    other.mkdir()
+    results = PackageInstaller(fake_r / "bin" / "Rscript", other, [local_cran], **kwargs).install(["pkgB"])
+    assert {pkg: result["status"] for pkg, result in results.items()} == {"pkgA": "linked", "pkgB": "linked"}
+
+
+def test_unlinked_system_packages_are_installed(tmp_path, renv_home, fake_r):
+    # pkgM imports a recommended package of the system R
+    repo = make_local_cran(tmp_path / "repo", {"recommended0": ("3.4.4", []), "pkgM": ("1.0", ["recommended0"])})
+    config_file = _config(tmp_path, repo, STANDARD_PKG_LIST={"pkgM": "M"})
+    # Without the recommended packages the environment's R can't load recommended0 from the system library
+    entry = api.create("e1", str(fake_r), config_file=config_file, recommended_packages=False)
+    library = Path(entry["env_home"]) / "lib64" / "R" / "library"
+    assert (library / "recommended0" / "DESCRIPTION").is_file()
+    assert not (library / "recommended0").is_symlink()
+    assert (library / "pkgM" / "DESCRIPTION").is_file()
+
+    # The linked recommended package is used when the environment has it
+    entry = api.create("e2", str(fake_r), config_file=config_file)
+    library = Path(entry["env_home"]) / "lib64" / "R" / "library"
+    assert (library / "recommended0").is_symlink()
+    assert list(utils.read_renv_config(Path(entry["env_home"]) / "renv.yaml")["PACKAGE_INSTALLS"]) == ["pkgM"]
+
+
+def test_negative_retries(tmp_path, fake_r, local_cran):
+    with pytest.raises(ValueError):
+        PackageInstaller(fake_r / "bin" / "Rscript", tmp_path, [local_cran], retries=-1)
@@ -0,0 +1,73 @@
+import pytest
+
+import renv.api as api
+import renv.utils as utils
+from renv.core import LinuxRenvBuilder
+from renv.store import tree_hash
+
+
+def _tamper(path):
+    # Replace the file rather than writing through it, since it is hardlinked with the package store
+    path.unlink()
+    path.write_text("# tampered\n")
+
+
+@pytest.fixture
+def locked(tmp_path, renv_home, fake_r, local_cran):
+    config_file = tmp_path / "renv.yaml"
+    utils.write_renv_config(config_file, {"CRAN_MIRROR": local_cran, "CRANEXTRA_MIRROR": local_cran,
+                                          "FIRST_RUN": "declarative", "STANDARD_PKG_LIST": {"pkgB": "B"},
+                                          "REPRODUCIBLE_WORKFLOW_PKG_LIST": {}})
+    api.create("e1", str(fake_r), config_file=str(config_file))
+    builder = api.env_builder("e1")
+    return builder, builder.lock_venv()
+
+
+def test_lock(fake_r, locked):
+    builder, lock = locked
+    assert utils.read_lockfile(builder.lock_file) == lock
+    assert lock["R"]["Version"] == "3.4.4" and lock["R"]["Home"] == str(fake_r)
+    assert lock["Packages"]["base0"] == {"Version": "3.4.4", "Source": "R"}
+    pkg_a = lock["Packages"]["pkgA"]
+    assert pkg_a["Version"] == "1.0"
+    assert pkg_a["Hash"] == tree_hash(builder.env_library / "pkgA")
+    assert builder.store.entry_path(("pkgA", "1.0", "3.4", pkg_a["Build"])).is_dir()
+
+
+def test_restore_verifies_hashes(locked):
+    builder, lock = locked
+    library = builder.env_library
+    assert builder.restore_venv(lock) == {"pkgA": {"status": "kept", "version": "1.0"},
+                                          "pkgB": {"status": "kept", "version": "2.1"}}
+
+    # A changed package is linked from the store again and an unlocked package is removed with clean
+    _tamper(library / "pkgA" / "R" / "pkgA")
+    (library / "extra").mkdir()
+    results = builder.restore_venv(lock, clean=True)
+    assert results["pkgA"]["status"] == "linked"
+    assert tree_hash(library / "pkgA") == lock["Packages"]["pkgA"]["Hash"]
+    assert results["pkgB"]["status"] == "kept"
+    assert not (library / "extra").exists()
+
+
+def test_restore_rebuilds_corrupt_store_entries(locked, local_cran):
+    builder, lock = locked
+    library = builder.env_library
+    pkg_a = lock["Packages"]["pkgA"]
+    stored = builder.store.entry_path(("pkgA", "1.0", "3.4", pkg_a["Build"]))
+    _tamper(stored / "R" / "pkgA")
+    _tamper(library / "pkgA" / "R" / "pkgA")
+
+    results = builder.restore_venv(lock)
+    assert results["pkgA"] == {"status": "built", "version": "1.0"}
+    assert tree_hash(library / "pkgA") == pkg_a["Hash"]
+    assert tree_hash(stored) == pkg_a["Hash"]
+
+
+def test_restore_new_environment(renv_home, fake_r, locked):
+    builder, lock = locked
+    other = LinuxRenvBuilder(env_name="e2", path=str(renv_home.parent), name=renv_home.name, r_home=str(fake_r))
+    results = other.restore_venv(lock)
+    assert {pkg: result["status"] for pkg, result in results.items()} == {"pkgA": "linked", "pkgB": "linked"}
+    assert (other.env_library / "pkgB" / "DESCRIPTION").samefile(builder.env_library / "pkgB" / "DESCRIPTION")
+    assert other.lock_venv()["Packages"] == lock["Packages"]
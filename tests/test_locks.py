@@ -0,0 +1,90 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import renv.api as api
+from renv.core import LinuxRenvBuilder
+from renv.exceptions import EnvExistsError
+from renv.locks import FileLock, env_lock_file
+
+
+def test_hold_is_reentrant(tmp_path):
+    lock = FileLock(tmp_path / "locks" / "e1.lock")
+    with lock.hold():
+        fd = lock._fd
+        with lock.hold(shared=True):
+            assert lock.depth == 2
+            assert lock._fd == fd
+        assert lock.locked
+        # Another holder of the same file is excluded until the outermost hold is released
+        assert not FileLock(lock.lock_file).acquire(blocking=False)
+    assert not lock.locked
+    assert lock._fd is None
+    with pytest.raises(RuntimeError):
+        lock.release()
+
+
+def test_shared_and_exclusive(tmp_path):
+    lock_file = tmp_path / "e1.lock"
+    reader = FileLock(lock_file)
+    with reader.hold(shared=True):
+        other_reader = FileLock(lock_file)
+        assert other_reader.acquire(shared=True, blocking=False)
+        other_reader.release()
+        assert not FileLock(lock_file).acquire(blocking=False)
+        with pytest.raises(TimeoutError):
+            FileLock(lock_file, timeout=0.2, poll=0.05).acquire()
+    writer = FileLock(lock_file)
+    assert writer.acquire(blocking=False)
+    writer.release()
+
+
+def test_waits_for_release(tmp_path):
+    lock_file = tmp_path / "e1.lock"
+    holder = FileLock(lock_file)
+    holder.acquire()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        start = time.perf_counter()
+        waiter = pool.submit(lambda: FileLock(lock_file, poll=0.01).hold().__enter__())
+        time.sleep(0.2)
+        assert not waiter.done()
+        holder.release()
+        waiter.result(timeout=5)
+        assert time.perf_counter() - start >= 0.2
+
+
+def _builder(renv_home, fake_r, **kwargs):
+    return LinuxRenvBuilder(env_name="e1", path=str(renv_home.parent), name=renv_home.name, r_home=str(fake_r),
+                            **kwargs)
+
+
+def test_built_since(renv_home, fake_r):
+    requested = time.time()
+    api.create("e1", str(fake_r))
+    assert _builder(renv_home, fake_r).built_since(requested)
+    # A different spec or a request made after the build rebuilds
+    assert not _builder(renv_home, fake_r, recommended_packages=False).built_since(requested)
+    assert not _builder(renv_home, fake_r, relocatable=True).built_since(requested)
+    assert not _builder(renv_home, fake_r, prompt="other").built_since(requested)
+    assert not _builder(renv_home, fake_r).built_since(time.time())
+
+
+def test_concurrent_builds_share_one_build(renv_home, fake_r):
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        entries = list(pool.map(lambda _: api.create("e1", str(fake_r)), range(4)))
+    # Every build after the first reused the environment the first one built
+    assert len(set(entry["created"] for entry in entries)) == 1
+    assert [entry["name"] for entry in api.list()] == ["e1"]
+    assert not list(renv_home.glob("cran/.e1~*"))
+
+
+def test_env_lock_file(renv_home, fake_r):
+    builder = _builder(renv_home, fake_r)
+    assert builder.env_lock.lock_file == env_lock_file(renv_home, "e1") == renv_home / "locks" / "e1.lock"
+
+
+def test_clone_onto_itself(renv_home, fake_r):
+    api.create("e1", str(fake_r))
+    with pytest.raises(EnvExistsError):
+        api.clone("e1", "e1")
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from renv.plan import FilesystemPlan
+
+
+def _plan_tree(root, targets):
+    plan = FilesystemPlan(max_workers=2)
+    plan.mkdir(root / "lib" / "library")
+    plan.mkdir(root / "bin")
+    for name, target in targets.items():
+        plan.symlink(target, root / "lib" / "library" / name)
+    plan.symlink(targets["pkgA"], root / "bin" / "pkgA")
+    return plan
+
+
+def test_apply(tmp_path):
+    root = tmp_path / "env"
+    targets = dict(("pkg%s" % c, str(tmp_path / "R" / ("pkg%s" % c))) for c in "ABC")
+    plan = _plan_tree(root, targets)
+    assert len(plan) == 6
+    plan.apply()
+    assert len(plan) == 0
+    for name, target in targets.items():
+        assert os.readlink(str(root / "lib" / "library" / name)) == target
+    assert os.readlink(str(root / "bin" / "pkgA")) == targets["pkgA"]
+
+    # Existing symlinks are an error for apply (sync is used for existing trees)
+    with pytest.raises(FileExistsError):
+        _plan_tree(root, targets).apply()
+
+
+def test_sync(tmp_path):
+    root = tmp_path / "env"
+    old = dict(("pkg%s" % c, str(tmp_path / "old" / ("pkg%s" % c))) for c in "ABC")
+    _plan_tree(root, old).apply()
+    library = root / "lib" / "library"
+    # A user package and a symlink that isn't removable are left alone
+    (library / "userpkg").mkdir()
+    os.symlink(str(tmp_path / "store" / "pkgS"), str(library / "pkgS"))
+
+    new = {"pkgA": old["pkgA"], "pkgB": str(tmp_path / "new" / "pkgB"), "userpkg": str(tmp_path / "new" / "userpkg"),
+           "pkgD": str(tmp_path / "new" / "pkgD")}
+    changes = _plan_tree(root, new).sync(removable=lambda link: "/old/" in os.readlink(link))
+    assert changes == {"added": 1, "retargeted": 1, "removed": 1, "kept": 3}
+    assert os.readlink(str(library / "pkgA")) == old["pkgA"]
+    assert os.readlink(str(library / "pkgB")) == new["pkgB"]
+    assert os.readlink(str(library / "pkgD")) == new["pkgD"]
+    assert not os.path.lexists(str(library / "pkgC"))
+    assert (library / "userpkg").is_dir() and not (library / "userpkg").is_symlink()
+    assert os.path.islink(str(library / "pkgS"))
+    assert not [name for name in os.listdir(str(library)) if name.endswith(".tmp")]
+
+    # Syncing again only removes what is now removable
+    changes = _plan_tree(root, new).sync(removable=lambda link: True)
+    assert changes == {"added": 0, "retargeted": 0, "removed": 1, "kept": 5}
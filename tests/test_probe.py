@@ -0,0 +1,37 @@
+import pytest
+from click.testing import CliRunner
+
+import renv.api as api
+from renv.exceptions import RenvError, RInstallationError
+from renv.renv import renv
+from renv.utils import system_r_probe
+
+
+def test_probe(fake_r):
+    r_info = system_r_probe(str(fake_r / "bin" / "Rscript"))
+    assert r_info["version"] == "3.4.4"
+    assert r_info["packages"]["base0"]["priority"] == "base"
+
+
+def test_failing_probe(renv_home, fake_r):
+    (fake_r / "bin" / "Rscript").write_text("#!/bin/sh\necho 'Fatal error: broken R' >&2\nexit 1\n")
+    with pytest.raises(RInstallationError, match="broken R"):
+        api.create("e1", str(fake_r))
+    assert not (renv_home / "cran" / "e1").exists()
+    assert api.list() == []
+
+
+def test_empty_probe(renv_home, fake_r):
+    (fake_r / "bin" / "Rscript").write_text("#!/bin/sh\nexit 0\n")
+    with pytest.raises(RInstallationError, match="did not report the R version"):
+        api.create("e1", str(fake_r))
+
+
+def test_missing_rscript(renv_home, fake_r):
+    (fake_r / "bin" / "Rscript").unlink()
+    with pytest.raises(RenvError):
+        api.create("e1", str(fake_r))
+    result = CliRunner().invoke(renv, ["-r", str(fake_r), "-e", "e1"])
+    assert result.exit_code == 1
+    assert isinstance(result.exception, SystemExit)
+    assert "Rscript" in result.output
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+import renv.api as api
+from renv.profiling import add_hook, remove_hook, tracer
+from renv.renv import renv
+
+PHASES = ["create_env_dirs", "create_etc_symlink", "create_library_symlink", "materialize", "setup_templates",
+          "create_r_symlink", "write_config", "install_first_run_packages", "commit_venv", "register_venv"]
+
+
+@pytest.fixture(autouse=True)
+def clean_tracer():
+    # The tracer is shared by the whole process
+    yield
+    tracer.enabled = False
+    tracer.hooks = []
+    tracer.reset()
+
+
+def test_trace_json(tmp_path, renv_home, fake_r):
+    trace_file = tmp_path / "trace.json"
+    result = CliRunner().invoke(renv, ["-r", str(fake_r), "-e", "e1", "--profile", "--trace-json", str(trace_file)])
+    assert result.exit_code == 0, result.output
+
+    trace = json.loads(trace_file.read_text())
+    events = trace["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    for event in spans:
+        assert event["ts"] >= 0 and event["dur"] >= 0
+        assert set(event) >= {"name", "cat", "ph", "pid", "tid", "ts", "dur", "args"}
+    # One span per build phase, in the order they ran
+    phase_spans = [event for event in spans if event["name"] in PHASES]
+    assert [event["name"] for event in sorted(phase_spans, key=lambda event: event["ts"])] == PHASES
+    for event in phase_spans:
+        assert event["args"] == {"env_name": "e1"}
+    assert {"ph": "C", "name": "syscalls.symlink"}.items() <= \
+        next(event for event in events if event["name"] == "syscalls.symlink").items()
+    # The summary is printed as well
+    assert "create_env_dirs" in result.stderr
+
+
+def test_hooks_without_recording(renv_home, fake_r):
+    events = []
+    add_hook(events.append)
+    api.create("e1", str(fake_r))
+    remove_hook(events.append)
+    api.create("e2", str(fake_r))
+    assert [event["name"] for event in events if event["name"] in PHASES] == PHASES
+    assert all(event["args"].get("env_name") != "e2" for event in events)
+    # Events are only recorded while the tracer is enabled
+    assert tracer.events == []
+    assert tracer.chrome_trace()["traceEvents"] == []
+
+
+def test_builder_timings(renv_home, fake_r):
+    builder = api.env_builder(api.create("e1", str(fake_r))["name"], env_name="e2")
+    builder.build_venv()
+    assert list(builder.timings) == PHASES
+    assert all(seconds >= 0 for seconds in builder.timings.values())
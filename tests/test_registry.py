@@ -0,0 +1,51 @@
+import shutil
+
+from click.testing import CliRunner
+
+import renv.api as api
+from renv.registry import EnvRegistry
+from renv.renv import renv
+
+
+def _statuses(output):
+    return dict(line.split(": ") for line in output.splitlines() if not line.startswith(" ") and ": " in line)
+
+
+def test_verify(renv_home, fake_r):
+    for env_name in ("healthy", "deleted", "changed", "corrupt"):
+        api.create(env_name, str(fake_r))
+    registry = EnvRegistry(renv_home / "registry.sqlite")
+    packages = registry.get("changed")["packages"]
+    shutil.rmtree(str(api.env_home("deleted")))
+    (api.env_home("changed") / "lib64" / "R" / "library" / "mypkg").mkdir()
+    (api.env_home("corrupt") / "renv.yaml").write_text("R_VERSION: [unclosed\n")
+    # An environment built before the registry existed
+    shutil.copytree(str(api.env_home("healthy")), str(renv_home / "cran" / "legacy"), symlinks=True)
+
+    assert registry.verify(renv_home / "cran") == {"healthy": "ok", "deleted": "removed", "changed": "updated",
+                                                   "corrupt": "invalid", "legacy": "added"}
+    assert registry.get("deleted") is None
+    assert registry.get("changed")["packages"] == packages + 1
+    assert registry.get("corrupt")
+    assert registry.verify(renv_home / "cran", names=["changed"]) == {"changed": "ok"}
+
+
+def test_status_command(renv_home, fake_r):
+    for env_name in ("healthy", "deleted", "corrupt"):
+        api.create(env_name, str(fake_r))
+    shutil.rmtree(str(api.env_home("deleted")))
+    (api.env_home("corrupt") / "renv.yaml").write_text("- not a configuration\n")
+
+    result = CliRunner().invoke(renv, ["status"])
+    assert result.exit_code == 0, result.output
+    assert _statuses(result.stdout) == {"healthy": "registered", "deleted": "registered", "corrupt": "registered"}
+
+    result = CliRunner().invoke(renv, ["status", "--verify"])
+    assert result.exit_code == 0, result.output
+    assert _statuses(result.stdout) == {"healthy": "ok", "deleted": "removed", "corrupt": "invalid"}
+    assert "R 3.4.4" in result.stdout
+
+    result = CliRunner().invoke(renv, ["status", "--verify", "healthy"])
+    assert _statuses(result.stdout) == {"healthy": "ok"}
+    result = CliRunner().invoke(renv, ["list"])
+    assert [line.split()[0] for line in result.stdout.splitlines()] == ["corrupt", "healthy"]
@@ -0,0 +1,70 @@
+import os
+import shutil
+import subprocess as sp
+
+import pytest
+
+import renv.api as api
+import renv.utils as utils
+
+SHELLS = [shell for shell in ("bash", "zsh", "sh", "dash") if shutil.which(shell)]
+
+
+def _activate(shell, env_home):
+    proc = sp.run([shell, "-c", '. "%s/bin/activate" && echo "$VIRTUAL_ENV"' % env_home], stdout=sp.PIPE,
+                  stderr=sp.PIPE, universal_newlines=True)
+    return proc.returncode, proc.stdout.strip(), proc.stderr
+
+
+@pytest.fixture
+def relocatable_env(renv_home, fake_r):
+    return api.env_home(api.create("rel", str(fake_r), relocatable=True)["name"])
+
+
+def test_relative_links(renv_home, relocatable_env):
+    # An R installed under the renv installation path is linked relatively
+    r_home = renv_home.parent / "R-3.4.4"
+    from benchmarks.fake_r import make_fake_r
+    make_fake_r(r_home, n_packages=2, n_recommended=1, n_etc=1)
+    env_home = api.env_home(api.create("rel2", str(r_home), relocatable=True)["name"])
+    assert os.readlink(str(env_home / "bin" / "R")) == "../../../../R-3.4.4/bin/R"
+    assert (env_home / "bin" / "R").exists()
+    # The system R at another path keeps absolute links
+    assert os.path.isabs(os.readlink(str(relocatable_env / "bin" / "R")))
+
+
+def test_env_block_resolves_virtual_env(relocatable_env):
+    assert "${VIRTUAL_ENV}" in (relocatable_env / "bin" / "activate.env").read_text()
+    env_block = utils.read_env_block(relocatable_env)
+    assert env_block["R_LIBS_USER"] == str(relocatable_env / "lib64" / "R" / "library")
+
+
+@pytest.mark.parametrize("shell", SHELLS)
+def test_activate_in_place(shell, relocatable_env):
+    assert _activate(shell, relocatable_env) == (0, str(relocatable_env), "")
+
+
+@pytest.mark.parametrize("shell", SHELLS)
+def test_activate_moved_env(shell, tmp_path, relocatable_env):
+    moved = tmp_path / "moved"
+    os.rename(str(relocatable_env), str(moved))
+    returncode, virtual_env, stderr = _activate(shell, moved)
+    if shell in ("bash", "zsh"):
+        assert (returncode, virtual_env) == (0, str(moved))
+    else:
+        # sh can't report the script's location, so activate fails instead of guessing
+        assert returncode != 0
+        assert virtual_env == ""
+        assert "bash or zsh" in stderr
+
+
+def test_pack_unpack(tmp_path, renv_home, relocatable_env):
+    archive = tmp_path / "rel.tar.xz"
+    assert api.pack("rel", str(archive))["files"] > 0
+    entry = api.unpack(str(archive), env_name="copy")
+    copy_home = api.env_home("copy")
+    assert entry["env_home"] == str(copy_home)
+    assert utils.read_env_block(copy_home)["VIRTUAL_ENV"] == str(copy_home)
+    assert (copy_home / "bin" / "R").exists()
+    assert str(copy_home) in (copy_home / "bin" / "activate.csh").read_text()
+    assert utils.read_renv_config(copy_home / "renv.yaml")["R_ENV_HOME"] == str(copy_home)
@@ -0,0 +1,68 @@
+import os
+import time
+import socket
+import subprocess as sp
+
+import pytest
+
+import renv.api as api
+from renv.core import LinuxRenvBuilder, STALE_STAGING_AGE
+
+
+def _fail(self):
+    raise RuntimeError("The build failed.")
+
+
+def _envs(renv_home):
+    return sorted(os.listdir(str(renv_home / "cran")))
+
+
+def test_failed_build_leaves_nothing(renv_home, fake_r, monkeypatch):
+    monkeypatch.setattr(LinuxRenvBuilder, "write_config", _fail)
+    with pytest.raises(RuntimeError):
+        api.create("e1", str(fake_r))
+    assert _envs(renv_home) == []
+    assert api.list() == []
+
+
+def test_clear_swaps_in_the_new_environment(renv_home, fake_r, monkeypatch):
+    env_home = api.env_home(api.create("e1", str(fake_r))["name"])
+    (env_home / "marker").write_text("old")
+
+    # A failed rebuild keeps the old environment
+    with monkeypatch.context() as patch:
+        patch.setattr(LinuxRenvBuilder, "write_config", _fail)
+        with pytest.raises(RuntimeError):
+            api.create("e1", str(fake_r), clear=True)
+    assert (env_home / "marker").read_text() == "old"
+    assert _envs(renv_home) == ["e1"]
+
+    api.create("e1", str(fake_r), clear=True)
+    assert not (env_home / "marker").exists()
+    assert (env_home / "bin" / "R").exists()
+    assert _envs(renv_home) == ["e1"]
+
+
+def test_remove_stale_staging(renv_home, fake_r):
+    host = socket.gethostname()
+    proc = sp.Popen(["true"])
+    proc.wait()
+    envs_dir = renv_home / "cran"
+    names = {".e1~%s~%s.staging" % (host, proc.pid): False,  # the build process is gone
+             ".e1~%s~%s.staging" % (host, os.getpid()): False,  # left by an earlier process with this pid
+             ".e1~%s~%s.staging" % (host, os.getppid()): True,  # the build is still running
+             ".e1~otherhost~1.old": False,
+             ".e1~otherhost~2.staging": True,
+             ".e2~%s~%s.staging" % (host, proc.pid): True}  # another environment's build
+    for name in names:
+        (envs_dir / name / "bin").mkdir(parents=True)
+    old = time.time() - STALE_STAGING_AGE - 60
+    os.utime(str(envs_dir / ".e1~otherhost~1.old"), (old, old))
+
+    builder = LinuxRenvBuilder(env_name="e1", path=str(renv_home.parent), name=renv_home.name, r_home=str(fake_r))
+    builder.remove_stale_staging()
+    assert _envs(renv_home) == sorted(name for name, kept in names.items() if kept)
+
+    # Building the environment also removes the stale staging directories
+    api.create("e1", str(fake_r))
+    assert (envs_dir / "e1").is_dir()
@@ -0,0 +1,39 @@
+import sys
+import subprocess as sp
+
+# The cumulative import time of renv.renv (what renv --help loads) in a cold interpreter.  It was about 45 ms
+# when this budget was set, so the budget only trips on real regressions (e.g. importing the builders again).
+IMPORT_BUDGET_US = 250000
+
+# Modules that must only be imported by the commands that use them
+HEAVY_MODULES = ("renv.core", "cookiecutter", "yaml", "pkg_resources", "sqlite3", "tarfile")
+
+
+def _import_times(code):
+    proc = sp.run([sys.executable, "-X", "importtime", "-c", code], stdout=sp.PIPE, stderr=sp.PIPE,
+                  universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    return proc.stdout, times
+
+
+def test_help_import_budget():
+    stdout, times = _import_times("import sys\nfrom renv.renv import renv\n"
+                                  "try:\n    renv(['--help'])\nexcept SystemExit:\n    pass\n"
+                                  "print('LOADED', *(m for m in %r if m in sys.modules))" % (HEAVY_MODULES,))
+    assert "Usage:" in stdout
+    assert times["renv.renv"] < IMPORT_BUDGET_US, "import renv.renv took %s us" % times["renv.renv"]
+    loaded = stdout.split("LOADED")[-1].split()
+    assert not loaded, "renv --help imported %s" % ", ".join(loaded)
+
+
+def test_package_is_lazy():
+    _, times = _import_times("import renv; renv.__all__")
+    assert "renv.core" not in times
+    stdout, _ = _import_times("import sys\nfrom renv import LinuxRenvBuilder, RenvError\n"
+                              "print(LinuxRenvBuilder.__module__, 'renv.core' in sys.modules)")
+    assert stdout.split() == ["renv.core", "True"]
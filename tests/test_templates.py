@@ -0,0 +1,82 @@
+import os
+import json
+import stat
+from pathlib import Path
+
+import pytest
+
+import renv.api as api
+from renv.templates import TemplateSet, get_templates
+
+COOKIE_DIR = Path(__file__).resolve().parent.parent / "renv" / "cookies" / "posix"
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(str(path)).st_mode)
+
+
+def test_matches_cookiecutter(tmp_path):
+    cookiecutter = pytest.importorskip("cookiecutter.main").cookiecutter
+    with open(str(COOKIE_DIR / "cookiecutter.json")) as cookie_json:
+        context = {name: "%s-value" % name.strip("_").lower() for name in json.load(cookie_json)}
+    context.update(dirname="out", __VENV_RELOCATABLE__="1", __R_LIBS_SITE_R__='"/envs/e1/lib64/R/library"')
+    cookiecutter(str(COOKIE_DIR), no_input=True, extra_context=context, output_dir=str(tmp_path / "cookiecutter"))
+    expected_dir = tmp_path / "cookiecutter" / "out"
+    assert 'VIRTUAL_ENV="venv_dir-value"' in (expected_dir / "activate").read_text()
+
+    templates = TemplateSet(COOKIE_DIR)
+    output_dir = tmp_path / "renv"
+    output_dir.mkdir()
+    templates.write(context, {filename: output_dir / filename for filename in templates.templates})
+    assert sorted(os.listdir(str(output_dir))) == sorted(os.listdir(str(expected_dir)))
+    for filename in templates.templates:
+        assert (output_dir / filename).read_bytes() == (expected_dir / filename).read_bytes(), filename
+        assert _mode(output_dir / filename) == _mode(expected_dir / filename), filename
+
+
+def test_defaults_and_overrides(tmp_path):
+    templates = TemplateSet(COOKIE_DIR)
+    text = templates.render("activate", {"__VENV_DIR__": "/envs/e1"})
+    assert 'VIRTUAL_ENV="/envs/e1"' in text
+    # Missing variables fall back to cookiecutter.json
+    assert 'if [ -n "" ]' in text
+    output_files = {filename: tmp_path / filename for filename in templates.templates}
+    templates.write({"__VENV_DIR__": "/envs/e1"}, output_files,
+                    overrides={"activate": {"__VENV_RELOCATABLE__": "1"}})
+    assert 'if [ -n "1" ]' in (tmp_path / "activate").read_text()
+    assert 'if [ -n "" ]' not in (tmp_path / "activate").read_text()
+    assert "/envs/e1" in (tmp_path / "activate.csh").read_text()
+
+
+def test_template_cache(tmp_path):
+    cookie_dir = tmp_path / "posix"
+    template_dir = cookie_dir / "{{cookiecutter.dirname}}"
+    template_dir.mkdir(parents=True)
+    (cookie_dir / "cookiecutter.json").write_text('{"dirname": "", "__NAME__": "default"}')
+    (template_dir / "hello").write_text("hello {{ cookiecutter.__NAME__ }}\n")
+    templates = get_templates(cookie_dir)
+    assert get_templates(cookie_dir) is templates
+    assert templates.render("hello", {}) == "hello default\n"
+    # Changing a template compiles the templates again
+    (template_dir / "hello").write_text("goodbye {{cookiecutter.__NAME__}}\n")
+    os.utime(str(template_dir / "hello"), ns=(0, 0))
+    assert get_templates(cookie_dir).render("hello", {"__NAME__": "you"}) == "goodbye you\n"
+
+
+@pytest.mark.parametrize("relocatable", [False, True])
+def test_environment_templates(renv_home, fake_r, relocatable):
+    env_home = api.env_home(api.create("e1", str(fake_r), relocatable=relocatable)["name"])
+    library = env_home / "lib64" / "R" / "library"
+    activate = (env_home / "bin" / "activate").read_text()
+    rprofile_site = (env_home / "lib64" / "R" / "etc" / "Rprofile.site").read_text()
+    assert 'VIRTUAL_ENV="%s"' % env_home in activate
+    assert ('if [ -n "1" ]' in activate) == relocatable
+    if relocatable:
+        assert '.Library.site <- Sys.getenv("R_LIBS_SITE")' in rprofile_site
+    else:
+        assert '.Library.site <- "%s"' % library in rprofile_site
+    assert "{{" not in activate + rprofile_site
+    # The rendered files keep the template's permissions
+    template_dir = COOKIE_DIR / "{{cookiecutter.dirname}}"
+    assert _mode(env_home / "bin" / "activate") == _mode(template_dir / "activate")
+    assert _mode(env_home / "lib64" / "R" / "etc" / "Rprofile.site") == _mode(template_dir / "Rprofile.site")
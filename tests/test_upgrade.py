@@ -0,0 +1,59 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import renv.api as api
+import renv.utils as utils
+from benchmarks.fake_r import make_fake_r
+from renv.exceptions import EnvExistsError
+from renv.store import PackageStore
+
+
+@pytest.fixture
+def upgraded(tmp_path, renv_home, fake_r, local_cran):
+    config_file = tmp_path / "renv.yaml"
+    utils.write_renv_config(config_file, {"CRAN_MIRROR": local_cran, "CRANEXTRA_MIRROR": local_cran,
+                                          "FIRST_RUN": "declarative", "STANDARD_PKG_LIST": {"pkgB": "B"},
+                                          "REPRODUCIBLE_WORKFLOW_PKG_LIST": {}})
+    env_home = Path(api.create("e1", str(fake_r), config_file=str(config_file))["env_home"])
+    library = env_home / "lib64" / "R" / "library"
+    # A package the user built for the new R already
+    (library / "mypkg").mkdir()
+    (library / "mypkg" / "DESCRIPTION").write_text("Package: mypkg\nVersion: 1.0\nBuilt: R 3.5.0; ; ; unix\n")
+    old_inode = (library / "mypkg" / "DESCRIPTION").stat().st_ino
+
+    # The new R has one less recommended package
+    new_r = make_fake_r(tmp_path / "R-3.5.0", n_packages=5, n_recommended=2, n_etc=3, version="3.5.0")
+    entry = api.create("e1", str(new_r), upgrade=True)
+    return entry, env_home, library, new_r, old_inode
+
+
+def test_upgrade_retargets_links(fake_r, upgraded):
+    entry, env_home, library, new_r, _ = upgraded
+    assert entry["r_version"] == "3.5.0"
+    assert os.readlink(str(env_home / "bin" / "R")) == str(new_r / "bin" / "R")
+    for pkg in ("base0", "recommended1"):
+        assert os.readlink(str(library / pkg)) == str(new_r / "lib64" / "R" / "library" / pkg)
+    # The link to the package the new R doesn't have is removed
+    assert not os.path.lexists(str(library / "recommended2"))
+    assert not [path for path in env_home.rglob("*") if path.is_symlink() and str(fake_r) in utils.link_target(path)]
+    assert utils.read_renv_config(env_home / "renv.yaml")["R_ABS_HOME"] == str(new_r)
+
+
+def test_upgrade_rebuilds_stale_packages(upgraded):
+    entry, env_home, library, new_r, old_inode = upgraded
+    for pkg in ("pkgA", "pkgB"):
+        assert utils.read_description(library / pkg)["Built"].startswith("R 3.5")
+    assert not [name for name in os.listdir(str(library)) if name.startswith(".")]
+    # The reinstalled packages are linked from the package store
+    store = PackageStore(env_home.parent.parent / "store")
+    assert (library / "pkgA" / "DESCRIPTION").samefile(store.find("pkgA", "3.5", "1.0") / "DESCRIPTION")
+    # Packages already built for the new R are kept as they are
+    assert (library / "mypkg" / "DESCRIPTION").stat().st_ino == old_inode
+
+
+def test_create_existing_without_upgrade(renv_home, fake_r):
+    api.create("e1", str(fake_r))
+    with pytest.raises(EnvExistsError, match="--upgrade"):
+        api.create("e1", str(fake_r))